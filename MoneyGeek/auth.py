@@ -1,12 +1,15 @@
 import functools
+import os
+import time
 
 # This is part of the flask app which takes care of authentication
 
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, session, url_for
+    Blueprint, current_app, flash, g, redirect, render_template, request, session, url_for
 )
 from werkzeug.security import check_password_hash, generate_password_hash
 
+from . import dao
 from .flask_util import get_da
 
 # All routes are under /auth
@@ -35,22 +38,53 @@ def login():
     if error is None:
       session.clear()
       session['userID'] = user_info['userID']
-      g.user = user_info['username']
+      session['user'] = g.user = user_snapshot(user_info)
       return redirect(url_for('summary.home'))
 
     flash(error)
 
   return render_template('auth/login.html')
 
+# Endpoints that never look at the user
+ANONYMOUS_ENDPOINTS = ('static', )
+
+def user_stamp(userID):
+  # This process's version of the user's row (see dao.get_ref_version), tagged with the pid
+  # since versions are only counted per process
+  return [os.getpid()] + list(dao.get_ref_version(current_app.config['DATABASE'], ('user', userID)))
+
+def user_snapshot(row):
+  return {'userID': row['userID'], 'username': row['username'], 'email': row['email'],
+    'stamp': user_stamp(row['userID']), 'checked': int(time.time())}
+
+def snapshot_valid(snapshot, userID):
+  if not snapshot or snapshot.get('userID') != userID:
+    return False
+  if time.time() - snapshot['checked'] > current_app.config['USER_SNAPSHOT_TTL']:
+    return False
+  # Another worker's stamp can't be compared, its snapshot is only bounded by the TTL
+  return snapshot['stamp'][0] != os.getpid() or snapshot['stamp'] == user_stamp(userID)
+
 @bp.before_app_request
 def load_logged_in_user():
+  # The (signed) session carries a snapshot of the user row, so a normal page load does no
+  # identity query. It is re-read once the user's version in this process moves on or after
+  # USER_SNAPSHOT_TTL seconds (changes made by other processes)
+  if request.endpoint in ANONYMOUS_ENDPOINTS:
+    return
   user_id = session.get('userID')
-  da = get_da()
 
   if user_id is None:
     g.user = None
+  elif snapshot_valid(session.get('user'), user_id):
+    g.user = session['user']
   else:
-    g.user = da.get_user_from_id(user_id)
+    user_info = get_da().get_user_from_id(user_id)
+    if user_info is None:
+      session.clear()
+      g.user = None
+    else:
+      session['user'] = g.user = user_snapshot(user_info)
 
 @bp.route('/logout')
 def logout():
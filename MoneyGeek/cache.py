@@ -0,0 +1,47 @@
+import threading
+import time
+from collections import OrderedDict
+
+class LRUCache:
+  # Thread safe in-process cache evicting the least recently used entry beyond maxsize,
+  # entries also expire ttl seconds after being set. Any object with the same get/set/delete/clear
+  # methods can be plugged in instead (see SUMMARY_CACHE_BACKEND).
+
+  def __init__(self, maxsize=1024, ttl=300, clock=time.monotonic):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.clock = clock
+    self.entries = OrderedDict()   # key -> (expiry, value)
+    self.lock = threading.Lock()
+
+  def get(self, key, default=None):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        return default
+      if entry[0] <= self.clock():
+        del self.entries[key]
+        return default
+      self.entries.move_to_end(key)
+      return entry[1]
+
+  def set(self, key, value):
+    with self.lock:
+      self.entries[key] = (self.clock() + self.ttl, value)
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.maxsize:
+        self.entries.popitem(last=False)
+
+  def delete(self, key):
+    with self.lock:
+      self.entries.pop(key, None)
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+  def __len__(self):
+    return len(self.entries)
+
+def lru_backend(app):
+  return LRUCache(app.config['SUMMARY_CACHE_SIZE'], app.config['SUMMARY_CACHE_TTL'])
@@ -0,0 +1,111 @@
+import re
+import time
+
+# Escapes, and the constructs that only work in a pattern of its own: in the combined regex inline
+# global flags don't compile, named groups clash with another pattern's and group references point
+# at the wrong group
+PATTERN_TOKEN = re.compile(r"\\[1-9]|\\.|\(\?(?:[aiLmsux]+\)|P[<=]|\()")
+
+# Seconds between re-reads of the mapping table, for mappings added by other processes
+REFRESH_TTL = 60
+
+def check_pattern(pattern):
+  # Raises ValueError when pattern can't be used as a mapping
+  try:
+    re.compile(pattern)
+  except re.error as e:
+    raise ValueError(str(e))
+  for token in PATTERN_TOKEN.findall(pattern):
+    if token[0] != "\\" or token[1] in "123456789":
+      raise ValueError("{} is not supported".format(token))
+
+class Categoriser:
+  # Assigns categories from the mapping table. Every pattern is compiled into a single case
+  # insensitive regex, one group per pattern (longest first, so the more specific mapping wins
+  # when several match at the same place), and only recompiled when the mappings change.
+
+  def __init__(self, da, ttl=REFRESH_TTL):
+    self.da = da
+    self.ttl = ttl
+    self.version = None
+    self.checked = None
+    self.mappings = None
+    self.regex = None
+    self.groups = {}   # Group index of each pattern -> category ID
+
+  def refresh(self):
+    # The ref version only follows mappings added in this process. flask add-mapping runs in its
+    # own, so the table is also re-read every ttl seconds and recompiled when it differs
+    version = self.da.get_ref_version('mapping')
+    now = time.monotonic()
+    if version == self.version and self.checked is not None and now - self.checked < self.ttl:
+      return
+    mappings = sorted((m["pattern"], m["categoryID"]) for m in self.da.get_mappings())
+    if mappings != self.mappings:
+      self.compile(mappings)
+      self.mappings = mappings
+    self.version = version
+    self.checked = now
+
+  def compile(self, mappings):
+    # mappings: (pattern, categoryID) pairs
+    parts = []
+    self.groups = {}
+    index = 1
+    for (pattern, categoryID) in sorted(mappings, key=lambda m: (-len(m[0]), m[0])):
+      try:
+        check_pattern(pattern)
+      except ValueError as e:
+        print("WARN: Skipping invalid mapping pattern: {} ({})".format(pattern, e))
+        continue
+      inner = re.compile(pattern).groups
+      parts.append("({})".format(pattern))
+      self.groups[index] = categoryID
+      index += inner + 1
+    self.regex = re.compile("|".join(parts), re.IGNORECASE) if parts else None
+
+  def match(self, name):
+    # Category ID for a transaction name, None when nothing matches
+    if self.regex is None or not name:
+      return None
+    m = self.regex.search(name)
+    if m is None:
+      return None
+    # The outer group of a pattern closes last, so lastindex points at it
+    return self.groups.get(m.lastindex)
+
+  def categorise(self, rows):
+    # Fills in the categoryID of uncategorised add_transactions rows as they stream past.
+    # Refreshes up front, the generator may end up being consumed inside a DAO call.
+    self.refresh()
+    return self._categorise(rows)
+
+  def _categorise(self, rows):
+    for row in rows:
+      if row[7] is None:
+        categoryID = self.match(row[4])
+        if categoryID is not None:
+          row = tuple(row[:7]) + (categoryID, ) + tuple(row[8:])
+      yield row
+
+  def backfill(self, batch_size=1000):
+    # Categorises existing uncategorised transactions, one committed UPDATE batch at a time.
+    # Returns (examined, categorised)
+    self.refresh()
+    examined = 0
+    categorised = 0
+    after = 0
+    while True:
+      batch = self.da.get_uncategorised_transactions(after, batch_size)
+      if not batch:
+        break
+      after = batch[-1]["rowID"]
+      examined += len(batch)
+      updates = []
+      for row in batch:
+        categoryID = self.match(row["name"])
+        if categoryID is not None:
+          updates.append((categoryID, row["rowID"]))
+      if updates:
+        categorised += self.da.set_transaction_categories(updates)
+    return (examined, categorised)
@@ -1,15 +1,364 @@
+import os
+import re
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
 from sqlite3 import IntegrityError
-from datetime import datetime
+from datetime import datetime, MAXYEAR, MINYEAR
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from types import MappingProxyType
 from werkzeug.security import check_password_hash, generate_password_hash
 
+# Migration scripts are named NNNN_description.sql, NNNN being the schema version they produce
+MIGRATION_FILE = re.compile(r'^(\d+)_\w+\.sql$')
+
+def month_range(year, month):
+  # Half open [start, end) ISO date bounds for a month, so date filters can use an index.
+  # ValueError for a month the 4 digit ISO years can't bound
+  year = int(year)
+  month = int(month)
+  if not (MINYEAR <= year < MAXYEAR and 1 <= month <= 12):
+    raise ValueError("Invalid month: {}-{}".format(year, month))
+  if month == 12:
+    return ("{:04d}-12-01".format(year), "{:04d}-01-01".format(year + 1))
+  return ("{:04d}-{:02d}-01".format(year, month), "{:04d}-{:02d}-01".format(year, month + 1))
+
+def to_cents(amount):
+  # Amounts are stored as integer cents, converted exactly from decimal strings or numbers.
+  # ValueError for anything else, including infinities, NaN and amounts too big to round
+  if amount is None:
+    return None
+  try:
+    cents = Decimal(str(amount).strip()) * 100
+    if not cents.is_finite():
+      raise InvalidOperation()
+    return int(cents.quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+  except InvalidOperation:
+    raise ValueError("Invalid amount: {}".format(amount))
+
+def to_timestamp(moment):
+  # Text form of a (UTC) datetime that sorts and compares chronologically, as stored in sync_job
+  return moment.strftime("%Y-%m-%d %H:%M:%S")
+
+def quote_fts(text):
+  return '"{}"'.format(text.replace('"', '""'))
+
+def search_expression(text, accountIDs):
+  # FTS5 query for free text: every word has to match (as a prefix) the description or categories
+  # of a transaction in one of the accounts. Only the words are used, so FTS5 syntax typed into
+  # a search box is never interpreted. None when there is nothing to search for.
+  words = re.findall(r'\w+', text or '')
+  if not words or not accountIDs:
+    return None
+  return "{{name category subCategory}} : ({}) AND accountID : ({})".format(
+    " ".join(quote_fts(w) + "*" for w in words), " OR ".join(quote_fts(a) for a in accountIDs))
+
+# Settings for a database shared by the web app and the sync scripts: readers don't block
+# the writer (WAL), writers wait for each other instead of failing, bigger page cache and mmap
+TUNED_PRAGMAS = {
+  'journal_mode': 'WAL',
+  'synchronous': 'NORMAL',
+  'busy_timeout': 5000,
+  'cache_size': -16000,
+  'mmap_size': 268435456
+}
+
+# Process wide version counters of reference data, keyed by (database file, table) where a
+# table can also be a (table, key) tuple for per user data. The DataAccessor methods changing
+# that data bump them, so whatever is built from it (the compiled category matcher, cached
+# lookups) can tell when it needs rebuilding. Re-initialising or migrating a database moves
+# its generation on, which invalidates everything for that file at once.
+_ref_versions = {}
+_ref_generations = {}
+_ref_lock = threading.Lock()
+
+def get_ref_version(db_file, table):
+  return (_ref_generations.get(db_file, 0), _ref_versions.get((db_file, table), 0))
+
+def bump_ref_version(db_file, table=None):
+  with _ref_lock:
+    if table is None:
+      _ref_generations[db_file] = _ref_generations.get(db_file, 0) + 1
+    else:
+      _ref_versions[(db_file, table)] = _ref_versions.get((db_file, table), 0) + 1
+
+# Snapshots of reference data built by DataAccessor.get_ref_data, keyed by (database file, table).
+# Versions only see changes made in this process, so snapshots are also reloaded after
+# REF_DATA_TTL seconds to pick up changes from other processes (e.g. manual_update). Per user
+# snapshots (budgets) come and go with the users, so only the REF_DATA_ENTRIES most recently
+# used snapshots are kept.
+REF_DATA_TTL = 60
+REF_DATA_ENTRIES = 1024
+_ref_data = OrderedDict()
+
+class RefIndex:
+  # Rows of a reference table with O(1) lookups by id and, optionally, case insensitive name.
+  # Snapshots are shared by every thread of the process, so rows and lookups are read only
+  # views and the DataAccessor getters hand out copies.
+
+  def __init__(self, rows, idColumn, nameColumn=None):
+    self.rows = tuple(MappingProxyType(dict(row)) for row in rows)
+    byID = {}
+    byName = {}
+    for row in self.rows:
+      byID[row[idColumn]] = row
+      if nameColumn:
+        byName.setdefault(row[nameColumn].upper(), row)
+    self.byID = MappingProxyType(byID)
+    self.byName = MappingProxyType(byName)
+
+  def get(self, key):
+    row = self.byID.get(key)
+    return dict(row) if row is not None else None
+
+  def get_by_name(self, name):
+    row = self.byName.get(name.upper())
+    return dict(row) if row is not None else None
+
+  def copy_rows(self):
+    return [dict(row) for row in self.rows]
+
+# (cursor.description, column names) of the last query seen by dict_factory. Replaced as a
+# whole tuple, so concurrent threads at worst rebuild it
+_dict_columns = (None, ())
+
+def dict_factory(cursor, row):
+  # Plain dicts straight off the cursor, usable by templates, JSON and caches without a copy pass.
+  # The column names are only rebuilt when the cursor moves on to a different result set.
+  global _dict_columns
+  description = cursor.description
+  columns = _dict_columns
+  if columns[0] is not description:
+    columns = (description, tuple(column[0] for column in description))
+    _dict_columns = columns
+  return dict(zip(columns[1], row))
+
+# Row types a DataAccessor can return: sqlite3.Row (compact, indexable by name or position)
+# or plain dicts
+ROW_FACTORIES = {
+  'row': sqlite3.Row,
+  'dict': dict_factory
+}
+
+# Statements worth an EXPLAIN QUERY PLAN in the slow query log
+EXPLAINABLE = re.compile(r'^\s*(SELECT|INSERT|UPDATE|DELETE|REPLACE|WITH)\b', re.IGNORECASE)
+
+class QueryStats:
+  # Per statement executions, time and rows fetched, aggregated over every DataAccessor (and
+  # thread) sharing it. Executions taking slow_ms or more are logged with their query plan.
+
+  def __init__(self, slow_ms=None, log=print):
+    self.slow_ms = slow_ms
+    self.log = log
+    self.lock = threading.Lock()
+    self.statements = {}   # SQL -> [executions, seconds, max seconds, rows]
+
+  def record(self, sql, seconds, rows):
+    with self.lock:
+      entry = self.statements.get(sql)
+      if entry is None:
+        entry = self.statements[sql] = [0, 0.0, 0.0, 0]
+      entry[0] += 1
+      entry[1] += seconds
+      entry[2] = max(entry[2], seconds)
+      entry[3] += rows
+
+  def log_slow(self, connection, sql, params, seconds, rows):
+    plan = []
+    if params is not None and EXPLAINABLE.match(sql):
+      cursor = connection.cursor()
+      cursor.row_factory = None
+      try:
+        plan = [row[3] for row in cursor.execute("EXPLAIN QUERY PLAN " + sql, params)]
+      except sqlite3.Error:
+        pass
+      finally:
+        cursor.close()
+    self.log("WARN: Slow query ({:.1f} ms, {} rows): {}{}".format(seconds * 1000, rows, sql,
+      "".join("\n    " + step for step in plan)))
+
+  def summary(self, limit=None):
+    # Statements by total time, most expensive first
+    with self.lock:
+      items = [(sql, list(entry)) for (sql, entry) in self.statements.items()]
+    stats = [{
+      'sql': sql,
+      'executions': executions,
+      'totalMs': round(seconds * 1000, 3),
+      'meanMs': round(seconds * 1000 / executions, 3),
+      'maxMs': round(maxSeconds * 1000, 3),
+      'rows': rows
+    } for (sql, (executions, seconds, maxSeconds, rows)) in items]
+    stats.sort(key=lambda s: s['totalMs'], reverse=True)
+    return stats[:limit] if limit else stats
+
+  def format_summary(self, limit=10):
+    lines = ["{:>6} {:>10} {:>9} {:>9} {:>8}  statement".format("count", "total ms", "mean ms", "max ms", "rows")]
+    for s in self.summary(limit):
+      lines.append("{executions:>6} {totalMs:>10.1f} {meanMs:>9.2f} {maxMs:>9.2f} {rows:>8}  {sql}".format(**s))
+    return lines
+
+  def reset(self):
+    with self.lock:
+      self.statements = {}
+
+class InstrumentedCursor:
+  # Wraps a sqlite3.Cursor, timing a statement from execute until its results have been fetched
+  # (SQLite does most of the work while stepping through them) and counting the rows. A statement
+  # is recorded once fetchone/fetchall returns, fetchmany runs dry or the next one starts.
+
+  def __init__(self, cursor, stats):
+    self.cursor = cursor
+    self.stats = stats
+    self.sql = None
+
+  def __getattr__(self, name):
+    # rowcount, lastrowid, description, connection, ...
+    return getattr(self.cursor, name)
+
+  def __iter__(self):
+    while True:
+      rows = self.fetchmany(100)
+      if not rows:
+        return
+      yield from rows
+
+  def timed(self, fn, *args):
+    started = time.perf_counter()
+    try:
+      return fn(*args)
+    finally:
+      self.seconds += time.perf_counter() - started
+
+  def start(self, sql, params):
+    self.finish()
+    self.sql = " ".join(sql.split())
+    self.params = params
+    self.seconds = 0.0
+    self.rows = 0
+
+  def finish(self):
+    if self.sql is None:
+      return
+    (sql, self.sql) = (self.sql, None)
+    self.stats.record(sql, self.seconds, self.rows)
+    if self.stats.slow_ms is not None and self.seconds * 1000 >= self.stats.slow_ms:
+      self.stats.log_slow(self.cursor.connection, sql, self.params, self.seconds, self.rows)
+
+  def execute(self, sql, params=()):
+    self.start(sql, params)
+    self.timed(self.cursor.execute, sql, params)
+    return self
+
+  def executemany(self, sql, seq_of_params):
+    # Recorded straight away, there is nothing to fetch
+    self.start(sql, None)
+    self.timed(self.cursor.executemany, sql, seq_of_params)
+    self.finish()
+    return self
+
+  def executescript(self, script):
+    self.finish()
+    self.cursor.executescript(script)
+    return self
+
+  def fetchone(self):
+    if self.sql is None:
+      return self.cursor.fetchone()
+    row = self.timed(self.cursor.fetchone)
+    if row is not None:
+      self.rows += 1
+    self.finish()
+    return row
+
+  def fetchmany(self, size=None):
+    if self.sql is None:
+      return self.cursor.fetchmany(size or self.cursor.arraysize)
+    rows = self.timed(self.cursor.fetchmany, size or self.cursor.arraysize)
+    self.rows += len(rows)
+    if not rows:
+      self.finish()
+    return rows
+
+  def fetchall(self):
+    if self.sql is None:
+      return self.cursor.fetchall()
+    rows = self.timed(self.cursor.fetchall)
+    self.rows += len(rows)
+    self.finish()
+    return rows
+
+  def close(self):
+    self.finish()
+    self.cursor.close()
+
+PRAGMA_NAME = re.compile(r'^[a-z_]+$')
+PRAGMA_VALUE = re.compile(r'^-?\w+$')
+
+# Sharded layout: users are spread over N shard files by userID, each holding its users'
+# connections, accounts, transactions, budgets and sync state. These tables live only in the
+# directory database (DATABASE itself), which every shard connection attaches; shards don't
+# have them, so unqualified names in the queries fall through to the directory.
+DIRECTORY_TABLES = ('user', 'institution', 'category', 'mapping')
+
+def shard_file(db_file, shard):
+  # instance/moneygeek.sqlite3 -> instance/moneygeek.shard0.sqlite3
+  (root, ext) = os.path.splitext(db_file)
+  return "{}.shard{:d}{}".format(root, shard, ext)
+
+def shard_for(userID, shards):
+  # Index of the user's shard, always 0 when the database isn't sharded
+  return int(userID) % shards if shards else 0
+
+def open_shards(db_file, shards, **kwargs):
+  # A DataAccessor per shard (indexed by shard_for), or just the one for an unsharded db_file
+  if not shards:
+    return [DataAccessor(db_file, **kwargs)]
+  return [DataAccessor(shard_file(db_file, shard), directory=db_file, **kwargs) for shard in range(shards)]
+
 class DataAccessor:
 
-  def __init__(self, db_file):
-    conn = sqlite3.connect(db_file)
-    conn.row_factory = sqlite3.Row
+  def __init__(self, db_file, pragmas=None, check_same_thread=True, cached_statements=128, row_factory='row',
+      stats=None, directory=None):
+    if row_factory not in ROW_FACTORIES:
+      raise ValueError("Unknown row factory: {}".format(row_factory))
+    if directory and not os.path.exists(db_file):
+      # sqlite would create an empty shard, and its queries would quietly use the directory's tables
+      raise IOError("Shard {} does not exist, run migrate-db --init".format(db_file))
+    conn = sqlite3.connect(db_file, check_same_thread=check_same_thread, cached_statements=cached_statements)
+    conn.row_factory = ROW_FACTORIES[row_factory]
+    self.db_file = db_file
     self.conn = conn
-    self.db = conn.cursor()
+    # Optional QueryStats, every statement run through cursor() is timed into it
+    self.stats = stats
+    self.db = self.cursor()
+    # Directory database of a shard, see DIRECTORY_TABLES
+    self.directory = directory
+    if directory:
+      self.db.execute("ATTACH DATABASE ? AS directory", (directory, ))
+    for (name, value) in (pragmas or {}).items():
+      self.set_pragma(name, value)
+      if directory:
+        self.set_pragma(name, value, 'directory')
+
+  def cursor(self):
+    cursor = self.conn.cursor()
+    if self.stats is not None:
+      return InstrumentedCursor(cursor, self.stats)
+    return cursor
+
+  def set_pragma(self, name, value, schema=None):
+    # PRAGMA doesn't take bound parameters, so only allow plain names and values
+    value = str(value)
+    if not PRAGMA_NAME.match(name) or not PRAGMA_VALUE.match(value):
+      raise ValueError("Invalid pragma: {} = {}".format(name, value))
+    if schema:
+      name = "{}.{}".format(schema, name)
+    self.db.execute("PRAGMA {} = {}".format(name, value))
+
+  def close(self):
+    self.conn.close()
 
   def initialise_db(self, sql_file):
     try:
@@ -17,17 +366,111 @@ class DataAccessor:
         self.db.executescript(f.read())
     except IOError:
       print("Could not find sql script file: {}".format(sql_file))
+    self.invalidate_ref_data()
+
+  def ref_file(self, table):
+    # Directory tables are versioned under the directory database, so every shard sees a change
+    name = table[0] if isinstance(table, tuple) else table
+    if self.directory and name in DIRECTORY_TABLES:
+      return self.directory
+    return self.db_file
+
+  def get_ref_version(self, table):
+    return get_ref_version(self.ref_file(table), table)
+
+  def invalidate_ref_data(self, *tables):
+    # Everything for this database when no tables are given
+    if not tables:
+      bump_ref_version(self.db_file)
+    for table in tables:
+      bump_ref_version(self.ref_file(table), table)
+
+  def get_ref_data(self, table, load):
+    # Process wide snapshot of load() for reference data, reused until the table's version moves on
+    version = self.get_ref_version(table)
+    now = time.monotonic()
+    key = (self.ref_file(table), table)
+    with _ref_lock:
+      entry = _ref_data.get(key)
+      if entry is not None and entry[0] == version and entry[1] + REF_DATA_TTL > now:
+        _ref_data.move_to_end(key)
+        return entry[2]
+    # Loaded outside the lock, threads racing on a stale snapshot at worst load it twice
+    data = load()
+    with _ref_lock:
+      _ref_data[key] = (version, now, data)
+      _ref_data.move_to_end(key)
+      while len(_ref_data) > REF_DATA_ENTRIES:
+        _ref_data.popitem(last=False)
+    return data
+
+  def get_schema_version(self):
+    res = self.db.execute("PRAGMA user_version")
+    return res.fetchone()["user_version"]
+
+  def get_migrations(self, migrations_dir):
+    # Sorted list of (version, path) found in migrations_dir
+    migrations = []
+    for name in os.listdir(migrations_dir):
+      match = MIGRATION_FILE.match(name)
+      if match:
+        migrations.append((int(match.group(1)), os.path.join(migrations_dir, name)))
+    return sorted(migrations)
+
+  def migrate(self, migrations_dir):
+    # Applies every migration newer than the current schema version, each one in its own
+    # transaction along with the version bump. Returns the versions applied.
+    applied = []
+    version = self.get_schema_version()
+    for (number, path) in self.get_migrations(migrations_dir):
+      if number <= version:
+        continue
+      with open(path, 'r', encoding='utf8') as f:
+        script = f.read()
+      try:
+        self.db.executescript("BEGIN;\n{}\nPRAGMA user_version = {:d};\nCOMMIT;".format(script, number))
+      except:
+        if self.conn.in_transaction:
+          self.conn.rollback()
+        raise
+      applied.append(number)
+    if applied:
+      self.invalidate_ref_data()
+    return applied
+
+  def drop_directory_tables(self):
+    # Turns a freshly initialised database into a shard. Done without the directory attached:
+    # schema.sql run on a shard that has it would drop the directory's tables instead.
+    for table in DIRECTORY_TABLES:
+      self.db.execute("DROP TABLE IF EXISTS main." + table)
+    self.conn.commit()
+    self.invalidate_ref_data()
+
+  def rebuild_rollup(self):
+    # Recomputes txn_rollup from scratch, the triggers keep it current after that
+    try:
+      self.db.execute("DELETE FROM txn_rollup")
+      self.db.execute(
+        "INSERT INTO txn_rollup (accountID, year, month, categoryID, totalCents, count) "
+          + "SELECT accountID, CAST(strftime('%Y', date) AS INTEGER), CAST(strftime('%m', date) AS INTEGER), "
+          + "IFNULL(categoryID, 0), SUM(amountCents), COUNT(*) FROM txn GROUP BY 1, 2, 3, 4"
+      )
+      self.conn.commit()
+    except:
+      self.conn.rollback()
+      raise
 
   ##### Adding data (can throw exceptions) ####
 
   def add_user(self, username, password, email):
     existing = self.get_user_info(username, email)
     if not existing:
-      self.db.execute(
+      res = self.db.execute(
         'INSERT INTO user (username, password, email) VALUES (?, ?, ?)',
           (username, generate_password_hash(password), email)
       )
       self.conn.commit()
+      self.invalidate_ref_data(('user', res.lastrowid))
     else:
       self.conn.rollback()
       raise(IOError("ERROR: Username: [{}] or Email: [{}] already exists!".format(existing['username'], existing['email'])))
@@ -42,6 +485,9 @@ class DataAccessor:
           (connectionID, accountID, lastFourID, name, officialName, accountType, accountSubType)
       )
       self.conn.commit()
+      connection = self.db.execute("SELECT userID FROM connection WHERE connectionID = ?", (connectionID, )).fetchone()
+      if connection:
+        self.invalidate_ref_data(('account', connection["userID"]))
     else:
       self.conn.rollback()
       raise(IOError("ERROR: AccountID already exists!"))
@@ -52,6 +498,7 @@ class DataAccessor:
         "INSERT INTO institution (institutionID, name) VALUES (?, ?)", (institutionID, name)
       )
       self.conn.commit()
+      self.invalidate_ref_data('institution')
     except IntegrityError:
       self.conn.rollback()
       raise(IOError("ERROR: InstitutionID already exists!"))
@@ -68,29 +515,79 @@ class DataAccessor:
         "UPDATE connection SET accessCode = ? WHERE userID = ? AND institutionID = ?", (accessCode, userID, institutionID)
       )
       self.conn.commit()
+    self.invalidate_ref_data(('account', userID))
 
   def add_transaction(self, transactionID, accountID, category, subCategory, name, amount, date, categoryID):
     try:
       self.db.execute(
-        "INSERT INTO txn (transactionID, accountID, category, subCategory, name, amount, date, categoryID) VALUES "
+        "INSERT INTO txn (transactionID, accountID, category, subCategory, name, amountCents, date, categoryID) VALUES "
           + "(?, ?, ?, ?, ?, ?, ?, ?)",
-          (transactionID, accountID, category, subCategory, name, amount, date, categoryID)
+          (transactionID, accountID, category, subCategory, name, to_cents(amount), date, categoryID)
       )
       self.conn.commit()
     except sqlite3.IntegrityError:
       self.conn.rollback()
       raise
 
+  def add_transactions(self, rows):
+    # Bulk insert of (transactionID, accountID, category, subCategory, name, amount, date, categoryID)
+    # tuples in a single transaction. Duplicates are ignored rather than raised, returns (inserted, duplicates)
+    counter = [0]
+    def counted():
+      for row in rows:
+        counter[0] += 1
+        yield tuple(row[:5]) + (to_cents(row[5]), ) + tuple(row[6:])
+    try:
+      res = self.db.executemany(
+        "INSERT OR IGNORE INTO txn (transactionID, accountID, category, subCategory, name, amountCents, date, categoryID) "
+          + "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+          counted()
+      )
+      self.conn.commit()
+    except:
+      self.conn.rollback()
+      raise
+    # rowcount only counts direct changes, not those made by triggers
+    inserted = max(res.rowcount, 0)
+    return (inserted, counter[0] - inserted)
+
   def add_category(self, name):
     try:
       self.db.execute(
         "INSERT INTO category (name) VALUES (?)", (name, )
       )
       self.conn.commit()
+      self.invalidate_ref_data('category')
     except sqlite3.IntegrityError:
       self.conn.rollback()
       raise
 
+  def add_mapping(self, pattern, categoryID):
+    # Patterns are case insensitive regular expressions matched against transaction names. The
+    # categoriser skips ones it can't combine with the rest (see categorise.check_pattern)
+    try:
+      re.compile(pattern)
+    except re.error as e:
+      raise ValueError("Invalid pattern: {} ({})".format(pattern, e))
+    try:
+      self.db.execute(
+        "INSERT OR REPLACE INTO mapping (pattern, categoryID) VALUES (?, ?)", (pattern, categoryID)
+      )
+      self.conn.commit()
+    except:
+      self.conn.rollback()
+      raise
+    self.invalidate_ref_data('mapping')
+
+  def delete_mapping(self, pattern):
+    try:
+      self.db.execute("DELETE FROM mapping WHERE pattern = ?", (pattern, ))
+      self.conn.commit()
+    except:
+      self.conn.rollback()
+      raise
+    self.invalidate_ref_data('mapping')
+
   #### Updating data (can throw exception) ####
 
   def update_category(self, accountID, transactionID, categoryID):
@@ -104,7 +601,35 @@ class DataAccessor:
       self.conn.rollback()
       raise
 
+  def update_categories(self, accountID, updates):
+    # Applies (transactionID, categoryID) pairs for one account in a single transaction, only
+    # touching rows whose category actually changes. Returns the number of rows updated
+    try:
+      res = self.db.executemany(
+        "UPDATE txn SET categoryID = ? WHERE accountID = ? AND transactionID = ? AND categoryID IS NOT ?",
+        [(categoryID, accountID, transactionID, categoryID) for (transactionID, categoryID) in updates]
+      )
+      self.conn.commit()
+    except:
+      self.conn.rollback()
+      raise
+    return max(res.rowcount, 0)
+
+  def set_transaction_categories(self, rows):
+    # Bulk categorisation of (categoryID, rowID) pairs in one transaction, for rows that are
+    # still uncategorised. Returns the number of rows updated
+    try:
+      res = self.db.executemany(
+        "UPDATE txn SET categoryID = ? WHERE rowid = ? AND categoryID IS NULL", rows
+      )
+      self.conn.commit()
+    except:
+      self.conn.rollback()
+      raise
+    return max(res.rowcount, 0)
+
   def upsert_budget(self, userID, categoryID, budgetAmount):
+    budgetCents = to_cents(budgetAmount)
     try:
       res = self.db.execute(
         "SELECT 1 FROM budget where userID = ? and categoryID = ?",
@@ -113,14 +638,31 @@ class DataAccessor:
       if res.fetchone():
         # Update existing record
         self.db.execute(
-          "UPDATE budget SET budgetAmount = ? WHERE userID = ? and categoryID = ?",
-          (budgetAmount, userID, categoryID)
+          "UPDATE budget SET budgetCents = ? WHERE userID = ? and categoryID = ?",
+          (budgetCents, userID, categoryID)
         )
       else:
         # Insert new record
         self.db.execute(
-          "INSERT INTO budget (userID, categoryID, budgetAmount) VALUES (?,?,?)",
-          (userID, categoryID, budgetAmount)
+          "INSERT INTO budget (userID, categoryID, budgetCents) VALUES (?,?,?)",
+          (userID, categoryID, budgetCents)
+        )
+      self.conn.commit()
+    except:
+      self.conn.rollback()
+      raise
+    self.invalidate_ref_data(('budget', userID))
+
+  def update_sync_state(self, connectionID, lastSyncDate, lastTxnDate):
+    try:
+      res = self.db.execute(
+        "UPDATE sync_state SET lastSyncDate = ?, lastTxnDate = ? WHERE connectionID = ?",
+        (lastSyncDate, lastTxnDate, connectionID)
+      )
+      if res.rowcount == 0:
+        self.db.execute(
+          "INSERT INTO sync_state (connectionID, lastSyncDate, lastTxnDate) VALUES (?, ?, ?)",
+          (connectionID, lastSyncDate, lastTxnDate)
         )
       self.conn.commit()
     except:
@@ -130,11 +672,13 @@ class DataAccessor:
   #### Getting data (can return None) ####
   
   def get_category_info(self, category):
-    res = self.db.execute(
-      "SELECT categoryID, name FROM category WHERE UPPER(name) = UPPER(?)", (category, )
-    )
-    row = res.fetchone()
-    return row
+    # Case insensitive, served from the reference data cache
+    if category is None:
+      return None
+    return self.get_category_index().get_by_name(category)
+
+  def get_category_by_id(self, categoryID):
+    return self.get_category_index().get(categoryID)
 
   def get_user_info(self, username, email=""):
     res = self.db.execute(
@@ -159,11 +703,13 @@ class DataAccessor:
     return row
 
   def get_institution_info(self, institutionID):
-    res = self.db.execute(
-      "SELECT institutionID, name FROM institution WHERE institutionID = ?", (institutionID, )
-    )
-    row = res.fetchone()
-    return row
+    return self.get_institution_index().get(institutionID)
+
+  def get_institution_by_name(self, name):
+    return self.get_institution_index().get_by_name(name)
+
+  def get_budget_info(self, userID, categoryID):
+    return self.get_budget_index(userID).get(categoryID)
 
   def get_user_connections(self, userID):
     res = self.db.execute(
@@ -189,10 +735,18 @@ class DataAccessor:
     row = res.fetchone()
     return row
 
+  def get_sync_state(self, connectionID):
+    res = self.db.execute(
+      "SELECT connectionID, lastSyncDate, lastTxnDate FROM sync_state WHERE connectionID = ?", (connectionID, )
+    )
+    row = res.fetchone()
+    return row
+
   def get_transaction_info(self, userID, transactionID, accountID):
     res = self.db.execute(
-      "SELECT userID, transactionID, accountID, category, subCategory, name, amount, date, categoryID FROM txn "
-        + "WHERE userID = ? AND transactionID = ? AND accountID = ?", (userID, transactionID, accountID) 
+      "SELECT c.userID, t.transactionID, t.accountID, t.category, t.subCategory, t.name, t.amountCents / 100.0 AS amount, "
+        + "t.date, t.categoryID FROM connection c, account a, txn t WHERE c.userID = ? AND c.connectionID = a.connectionID "
+        + "AND a.accountID = t.accountID AND t.transactionID = ? AND t.accountID = ?", (userID, transactionID, accountID)
     )
     row = res.fetchone()
     return row
@@ -206,10 +760,7 @@ class DataAccessor:
     return res.fetchall()
 
   def get_institutions(self):
-    res = self.db.execute(
-      "SELECT institutionID, name FROM institution"
-    )
-    return res.fetchall()
+    return self.get_institution_index().copy_rows()
 
   def get_accounts(self, connectionID):
     res = self.db.execute(
@@ -219,8 +770,42 @@ class DataAccessor:
     return res.fetchall()
  
   def get_categories(self):
+    return self.get_category_index().copy_rows()
+
+  def get_mappings(self):
+    res = self.db.execute(
+      "SELECT pattern, categoryID FROM mapping"
+    )
+    return res.fetchall()
+
+  def search_transactions(self, userID, text, start=None, end=None, minCents=None, maxCents=None, limit=50):
+    # Best matches of text across the user's accounts (bm25, a hit in the description counting
+    # most), optionally within a [start, end) date range and an amount range in cents. The
+    # accountID terms only narrow the index scan: a tokenised accountID phrase like "chk" also
+    # matches "chk-savings", so the user is enforced by the join on connection.
+    expression = search_expression(text, [a["accountID"] for a in self.get_summary(userID)])
+    if expression is None:
+      return []
+    sql = ("SELECT t.transactionID, t.accountID, a.name AS account, t.date, t.name, t.amountCents, "
+      + "t.amountCents / 100.0 AS amount, t.category, t.subCategory, t.categoryID, c.name AS userCategory "
+      + "FROM txn_search s JOIN txn t ON t.rowid = s.rowid JOIN account a ON a.accountID = t.accountID "
+      + "JOIN connection cn ON cn.connectionID = a.connectionID AND cn.userID = ? "
+      + "LEFT JOIN category c ON t.categoryID = c.categoryID WHERE txn_search MATCH ?")
+    params = [userID, expression]
+    for (predicate, value) in ((" AND t.date >= ?", start), (" AND t.date < ?", end),
+        (" AND t.amountCents >= ?", minCents), (" AND t.amountCents <= ?", maxCents)):
+      if value is not None:
+        sql += predicate
+        params.append(value)
+    sql += " ORDER BY bm25(txn_search, 10.0, 2.0, 1.0, 0.0), t.date DESC LIMIT ?"
+    params.append(limit)
+    return self.db.execute(sql, params).fetchall()
+
+  def get_uncategorised_transactions(self, afterRowID, limit):
+    # Keyset paged so callers can categorise as they go
     res = self.db.execute(
-      "SELECT categoryID, name FROM category"
+      "SELECT rowid AS rowID, name FROM txn WHERE categoryID IS NULL AND rowid > ? ORDER BY rowid LIMIT ?",
+      (afterRowID, limit)
     )
     return res.fetchall()
 
@@ -233,19 +818,70 @@ class DataAccessor:
 
   def get_transactions(self, accountID):
     res = self.db.execute(
-      "SELECT t.transactionID, t.accountID, t.category, t.subCategory, t.name, t.amount, t.date, t.categoryID, c.name as userCategory "
+      "SELECT t.transactionID, t.accountID, t.category, t.subCategory, t.name, t.amountCents / 100.0 AS amount, t.date, t.categoryID, c.name as userCategory "
       + "FROM txn t LEFT JOIN category c ON t.categoryID = c.categoryID WHERE accountID = ?", (accountID, )
     )
     return res.fetchall()
 
   def get_transactions_for_month(self, accountID, year, month):
+    (start, end) = month_range(year, month)
     res = self.db.execute(
-      "SELECT t.transactionID, t.accountID, t.category, t.subCategory, t.name, t.amount, t.date, t.categoryID, c.name as userCategory "
-      + "FROM txn t LEFT JOIN category c ON t.categoryID = c.categoryID WHERE accountID = ? "
-      + "AND strftime(\"%Y\", t.date) = ? AND strftime(\"%m\", t.date) = ?", (accountID, year, month)
+      "SELECT t.transactionID, t.accountID, t.category, t.subCategory, t.name, t.amountCents / 100.0 AS amount, t.date, t.categoryID, c.name as userCategory "
+      + "FROM txn t LEFT JOIN category c ON t.categoryID = c.categoryID WHERE t.accountID = ? "
+      + "AND t.date >= ? AND t.date < ?", (accountID, start, end)
     )
     return res.fetchall()
 
+  def get_transaction_page(self, accountID, start, end, after=None, limit=100):
+    # One page of an account's [start, end) transactions in (date, transactionID) order, starting
+    # after the (date, transactionID) key of the previous page's last row. The key seeks straight
+    # into txn_account_date_id so every page costs the same however deep it is.
+    # Returns (rows, key of the next page or None when this is the last one)
+    sql = ("SELECT t.transactionID, t.accountID, t.category, t.subCategory, t.name, t.amountCents, "
+      + "t.amountCents / 100.0 AS amount, t.date, t.categoryID, c.name as userCategory "
+      + "FROM txn t LEFT JOIN category c ON t.categoryID = c.categoryID WHERE t.accountID = ? ")
+    if after:
+      sql += "AND (t.date, t.transactionID) > (?, ?) "
+      params = [accountID, after[0], after[1]]
+    else:
+      sql += "AND t.date >= ? "
+      params = [accountID, start]
+    sql += "AND t.date < ? ORDER BY t.date, t.transactionID LIMIT ?"
+    # One extra row tells whether there is a next page
+    rows = self.db.execute(sql, params + [end, limit + 1]).fetchall()
+    if len(rows) <= limit:
+      return (rows, None)
+    rows = rows[:limit]
+    return (rows, (rows[-1]["date"], rows[-1]["transactionID"]))
+
+  def iter_transactions(self, userID, accountID=None, start=None, end=None, batch_size=500):
+    # Generator over a user's transactions (optionally one account and/or a [start, end) date
+    # range), fetched batch_size rows at a time on its own cursor so memory use stays constant.
+    # Accounts are walked one at a time so each query is an ordered index range, never a sort.
+    accounts = [(a["accountID"], a["account"]) for a in self.get_summary(userID)
+      if accountID is None or a["accountID"] == accountID]
+    sql = ("SELECT t.transactionID, t.accountID, ? AS account, t.date, t.name, t.amountCents, t.category, "
+      + "t.subCategory, t.categoryID, c.name AS userCategory "
+      + "FROM txn t LEFT JOIN category c ON t.categoryID = c.categoryID WHERE t.accountID = ?")
+    if start:
+      sql += " AND t.date >= ?"
+    if end:
+      sql += " AND t.date < ?"
+    sql += " ORDER BY t.date, t.transactionID"
+    for (acctID, acctName) in accounts:
+      params = [acctName, acctID] + [d for d in (start, end) if d]
+      cursor = self.cursor()
+      try:
+        cursor.execute(sql, params)
+        while True:
+          rows = cursor.fetchmany(batch_size)
+          if not rows:
+            break
+          for row in rows:
+            yield row
+      finally:
+        cursor.close()
+
   def get_summary(self, userID):
     res = self.db.execute(
       "SELECT c.connectionID, i.name AS institution, a.accountID, a.name as account, a.accountID, "
@@ -258,49 +894,151 @@ class DataAccessor:
 
   #### Canned Queries ####
   def find_uncategorised_accounts(self, userID):
+    # Months of the user's accounts that still have uncategorised transactions, with how many.
+    # Walks the txn_uncategorised partial index, so the categorised history is never read
     res = self.db.execute(
-      "SELECT lastFourID, strftime(\"%Y\", t.date) AS year, strftime(\"%m\", t.date) AS month "
-        + "FROM conection c, txn t, account a WHERE c.userID = ? AND c.connectionID = a.connectionID "
-        + "AND a.accountID = t.accountID AND t.categoryID IS NULL "
-        + "GROUP BY lastFourID, year, month",
+      "SELECT a.accountID, a.name AS account, a.lastFourID, substr(t.date, 1, 4) AS year, "
+        + "substr(t.date, 6, 2) AS month, COUNT(*) AS pending "
+        + "FROM connection c, account a, txn t WHERE c.userID = ? "
+        + "AND c.connectionID = a.connectionID AND a.accountID = t.accountID AND t.categoryID IS NULL "
+        + "GROUP BY a.accountID, year, month ORDER BY a.name, a.accountID, year DESC, month DESC",
         (userID, )
     )
     return res.fetchall()
 
   def get_monthly_summary(self, userID, year, month):
     res = self.db.execute(
-      "SELECT strftime('%Y', t.date) AS year, "
-        + "strftime('%m', t.date) AS month, "
+      "SELECT r.year AS year, "
+        + "r.month AS month, "
         + "COALESCE(cat.name, 'Uncategorised') AS catName, "
-        + "ROUND(SUM(t.amount),2) AS total, "
-        + "COALESCE(b.budgetAmount, 0) AS budget "
-        + "FROM connection c, account a, txn t "
-        + "LEFT JOIN category cat ON t.categoryID = cat.categoryID " 
-        + "LEFT JOIN budget b ON t.categoryID = b.categoryID "
+        + "SUM(r.totalCents) / 100.0 AS total, "
+        + "COALESCE(b.budgetCents, 0) / 100.0 AS budget "
+        + "FROM connection c, account a, txn_rollup r "
+        + "LEFT JOIN category cat ON r.categoryID = cat.categoryID "
+        + "LEFT JOIN budget b ON r.categoryID = b.categoryID AND b.userID = c.userID "
         + "WHERE c.userID = ? AND c.connectionID = a.connectionID "
-        + "AND a.accountID = t.accountID AND year = ? and month = ? GROUP BY catName ORDER BY catName",
-        (userID, year, month)
+        + "AND a.accountID = r.accountID AND r.year = ? AND r.month = ? GROUP BY catName ORDER BY catName",
+        (userID, int(year), int(month))
     )
     return res.fetchall()
 
   def get_annual_summary(self, userID, year):
+    return self.get_period_summary(userID, year, year)
+
+  def get_period_summary(self, userID, startYear, endYear):
+    # Category totals per month for the years [startYear, endYear] in one query
     res = self.db.execute(
-      "SELECT c.name, c.categoryID, x.month, x.year, ROUND(SUM(x.amount),2) as amount "
-      + "FROM category c LEFT JOIN "
-      + "  (SELECT strftime(\"%Y\", t.date) AS year, strftime(\"%m\", t.date) AS month, t.amount, t.categoryID "
-      + "  FROM connection c, account a, txn t "
-      + "  WHERE c.userID = ? AND c.connectionID = a.connectionID and a.accountID = t.accountID)x "
-      + "ON c.categoryID = x.categoryID WHERE year = ? GROUP BY c.name, c.categoryID, x.month, x.year ORDER BY c.name, x.month, x.year",
-      (userID, year)
+      "SELECT cat.name, cat.categoryID, r.month, r.year, SUM(r.totalCents) AS amountCents, SUM(r.totalCents) / 100.0 AS amount "
+      + "FROM connection c, account a, txn_rollup r, category cat "
+      + "WHERE c.userID = ? AND c.connectionID = a.connectionID AND a.accountID = r.accountID "
+      + "AND r.year >= ? AND r.year <= ? AND r.categoryID = cat.categoryID "
+      + "GROUP BY cat.name, cat.categoryID, r.year, r.month ORDER BY cat.name, r.year, r.month",
+      (userID, int(startYear), int(endYear))
     )
     return res.fetchall()
 
   def get_budget(self, userID):
+    return self.get_budget_index(userID).copy_rows()
+
+  #### Sync jobs (see sync_daemon.py), times are to_timestamp strings ####
+
+  def ensure_sync_jobs(self, now):
+    # A job due now for every connection that doesn't have one yet, returns how many were added
+    try:
+      res = self.db.execute(
+        "INSERT OR IGNORE INTO sync_job (connectionID, nextRunAt) SELECT connectionID, ? FROM connection", (now, )
+      )
+      self.conn.commit()
+    except:
+      self.conn.rollback()
+      raise
+    return max(res.rowcount, 0)
+
+  def claim_sync_jobs(self, now, limit):
+    # Marks up to limit due jobs as running and returns them with their connection, stalest
+    # first: never synced, then by oldest successful sync. Claiming is a single statement so
+    # two daemons on the same database never run the same job.
+    try:
+      res = self.db.execute(
+        "UPDATE sync_job SET status = 'running', startedAt = ? WHERE connectionID IN ("
+          + "SELECT connectionID FROM sync_job WHERE status = 'idle' AND nextRunAt <= ? "
+          + "ORDER BY lastSuccessAt IS NOT NULL, lastSuccessAt, nextRunAt LIMIT ?) RETURNING connectionID",
+          (now, now, limit)
+      )
+      claimed = [row["connectionID"] for row in res.fetchall()]
+      self.conn.commit()
+    except:
+      self.conn.rollback()
+      raise
+    if not claimed:
+      return []
+    res = self.db.execute(
+      "SELECT j.connectionID, j.attempts, j.lastSuccessAt, j.windowStart, j.checkpointOffset, c.userID, "
+        + "c.institutionID, c.accessCode, i.name FROM sync_job j, connection c, institution i "
+        + "WHERE j.connectionID = c.connectionID AND c.institutionID = i.institutionID "
+        + "AND j.connectionID IN (" + ", ".join("?" * len(claimed)) + ") "
+        + "ORDER BY j.lastSuccessAt IS NOT NULL, j.lastSuccessAt, j.nextRunAt", claimed
+    )
+    return res.fetchall()
+
+  def checkpoint_sync_job(self, connectionID, windowStart, checkpointOffset):
+    # How far into the window [windowStart, today] the running job has stored transactions
+    self.db.execute(
+      "UPDATE sync_job SET windowStart = ?, checkpointOffset = ? WHERE connectionID = ?",
+      (windowStart, checkpointOffset, connectionID)
+    )
+    self.conn.commit()
+
+  def complete_sync_job(self, connectionID, now, nextRunAt):
+    self.db.execute(
+      "UPDATE sync_job SET status = 'idle', attempts = 0, lastError = NULL, lastSuccessAt = ?, nextRunAt = ?, "
+        + "windowStart = NULL, checkpointOffset = 0 WHERE connectionID = ?", (now, nextRunAt, connectionID)
+    )
+    self.conn.commit()
+
+  def fail_sync_job(self, connectionID, error, nextRunAt):
+    # Keeps the checkpoint, the retry carries on from the last stored page
+    self.db.execute(
+      "UPDATE sync_job SET status = 'idle', attempts = attempts + 1, lastError = ?, nextRunAt = ? "
+        + "WHERE connectionID = ?", (error, nextRunAt, connectionID)
+    )
+    self.conn.commit()
+
+  def release_sync_jobs(self, startedBefore):
+    # Jobs left running by a daemon that stopped without finishing them become due again. Only
+    # the ones claimed before startedBefore, so another daemon's live jobs are left alone.
+    # Returns how many there were.
+    res = self.db.execute(
+      "UPDATE sync_job SET status = 'idle' WHERE status = 'running' AND startedAt < ?", (startedBefore, )
+    )
+    self.conn.commit()
+    return max(res.rowcount, 0)
+
+  def get_sync_jobs(self):
     res = self.db.execute(
-      "SELECT categoryID, budgetAmount FROM budget WHERE userID = ?", (userID, )
+      "SELECT j.connectionID, u.username, i.name, j.status, j.nextRunAt, j.attempts, j.lastError, "
+        + "j.lastSuccessAt, j.windowStart, j.checkpointOffset FROM sync_job j, connection c, institution i, user u "
+        + "WHERE j.connectionID = c.connectionID AND c.institutionID = i.institutionID AND c.userID = u.userID "
+        + "ORDER BY j.nextRunAt, j.connectionID"
     )
     return res.fetchall()
 
+  #### Reference data (cached per process, see get_ref_data) ####
+
+  def get_category_index(self):
+    return self.get_ref_data('category', lambda: RefIndex(
+      self.db.execute("SELECT categoryID, name FROM category").fetchall(), 'categoryID', 'name'))
+
+  def get_institution_index(self):
+    return self.get_ref_data('institution', lambda: RefIndex(
+      self.db.execute("SELECT institutionID, name FROM institution").fetchall(), 'institutionID', 'name'))
+
+  def get_budget_index(self, userID):
+    return self.get_ref_data(('budget', userID), lambda: RefIndex(
+      self.db.execute(
+        "SELECT categoryID, budgetCents, budgetCents / 100.0 AS budgetAmount FROM budget WHERE userID = ?", (userID, )
+      ).fetchall(), 'categoryID'))
+
   #### Validate ####
 
   def check_password(self, username, password):
@@ -320,6 +1058,9 @@ class DataAccessor:
     results = []
     if not rows or len(rows) == 0:
       return results
+    # Already dicts with the dict row factory
+    if isinstance(rows[0], dict):
+      return list(rows)
     keys = rows[0].keys()
     for r in rows:
       m = {}
@@ -0,0 +1,22 @@
+from flask import Blueprint, abort, current_app, jsonify, request
+
+from .auth import login_required
+from .flask_util import get_sql_stats
+
+# Diagnostics, only available when enabled in the config
+bp = Blueprint('debug', __name__, url_prefix='/debug')
+
+@bp.route('/sql', methods=('GET', 'DELETE'))
+@login_required
+def sql():
+  # Per statement timings of this process, most expensive first (limit=N for the top N).
+  # DELETE starts the aggregates afresh, for everyone, so only in debug mode or with SQL_STATS_RESET.
+  stats = get_sql_stats()
+  if stats is None:
+    abort(404)
+  if request.method == 'DELETE':
+    if not (current_app.debug or current_app.config['SQL_STATS_RESET']):
+      abort(403)
+    stats.reset()
+    return jsonify({'statements': []})
+  return jsonify({'statements': stats.summary(request.args.get('limit', type=int))})
@@ -0,0 +1,47 @@
+import csv
+import io
+import json
+
+# Columns written by every export format, in order
+COLUMNS = ('transactionID', 'accountID', 'account', 'date', 'name', 'amount', 'category', 'subCategory',
+  'categoryID', 'userCategory')
+
+def format_cents(cents):
+  # Exact decimal string for integer cents, e.g. -1999 -> "-19.99"
+  sign = "-" if cents < 0 else ""
+  return "{}{}.{:02d}".format(sign, abs(cents) // 100, abs(cents) % 100)
+
+def to_record(row):
+  # Ordered as COLUMNS, with the amount as an exact decimal string
+  record = {}
+  for column in COLUMNS:
+    if column == 'amount':
+      record[column] = format_cents(row['amountCents'])
+    else:
+      record[column] = row[column]
+  return record
+
+def csv_lines(rows):
+  # Generator of CSV lines (header first), reusing one small buffer
+  buf = io.StringIO()
+  writer = csv.writer(buf)
+  writer.writerow(COLUMNS)
+  for row in rows:
+    record = to_record(row)
+    writer.writerow([record[column] for column in COLUMNS])
+    yield buf.getvalue()
+    buf.seek(0)
+    buf.truncate(0)
+  # Nothing exported, still send the header
+  if buf.tell():
+    yield buf.getvalue()
+
+def ndjson_lines(rows):
+  for row in rows:
+    yield json.dumps(to_record(row)) + "\n"
+
+# format -> (line generator, mimetype)
+FORMATS = {
+  'csv': (csv_lines, 'text/csv'),
+  'ndjson': (ndjson_lines, 'application/x-ndjson')
+}
@@ -0,0 +1,256 @@
+import json
+import os
+import random
+import threading
+import time
+from datetime import date, timedelta
+
+# Local stand-ins for plaid.Client, so ingest (pull_data, sync_daemon, manual_update) can run and
+# be benchmarked without network access or credentials. Anything passed around as a plaid
+# client only needs the calls plaid_dao makes:
+#   client.Accounts.get(access_token)
+#   client.Transactions.get(access_token, start_date, end_date, count=..., offset=...)
+#   client.Institutions.search(query)
+# FakeClient serves deterministic generated data, RecordingClient wraps any client and writes
+# its responses to a file that ReplayClient serves back later. plaid_dao.get_client_from_env
+# picks one from PLAID_ENV. No package relative imports, the scripts import this as a sibling.
+
+# plaid style category lists and merchant names the fake transactions are drawn from
+CATEGORIES = (
+  (["Shops", "Supermarkets and Groceries"], ("WHOLE FOODS", "TRADER JOES", "SAFEWAY"), 4500),
+  (["Food and Drink", "Restaurants", "Coffee Shop"], ("STARBUCKS", "BLUE BOTTLE"), 450),
+  (["Food and Drink", "Restaurants"], ("CHIPOTLE", "SWEETGREEN", "DOORDASH"), 1500),
+  (["Travel", "Taxi"], ("UBER TRIP", "LYFT RIDE"), 1800),
+  (["Shops", "Digital Purchase"], ("AMAZON MKTPLACE", "AMZN DIGITAL"), 3000),
+  (["Service", "Utilities"], ("CON EDISON", "VERIZON WIRELESS"), 8000),
+  (["Recreation", "Gyms and Fitness Centers"], ("EQUINOX",), 6000),
+  (["Transfer", "Payroll"], ("ACME CORP PAYROLL",), -250000)
+)
+ACCOUNT_TYPES = (("Checking", "depository", "checking"), ("Credit Card", "credit", "credit card"),
+  ("Savings", "depository", "savings"))
+INSTITUTION_NAMES = ("Chase", "Bank of America", "Wells Fargo", "Citi", "Capital One", "US Bank", "PNC",
+  "TD Bank", "Ally", "Discover", "American Express", "Charles Schwab")
+
+class PlaidError(Exception):
+  # Mirrors plaid.errors.PlaidError, callers look at type and code
+
+  def __init__(self, message, type, code, display_message=None):
+    super().__init__(message)
+    self.message = message
+    self.type = type
+    self.code = code
+    self.display_message = display_message
+
+class RateLimitExceededError(PlaidError):
+  pass
+
+def to_error(error):
+  # Re-raisable form of a recorded error
+  cls = RateLimitExceededError if error["type"] == "RATE_LIMIT_EXCEEDED" else PlaidError
+  return cls(error["message"], error["type"], error["code"])
+
+class Endpoint:
+  # Client.<group>.<method>(...) calls forwarded to client.call("<group>.<method>", ...)
+
+  def __init__(self, client, group):
+    self.client = client
+    self.group = group
+
+  def __getattr__(self, name):
+    method = "{}.{}".format(self.group, name)
+    return lambda *args, **kwargs: self.client.call(method, *args, **kwargs)
+
+class FakeClient:
+  # Deterministic plaid: every access token has `accounts` accounts, each with about
+  # `per_day` transactions a day (the same ones for the same seed, token and day, so re-fetching
+  # overlapping windows gives duplicates exactly like plaid). The last `pending_days` days are
+  # pending. Every request sleeps `latency` seconds (+-`jitter`), every `rate_limit_every`th one
+  # fails with RATE_LIMIT_EXCEEDED and `error_rate` of them with an INTERNAL_SERVER_ERROR.
+
+  def __init__(self, accounts=2, per_day=3, pending_days=2, institutions=50, latency=0.0, jitter=0.0,
+      rate_limit_every=0, error_rate=0.0, max_page_size=500, seed=1, sleep=time.sleep, today=None):
+    self.accounts = accounts
+    self.per_day = per_day
+    self.pending_days = pending_days
+    self.institutions = institutions
+    self.latency = latency
+    self.jitter = jitter
+    self.rate_limit_every = rate_limit_every
+    self.error_rate = error_rate
+    self.max_page_size = max_page_size
+    self.seed = seed
+    self.sleep = sleep
+    self.today = today
+    self.random = random.Random(seed)
+    self.lock = threading.Lock()
+    self.requests = 0
+    self.windows = {}   # (access token, start, end) -> transactions, newest first
+    self.Accounts = Endpoint(self, "Accounts")
+    self.Transactions = Endpoint(self, "Transactions")
+    self.Institutions = Endpoint(self, "Institutions")
+
+  @classmethod
+  def from_env(cls, environ=os.environ):
+    # Sizes and faults from PLAID_FAKE_* variables, e.g. PLAID_FAKE_LATENCY=0.2
+    options = {}
+    for (name, convert) in (("accounts", int), ("per_day", int), ("pending_days", int), ("institutions", int),
+        ("latency", float), ("jitter", float), ("rate_limit_every", int), ("error_rate", float),
+        ("max_page_size", int), ("seed", int)):
+      value = environ.get("PLAID_FAKE_" + name.upper())
+      if value:
+        options[name] = convert(value)
+    return cls(**options)
+
+  def call(self, method, *args, **kwargs):
+    with self.lock:
+      self.requests += 1
+      count = self.requests
+      failing = self.error_rate and self.random.random() < self.error_rate
+      delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+    if delay:
+      self.sleep(delay)
+    if self.rate_limit_every and count % self.rate_limit_every == 0:
+      raise RateLimitExceededError("rate limit exceeded for request {}".format(count), "RATE_LIMIT_EXCEEDED",
+        "TRANSACTIONS_LIMIT")
+    if failing:
+      raise PlaidError("internal error for request {}".format(count), "API_ERROR", "INTERNAL_SERVER_ERROR")
+    if method == "Accounts.get":
+      return self.get_accounts(*args, **kwargs)
+    if method == "Transactions.get":
+      return self.get_transactions(*args, **kwargs)
+    if method == "Institutions.search":
+      return self.search_institutions(*args, **kwargs)
+    raise PlaidError("{} is not supported".format(method), "INVALID_REQUEST", "UNKNOWN_FIELDS")
+
+  def account_ids(self, access_token):
+    return ["{}-acc{}".format(access_token, i) for i in range(self.accounts)]
+
+  def get_accounts(self, access_token):
+    accounts = []
+    for (i, accountID) in enumerate(self.account_ids(access_token)):
+      (name, accountType, subType) = ACCOUNT_TYPES[i % len(ACCOUNT_TYPES)]
+      rnd = random.Random("{}:{}".format(self.seed, accountID))
+      accounts.append({"account_id": accountID, "mask": "{:04d}".format(rnd.randrange(10000)), "name": name,
+        "official_name": "{} {}".format(name, accountID), "type": accountType, "subtype": subType,
+        "balances": {"current": round(rnd.uniform(0, 20000), 2), "available": None}})
+    return {"accounts": accounts, "item": {"item_id": "item-" + access_token}}
+
+  def day_transactions(self, access_token, accountID, day, pendingFrom):
+    # Same seed, account and day always give the same transactions
+    rnd = random.Random("{}:{}:{}".format(self.seed, accountID, day.isoformat()))
+    txns = []
+    for n in range(rnd.randint(0, 2 * self.per_day)):
+      (category, merchants, median) = CATEGORIES[rnd.randrange(len(CATEGORIES))]
+      cents = int(median * rnd.lognormvariate(0, 0.6))
+      txns.append({"transaction_id": "{}-{}-{}".format(accountID, day.strftime("%Y%m%d"), n),
+        "account_id": accountID, "category": list(category),
+        "name": "{} #{}".format(rnd.choice(merchants), rnd.randrange(1000, 9999)),
+        "amount": cents / 100.0, "date": day.isoformat(), "pending": day >= pendingFrom})
+    return txns
+
+  def window(self, access_token, start_date, end_date):
+    key = (access_token, start_date, end_date)
+    txns = self.windows.get(key)
+    if txns is None:
+      today = self.today or date.today()
+      pendingFrom = today - timedelta(self.pending_days - 1) if self.pending_days else today + timedelta(1)
+      (start, end) = (date.fromisoformat(start_date), min(date.fromisoformat(end_date), today))
+      txns = []
+      day = end
+      while day >= start:
+        for accountID in self.account_ids(access_token):
+          txns.extend(self.day_transactions(access_token, accountID, day, pendingFrom))
+        day -= timedelta(1)
+      if len(self.windows) >= 64:
+        self.windows = {}
+      self.windows[key] = txns
+    return txns
+
+  def get_transactions(self, access_token, start_date, end_date, count=100, offset=0):
+    # Newest first, paged by count/offset like plaid
+    if count > self.max_page_size:
+      raise PlaidError("count must be at most {}".format(self.max_page_size), "INVALID_REQUEST", "INVALID_FIELD")
+    txns = self.window(access_token, start_date, end_date)
+    return {"accounts": self.get_accounts(access_token)["accounts"], "total_transactions": len(txns),
+      "transactions": txns[offset:offset + count]}
+
+  def search_institutions(self, query, products=None):
+    found = []
+    for i in range(self.institutions):
+      name = INSTITUTION_NAMES[i % len(INSTITUTION_NAMES)]
+      if i >= len(INSTITUTION_NAMES):
+        name = "{} {}".format(name, i // len(INSTITUTION_NAMES) + 1)
+      if query.lower() in name.lower():
+        found.append({"institution_id": "ins_{}".format(i + 1), "name": name})
+    return {"institutions": found, "total": len(found)}
+
+def request_key(method, args, kwargs):
+  # Transactions are matched on token and page but not the dates, which move with today,
+  # so a recording replays on any day
+  if method == "Transactions.get":
+    return json.dumps([method, args[0], kwargs.get("count", 100), kwargs.get("offset", 0)])
+  return json.dumps([method, list(args), kwargs], sort_keys=True)
+
+class RecordingClient:
+  # Forwards to client and appends every request with its response (or plaid error) to a
+  # JSON lines file that ReplayClient can serve
+
+  def __init__(self, client, path):
+    self.client = client
+    self.path = path
+    self.lock = threading.Lock()
+    self.Accounts = Endpoint(self, "Accounts")
+    self.Transactions = Endpoint(self, "Transactions")
+    self.Institutions = Endpoint(self, "Institutions")
+
+  def call(self, method, *args, **kwargs):
+    (group, name) = method.split(".")
+    record = {"key": request_key(method, args, kwargs)}
+    try:
+      response = getattr(getattr(self.client, group), name)(*args, **kwargs)
+      record["response"] = response
+      return response
+    except Exception as e:
+      if not hasattr(e, "code"):
+        raise
+      record["error"] = {"message": str(e), "type": getattr(e, "type", None), "code": e.code}
+      raise
+    finally:
+      if len(record) > 1:
+        with self.lock:
+          with open(self.path, "a", encoding="utf8") as f:
+            f.write(json.dumps(record) + "\n")
+
+class ReplayClient:
+  # Serves a RecordingClient file. A request recorded more than once gets its recordings in
+  # turn (so a rate limit followed by a successful retry replays the same way), repeating the
+  # last one after that. Unrecorded requests fail with a PlaidError.
+
+  def __init__(self, path, latency=0.0, sleep=time.sleep):
+    self.latency = latency
+    self.sleep = sleep
+    self.lock = threading.Lock()
+    self.recordings = {}   # key -> [records, next index]
+    with open(path, encoding="utf8") as f:
+      for line in f:
+        if line.strip():
+          record = json.loads(line)
+          self.recordings.setdefault(record["key"], [[], 0])[0].append(record)
+    self.Accounts = Endpoint(self, "Accounts")
+    self.Transactions = Endpoint(self, "Transactions")
+    self.Institutions = Endpoint(self, "Institutions")
+
+  def call(self, method, *args, **kwargs):
+    if self.latency:
+      self.sleep(self.latency)
+    key = request_key(method, args, kwargs)
+    with self.lock:
+      entry = self.recordings.get(key)
+      if entry is None:
+        raise PlaidError("No recording of {}".format(key), "INVALID_REQUEST", "NOT_RECORDED")
+      (records, index) = entry
+      record = records[min(index, len(records) - 1)]
+      entry[1] = index + 1
+    if "error" in record:
+      raise to_error(record["error"])
+    return record["response"]
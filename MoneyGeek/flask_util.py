@@ -1,11 +1,265 @@
+import os
+import queue
+import threading
+
+import click
 from flask import current_app, g
+from flask.cli import with_appcontext
 from . import dao
+from .categorise import Categoriser, check_pattern
+from .export import FORMATS
+from .importer import DEFAULT_DATE_FORMATS, FileImporter, guess_delimiter, parse_columns
+
+class ConnectionPool:
+  # Per process pool of DataAccessors. Each one is only used by a single request at a time
+  # but may be handed to a different thread next time, hence check_same_thread=False.
+
+  def __init__(self, db_file, size=8, pragmas=None, cached_statements=128, row_factory='row', stats=None,
+      directory=None):
+    self.db_file = db_file
+    self.directory = directory
+    self.row_factory = row_factory
+    self.stats = stats
+    self.size = size
+    self.pragmas = pragmas
+    self.cached_statements = cached_statements
+    self.idle = queue.LifoQueue()
+    self.pid = os.getpid()
+
+  def _check_pid(self):
+    # Connections must not be shared with a forked child, start afresh in the child
+    if self.pid != os.getpid():
+      self.idle = queue.LifoQueue()
+      self.pid = os.getpid()
+
+  def acquire(self):
+    self._check_pid()
+    try:
+      return self.idle.get_nowait()
+    except queue.Empty:
+      return dao.DataAccessor(self.db_file, pragmas=self.pragmas, check_same_thread=False,
+        cached_statements=self.cached_statements, row_factory=self.row_factory, stats=self.stats,
+        directory=self.directory)
+
+  def release(self, da):
+    self._check_pid()
+    # Never hand out a connection with a transaction left open by a failed request
+    if da.conn.in_transaction:
+      da.conn.rollback()
+    if self.idle.qsize() < self.size:
+      self.idle.put(da)
+    else:
+      da.close()
+
+  def close(self):
+    while True:
+      try:
+        self.idle.get_nowait().close()
+      except queue.Empty:
+        break
+
+_extensions_lock = threading.Lock()
+
+def get_pool(shard=None):
+  # The pool of the database, or of one of its shards (see dao.DIRECTORY_TABLES)
+  pool = current_app.extensions.get('moneygeek_pool')
+  if pool is None:
+    with _extensions_lock:
+      pool = current_app.extensions.get('moneygeek_pool')
+      if pool is None:
+        config = current_app.config
+        stats = None
+        if config['SQL_STATS']:
+          stats = dao.QueryStats(config['SQL_SLOW_MS'], current_app.logger.warning)
+        pool = ConnectionPool(config['DATABASE'], config['SQLITE_POOL_SIZE'], config['SQLITE_PRAGMAS'],
+          config['SQLITE_CACHED_STATEMENTS'], config['SQLITE_ROW_FACTORY'], stats)
+        current_app.extensions['moneygeek_pool'] = pool
+  if shard is None:
+    return pool
+  shards = current_app.extensions.get('moneygeek_shard_pools')
+  if shards is None:
+    with _extensions_lock:
+      shards = current_app.extensions.get('moneygeek_shard_pools')
+      if shards is None:
+        config = current_app.config
+        shards = [ConnectionPool(dao.shard_file(config['DATABASE'], n), config['SQLITE_POOL_SIZE'],
+          config['SQLITE_PRAGMAS'], config['SQLITE_CACHED_STATEMENTS'], config['SQLITE_ROW_FACTORY'], pool.stats,
+          config['DATABASE']) for n in range(config['SQLITE_SHARDS'])]
+        current_app.extensions['moneygeek_shard_pools'] = shards
+  return shards[shard]
+
+def close_pools():
+  # Closes the idle connections of every pool
+  get_pool().close()
+  for pool in current_app.extensions.get('moneygeek_shard_pools') or []:
+    pool.close()
+
+def get_sql_stats():
+  # The process wide QueryStats, None unless SQL_STATS is set
+  return get_pool().stats
+
+def get_summary_cache():
+  # Per process cache of account summaries, the backend is pluggable through SUMMARY_CACHE_BACKEND
+  cache = current_app.extensions.get('moneygeek_summary_cache')
+  if cache is None:
+    with _extensions_lock:
+      cache = current_app.extensions.get('moneygeek_summary_cache')
+      if cache is None:
+        cache = current_app.config['SUMMARY_CACHE_BACKEND'](current_app)
+        current_app.extensions['moneygeek_summary_cache'] = cache
+  return cache
+
+def get_shard(userID=None):
+  # The user's shard (the logged in user's by default), None for the directory database or
+  # when SQLITE_SHARDS is off
+  shards = current_app.config['SQLITE_SHARDS']
+  if not shards:
+    return None
+  if userID is None and g.get('user'):
+    userID = g.user['userID']
+  if userID is None:
+    return None
+  return dao.shard_for(userID, shards)
+
+def acquire_da(shard):
+  das = g.setdefault('das', {})
+  if shard not in das:
+    das[shard] = get_pool(shard).acquire()
+  return das[shard]
+
+def get_da(userID=None):
+  # The request's connection to the user's shard, see get_shard. Users, institutions, categories
+  # and mappings can be read and written through any of them.
+  return acquire_da(get_shard(userID))
+
+def get_shard_das():
+  # A connection to every shard, for commands working on all users' data. Just get_da() when unsharded
+  shards = current_app.config['SQLITE_SHARDS']
+  if not shards:
+    return [get_da()]
+  return [acquire_da(shard) for shard in range(shards)]
+
+def destroy_da(exception=None):
+  # Registered as an app context teardown, returns the request's connections to their pools
+  for (shard, da) in g.pop('das', {}).items():
+    get_pool(shard).release(da)
+
+@click.command('migrate-db')
+@click.option('--init', is_flag=True, help='Recreate the baseline schema and categories first (drops all data!)')
+@with_appcontext
+def migrate_db_command(init):
+  da = get_da()
+  config = current_app.config
+  schema_dir = config['SCHEMA_DIR']
+  if init:
+    da.initialise_db(os.path.join(schema_dir, 'schema.sql'))
+    da.initialise_db(os.path.join(schema_dir, 'categories.sql'))
+  applied = da.migrate(os.path.join(schema_dir, 'migrations'))
+  click.echo('Applied migrations: {} (schema version {})'.format(applied, da.get_schema_version()))
+  # Shards are set up and migrated without the directory attached
+  for shard in range(config['SQLITE_SHARDS']):
+    shardDA = dao.DataAccessor(dao.shard_file(config['DATABASE'], shard), pragmas=config['SQLITE_PRAGMAS'])
+    try:
+      if init:
+        shardDA.initialise_db(os.path.join(schema_dir, 'schema.sql'))
+      applied = shardDA.migrate(os.path.join(schema_dir, 'migrations'))
+      if init:
+        shardDA.drop_directory_tables()
+      click.echo('Shard {}: applied migrations: {} (schema version {})'.format(shard, applied,
+        shardDA.get_schema_version()))
+    finally:
+      shardDA.close()
+
+@click.command('rebuild-rollup')
+@with_appcontext
+def rebuild_rollup_command():
+  for da in get_shard_das():
+    da.rebuild_rollup()
+  click.echo('Rebuilt txn_rollup')
+
+@click.command('add-mapping')
+@click.argument('pattern')
+@click.argument('category')
+@with_appcontext
+def add_mapping_command(pattern, category):
+  da = get_da()
+  info = da.get_category_info(category)
+  if not info:
+    raise click.BadParameter('Unknown category: {}'.format(category))
+  # Checked here rather than in the DAO: whether patterns combine is the categoriser's business
+  try:
+    check_pattern(pattern)
+  except ValueError as e:
+    raise click.BadParameter('Invalid pattern: {} ({})'.format(pattern, e))
+  da.add_mapping(pattern, info['categoryID'])
+  click.echo('Mapped {} -> {}'.format(pattern, info['name']))
+
+@click.command('backfill-categories')
+@click.option('--batch-size', default=1000, help='Transactions categorised per committed UPDATE batch')
+@with_appcontext
+def backfill_categories_command(batch_size):
+  (examined, categorised) = (0, 0)
+  for da in get_shard_das():
+    counts = Categoriser(da).backfill(batch_size)
+    examined += counts[0]
+    categorised += counts[1]
+  click.echo('Categorised {} of {} uncategorised transactions'.format(categorised, examined))
+
+@click.command('export-transactions')
+@click.argument('username')
+@click.option('--account', 'accountID', help='Only this accountID')
+@click.option('--start', help='First date to include (YYYY-MM-DD)')
+@click.option('--end', help='Date to stop before (YYYY-MM-DD)')
+@click.option('--format', 'fmt', type=click.Choice(sorted(FORMATS)), default='csv')
+@click.option('--output', type=click.File('w'), default='-', help='File to write (default: stdout)')
+@with_appcontext
+def export_transactions_command(username, accountID, start, end, fmt, output):
+  user_info = get_da().get_user_info(username)
+  if not user_info:
+    raise click.BadParameter('Unknown user: {}'.format(username))
+  da = get_da(user_info['userID'])
+  lines = FORMATS[fmt][0]
+  for line in lines(da.iter_transactions(user_info['userID'], accountID, start, end)):
+    output.write(line)
 
-def get_da():
-  if 'da' not in g:
-    g.da = dao.DataAccessor(current_app.config['DATABASE'])
-  return g.da
+@click.command('import-file')
+@click.argument('username')
+@click.argument('account_id')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--columns', help='Column mapping, e.g. "date=0,name=2,amount=3,category=4" or header names '
+  + '(with --header). Defaults to the legacy manual upload TSV layout')
+@click.option('--date-format', 'date_formats', multiple=True, help='strptime format of the date column, '
+  + 'may be repeated (default: %m/%d/%y)')
+@click.option('--delimiter', help='Field delimiter (default: tab for .tsv/.txt, comma otherwise)')
+@click.option('--header', is_flag=True, help='The first line is a header row')
+@click.option('--batch-size', default=5000, help='Rows inserted per committed transaction')
+@click.option('--id-prefix', help='Prefix of generated transaction IDs (default: the path)')
+@click.option('--categorise/--no-categorise', default=True, help='Apply category mappings to uncategorised rows')
+@with_appcontext
+def import_file_command(username, account_id, path, columns, date_formats, delimiter, header, batch_size,
+    id_prefix, categorise):
+  user_info = get_da().get_user_info(username)
+  if not user_info:
+    raise click.BadParameter('Unknown user: {}'.format(username))
+  da = get_da(user_info['userID'])
+  if not da.get_account_connection(user_info['userID'], account_id):
+    raise click.BadParameter('Unknown account for {}: {}'.format(username, account_id))
+  try:
+    columns = parse_columns(columns) if columns else None
+  except ValueError as e:
+    raise click.BadParameter(str(e))
+  importer = FileImporter(da, account_id, columns, date_formats or DEFAULT_DATE_FORMATS,
+    delimiter or guess_delimiter(path), header, batch_size, Categoriser(da) if categorise else None, click.echo)
+  try:
+    importer.import_file(path, id_prefix)
+  except ValueError as e:
+    raise click.ClickException(str(e))
 
-def destroy_da():
-  if 'da' in g:
-    del g['da']
+def init_app(app):
+  app.teardown_appcontext(destroy_da)
+  app.cli.add_command(migrate_db_command)
+  app.cli.add_command(rebuild_rollup_command)
+  app.cli.add_command(add_mapping_command)
+  app.cli.add_command(backfill_categories_command)
+  app.cli.add_command(export_transactions_command)
+  app.cli.add_command(import_file_command)
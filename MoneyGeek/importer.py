@@ -0,0 +1,166 @@
+import csv
+import itertools
+import os
+import time
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+# Streaming import of bank export files (CSV/TSV) into txn, one committed batch at a time.
+# No package relative imports, the manual_update script imports this as a sibling module.
+
+# Columns of the legacy manual upload TSV: date, (unused), name, amount, category
+DEFAULT_COLUMNS = {'date': 0, 'name': 2, 'amount': 3, 'category': 4}
+REQUIRED_COLUMNS = ('date', 'name', 'amount')
+KNOWN_COLUMNS = ('date', 'name', 'amount', 'category', 'subCategory', 'id')
+DEFAULT_DATE_FORMATS = ('%m/%d/%y', )
+
+def parse_columns(spec):
+  # "date=0,name=2,amount=3" (0 based positions) or "date=Posted Date,name=Description,..." (header
+  # names, needs a header row) -> {column: position or name}
+  columns = {}
+  for part in spec.split(','):
+    (column, sep, source) = part.partition('=')
+    column = column.strip()
+    source = source.strip()
+    if not sep or not source or column not in KNOWN_COLUMNS:
+      raise ValueError("Invalid column mapping: {}".format(part))
+    columns[column] = int(source) if source.isdigit() else source
+  missing = [c for c in REQUIRED_COLUMNS if c not in columns]
+  if missing:
+    raise ValueError("Column mapping is missing: {}".format(", ".join(missing)))
+  return columns
+
+def guess_delimiter(filename):
+  return '\t' if os.path.splitext(filename)[1].lower() in ('.tsv', '.tab', '.txt') else ','
+
+def parse_amount(value):
+  # Bank exports write amounts as "1,234.50", "$12.00" or "(12.00)" for debits
+  value = value.strip().replace(',', '').replace('$', '')
+  if value.startswith('(') and value.endswith(')'):
+    value = '-' + value[1:-1]
+  amount = Decimal(value)
+  if not amount.is_finite():
+    raise ValueError("Invalid amount: {}".format(value))
+  return amount
+
+class FileImporter:
+  # Parses an export file into add_transactions rows and inserts them batch_size rows per
+  # transaction. Categories are resolved against the preloaded category index (by name), rows
+  # without one go through the Categoriser when given. Transaction IDs are <idPrefix>@<line>,
+  # as the old manual upload made them, so re-importing the same file skips the duplicates.
+
+  def __init__(self, da, accountID, columns=None, date_formats=DEFAULT_DATE_FORMATS, delimiter='\t',
+      has_header=False, batch_size=5000, categoriser=None, report=print):
+    self.da = da
+    self.accountID = accountID
+    self.columns = dict(columns or DEFAULT_COLUMNS)
+    self.date_formats = list(date_formats)
+    self.delimiter = delimiter
+    self.has_header = has_header
+    self.batch_size = batch_size
+    self.categoriser = categoriser
+    self.report = report
+    self.dates = {}              # Raw date string -> ISO date, exports repeat the same few dates
+    self.unknownCategories = set()
+    self.errors = 0
+
+  def resolve_columns(self, header):
+    # Column name -> position, header names are matched case insensitively
+    positions = {}
+    names = [h.strip().upper() for h in header] if header else []
+    for (column, source) in self.columns.items():
+      if isinstance(source, int):
+        positions[column] = source
+      elif source.upper() in names:
+        positions[column] = names.index(source.upper())
+      else:
+        raise ValueError("Column not found in header: {}".format(source))
+    return positions
+
+  def parse_date(self, value):
+    date = self.dates.get(value)
+    if date is None:
+      for (i, fmt) in enumerate(self.date_formats):
+        try:
+          date = datetime.strptime(value.strip(), fmt).date().isoformat()
+        except ValueError:
+          continue
+        # The format that matched is tried first from now on
+        if i:
+          self.date_formats.insert(0, self.date_formats.pop(i))
+        break
+      else:
+        raise ValueError("Unrecognised date: {}".format(value))
+      self.dates[value] = date
+    return date
+
+  def parse(self, lines, idPrefix):
+    # Generator of add_transactions rows, bad lines are reported and skipped
+    categories = self.da.get_category_index().byName
+    reader = csv.reader(lines, delimiter=self.delimiter)
+    header = next(reader, None) if self.has_header else None
+    positions = self.resolve_columns(header)
+    (date, name, amount) = (positions['date'], positions['name'], positions['amount'])
+    category = positions.get('category')
+    subCategory = positions.get('subCategory')
+    txnID = positions.get('id')
+    lineNumber = 1 if header is not None else 0
+    for fields in reader:
+      lineNumber += 1
+      if not fields:
+        continue
+      try:
+        row = (
+          fields[txnID] if txnID is not None else "{}@{}".format(idPrefix, lineNumber),
+          self.accountID,
+          "ManualUpload",
+          fields[subCategory] or None if subCategory is not None else None,
+          fields[name],
+          parse_amount(fields[amount]),
+          self.parse_date(fields[date]),
+          self.category_id(categories, fields[category] if category is not None and category < len(fields) else None)
+        )
+      except (IndexError, ValueError, InvalidOperation) as e:
+        self.errors += 1
+        self.report("WARN: Skipping line {}: {}".format(lineNumber, e))
+        continue
+      yield row
+
+  def category_id(self, categories, name):
+    if not name:
+      return None
+    info = categories.get(name.strip().upper())
+    if info is None:
+      if name not in self.unknownCategories:
+        self.unknownCategories.add(name)
+        self.report("WARN: Unrecognised category: {}, inserting categoryID=None instead".format(name))
+      return None
+    return info['categoryID']
+
+  def run(self, lines, idPrefix):
+    # Imports every line, returns (rows, inserted, duplicates)
+    rows = self.parse(lines, idPrefix)
+    if self.categoriser is not None:
+      rows = self.categoriser.categorise(rows)
+    total = inserted = duplicates = 0
+    started = time.perf_counter()
+    for batchNumber in itertools.count(1):
+      batchStarted = time.perf_counter()
+      batch = list(itertools.islice(rows, self.batch_size))
+      if not batch:
+        break
+      (batchInserted, batchDuplicates) = self.da.add_transactions(batch)
+      total += len(batch)
+      inserted += batchInserted
+      duplicates += batchDuplicates
+      elapsed = time.perf_counter() - batchStarted
+      self.report("INFO: Batch {}: {} rows ({} new) in {:.2f}s, {:.0f} rows/s".format(
+        batchNumber, len(batch), batchInserted, elapsed, len(batch) / elapsed if elapsed else 0))
+    elapsed = time.perf_counter() - started
+    self.report("INFO: Imported {} rows ({} new, {} duplicates, {} bad) in {:.2f}s, {:.0f} rows/s".format(
+      total, inserted, duplicates, self.errors, elapsed, total / elapsed if elapsed else 0))
+    return (total, inserted, duplicates)
+
+  def import_file(self, filename, idPrefix=None):
+    with open(filename, newline='') as f:
+      return self.run(f, idPrefix or filename)
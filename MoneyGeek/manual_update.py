@@ -1,24 +1,32 @@
-import os
+import sys
 import time
 import json
-import sqlite3
-from dao import DataAccessor as DA
+import argparse
+from dao import DataAccessor as DA, shard_file, shard_for
 import getpass
 import plaid_dao as PDA
+from categorise import Categoriser
+from importer import FileImporter
 
 class ManualUpdater:
 
-  PLAID_CLIENT_ID = os.getenv('PLAID_CLIENT_ID')
-  PLAID_SECRET = os.getenv('PLAID_SECRET')
-  PLAID_PUBLIC_KEY = os.getenv('PLAID_PUBLIC_KEY')
-  PLAID_ENV = os.getenv('PLAID_ENV', 'sandbox')
-
-  def __init__(self, db_file):
+  def __init__(self, db_file, client=None, shards=0):
+    # With shards (the app's SQLITE_SHARDS) registration and log in use the directory, db_file,
+    # everything after log in runs on the user's shard
+    self.db_file = db_file
+    self.shards = shards
     self.da = DA(db_file)
-    self.client = PDA.get_client(self.PLAID_CLIENT_ID, self.PLAID_PUBLIC_KEY, self.PLAID_SECRET, self.PLAID_ENV)
+    self.categoriser = Categoriser(self.da)
+    # PLAID_ENV=fake (or replay) works without credentials, see plaid_dao.get_client_from_env
+    self.client = client or PDA.get_client_from_env()
 
   def set_user(self, username):
     self.username = username
+    if self.shards:
+      userID = self.da.get_user_info(username)["userID"]
+      self.da.close()
+      self.da = DA(shard_file(self.db_file, shard_for(userID, self.shards)), directory=self.db_file)
+      self.categoriser = Categoriser(self.da)
     self.userConn = self.get_user_and_connection_info()
     print("INFO: Successfully logged in user: {}".format(self.username))
 
@@ -115,31 +123,21 @@ class ManualUpdater:
       access_code = conn_info["accessCode"]
       das = int(raw_input("DaysAgoStart?: "))
       dae = int(raw_input("DaysAgoEnd? (must be less than {}): ".format(das)))  
-      txns = PDA.get_transactions(self.client, access_code, das, dae)
-      num_txns = txns["total_transactions"]
-      print("INFO: Got {} transactions".format(num_txns))
-      transactions = txns["transactions"]
       insert = raw_input("Insert into database or Print? (Y/N/P): ")
+      # Transactions are streamed page by page rather than held in memory
+      txns = PDA.iter_transactions(self.client, access_code, das, dae)
 
       if insert == "Y":
-        for txn in transactions:
-          try:
-            category = txn["category"]
-            cat = category[0]
-            if len(category) > 1:
-              subcat = category[1]
-            else:
-              subcat = None
-            self.da.add_transaction(txn["transaction_id"], txn["account_id"], cat, subcat,
-              txn["name"], txn["amount"], txn["date"], None)
-          except sqlite3.IntegrityError:
-            print("INFO: Skipping duplicate transaction")
+        (inserted, duplicates) = self.da.add_transactions(
+          self.categoriser.categorise(PDA.to_row(txn) for txn in txns))
+        print("INFO: Got {} transactions".format(inserted + duplicates))
+        print("INFO: Inserted {} transactions, skipped {} duplicates".format(inserted, duplicates))
       elif insert == "P":
-        for txn in transactions:
+        for txn in txns:
           print(txn)
           time.sleep(5)
       elif insert == "N":
-        for txn in transactions:
+        for txn in txns:
           print(json.dumps(txn))
       else:
         print("INFO: Not inserting.")
@@ -149,38 +147,11 @@ class ManualUpdater:
   def upload_from_file(self):
     filename = raw_input("Enter filename with path: ")
     if self.userConn:
-      user_info = self.userConn["user_info"]
-      conn_info = self.userConn["conn_info"]
-      access_code = conn_info["accessCode"]
+      accountID = self.choose_account()
+      # Same streaming pipeline as `flask import-file`, with the legacy TSV layout
+      importer = FileImporter(self.da, accountID, categoriser=self.categoriser)
       try:
-        f = open(filename, "r")
-        accountID = self.choose_account()
-        counter = 0
-        success = 0        
-        for line in f:
-          counter += 1
-          line = line.strip()
-          fields = line.split("\t")
-          catID = None # Some rows aren't categorised
-          if len(fields) > 4:
-            userCategory = fields[4]
-            categoryInfo = self.da.get_category_info(userCategory)
-            if categoryInfo:
-              catID = categoryInfo["categoryID"]
-            else:
-              print("WARN: Unrecognised category: {}, inserting categorID=None instead".format(userCategory))
-              catID = None
-          else:
-            print("DODGY ROW!: {}".format(fields))
-          date = self.da.convertDateToSQLDate(fields[0])
-          txnID = filename + "@" + str(counter)
-          try:
-            self.da.add_transaction(txnID, accountID, "ManualUpload", None, fields[2], fields[3], date, catID)
-            success += 1
-          except sqlite3.IntegrityError:
-            print("INFO: Skipping duplicate transaction")
-        print("Uploaded {} out of {} transactions".format(success, counter))
-        f.close()
+        importer.import_file(filename)
       except:
         print("ERROR: Could not process file")
         raise
@@ -254,11 +225,18 @@ class ManualUpdater:
     ("add connection", add_connection)
   ]
   
+def parse_args(argv):
+  parser = argparse.ArgumentParser(description="Interactive user, connection and transaction maintenance")
+  parser.add_argument("db_file", nargs="?", default="instance/moneygeek.sqlite3")
+  parser.add_argument("--shards", type=int, default=0,
+    help="Number of shards db_file is split into (the app's SQLITE_SHARDS) (default: 0)")
+  return parser.parse_args(argv)
+
 def main():
-  mu = ManualUpdater("instance/moneygeek.sqlite3")
+  args = parse_args(sys.argv[1:])
+  mu = ManualUpdater(args.db_file, shards=args.shards)
 
   exit = False
-  da = DA("instance/moneygeek.sqlite3")
   while not exit:
     print("-------------------------")
     mu.printTupleList(mu.topMenu)
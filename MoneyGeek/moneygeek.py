@@ -2,13 +2,41 @@ import os
 
 from flask import Flask
 
+from . import cache, dao
+
 def create_app(test_config=None):
   # create and configure the app
   app = Flask(__name__, instance_relative_config=True)
   path = app.instance_path
   app.config.from_mapping(
     SECRET_KEY='dev',
-    DATABASE=os.path.join(path, 'moneygeek.sqlite3')
+    DATABASE=os.path.join(path, 'moneygeek.sqlite3'),
+    SCHEMA_DIR=os.path.join(os.path.dirname(app.root_path), 'db'),
+    # Idle connections kept per process, statement cache per connection and PRAGMAs run on connect
+    SQLITE_POOL_SIZE=8,
+    SQLITE_CACHED_STATEMENTS=128,
+    SQLITE_PRAGMAS=dict(dao.TUNED_PRAGMAS),
+    # 'dict' rows go straight to templates and caches, 'row' gives sqlite3.Row
+    SQLITE_ROW_FACTORY='dict',
+    # Spread users over this many shard files next to DATABASE (0 keeps everything in DATABASE).
+    # Set before `flask migrate-db --init`, there is no moving existing data between layouts
+    SQLITE_SHARDS=0,
+    # Server side cache of the per user account summary: factory taking the app, entry limit and TTL
+    SUMMARY_CACHE_BACKEND=cache.lru_backend,
+    SUMMARY_CACHE_SIZE=1024,
+    SUMMARY_CACHE_TTL=300,
+    # Transactions per page of view_account and the transactions API (which may ask for up to the max)
+    TRANSACTION_PAGE_SIZE=100,
+    TRANSACTION_PAGE_MAX=500,
+    # Most years the annual summary covers at once, longer start_year/end_year ranges are cut short
+    SUMMARY_MAX_YEARS=10,
+    # Per statement timings (served at /debug/sql) and a log of statements taking SQL_SLOW_MS or more
+    SQL_STATS=False,
+    SQL_SLOW_MS=None,
+    # Allow DELETE /debug/sql (resets the stats every user sees) outside debug mode
+    SQL_STATS_RESET=False,
+    # Seconds the user snapshot in the session is trusted before the user row is read again
+    USER_SNAPSHOT_TTL=300
   )
 
   if test_config is None:
@@ -24,10 +52,16 @@ def create_app(test_config=None):
   except OSError:
     pass
 
+  from . import flask_util
+  flask_util.init_app(app)
+
   from . import auth
   app.register_blueprint(auth.bp)
 
   from . import summary
   app.register_blueprint(summary.bp)
 
+  from . import debug
+  app.register_blueprint(debug.bp)
+
   return app
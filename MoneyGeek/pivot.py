@@ -0,0 +1,91 @@
+import calendar
+from array import array
+from itertools import accumulate, chain
+
+def month_span(startYear, endYear):
+  # Every (year, month) from January of startYear to December of endYear
+  return [(year, month) for year in range(int(startYear), int(endYear) + 1) for month in range(1, 13)]
+
+class Pivot:
+  # Category x month matrix of integer cents, one row per category and one column per month of
+  # the period. Cells live in a single flat row major array('q') so totals, cumulative sums and
+  # budget variance are computed with whole row/column slices (sum, accumulate) rather than
+  # per cell Python loops.
+
+  def __init__(self, categories, months, budgets=None):
+    # categories: list of (categoryID, name), months: list of (year, month),
+    # budgets: categoryID -> monthly budget in cents
+    self.categories = list(categories)
+    self.months = list(months)
+    self.width = len(self.months)
+    self.monthIndex = dict((m, i) for (i, m) in enumerate(self.months))
+    self.categoryIndex = dict((c[0], i) for (i, c) in enumerate(self.categories))
+    self.cells = array('q', bytes(8 * len(self.categories) * self.width))
+    budgets = budgets or {}
+    self.budgets = array('q', [budgets.get(c[0], 0) for c in self.categories])
+
+  @classmethod
+  def from_rows(cls, rows, months, budgets=None):
+    # rows: aggregated (categoryID, name, year, month, amountCents) rows, e.g. get_period_summary
+    categories = []
+    seen = set()
+    for row in rows:
+      if row['categoryID'] not in seen:
+        seen.add(row['categoryID'])
+        categories.append((row['categoryID'], row['name']))
+    pivot = cls(categories, months, budgets)
+    for row in rows:
+      pivot.add(row['categoryID'], int(row['year']), int(row['month']), row['amountCents'])
+    return pivot
+
+  def add(self, categoryID, year, month, cents):
+    col = self.monthIndex.get((year, month))
+    if col is not None:
+      self.cells[self.categoryIndex[categoryID] * self.width + col] += cents
+
+  def row(self, i):
+    return self.cells[i * self.width:(i + 1) * self.width]
+
+  def column(self, j):
+    return self.cells[j::self.width]
+
+  def totals(self):
+    # Per category total over the period
+    return array('q', (sum(self.row(i)) for i in range(len(self.categories))))
+
+  def month_totals(self):
+    # Per month total over all categories
+    return array('q', (sum(self.column(j)) for j in range(self.width)))
+
+  def cumulative(self):
+    # Running totals along each row, as a new flat array of the same shape
+    return array('q', chain.from_iterable(accumulate(self.row(i)) for i in range(len(self.categories))))
+
+  def budget_totals(self):
+    return array('q', (b * self.width for b in self.budgets))
+
+  def variance(self):
+    # Budget left over (negative when over budget) per category for the period
+    return array('q', (b - t for (b, t) in zip(self.budget_totals(), self.totals())))
+
+  def labels(self):
+    # Short month names, with the year when the period spans more than one
+    multiYear = len(set(m[0] for m in self.months)) > 1
+    return [calendar.month_abbr[m] + (" {}".format(y) if multiYear else "") for (y, m) in self.months]
+
+  def display_rows(self, cumulative=False):
+    # Rows for the templates, amounts converted from cents
+    cells = self.cumulative() if cumulative else self.cells
+    totals = self.totals()
+    variance = self.variance()
+    for (i, (categoryID, name)) in enumerate(self.categories):
+      values = cells[i * self.width:(i + 1) * self.width]
+      yield {
+        'categoryID': categoryID,
+        'name': name,
+        'values': [v / 100.0 for v in values],
+        'total': totals[i] / 100.0,
+        'average': totals[i] / 100.0 / self.width,
+        'budget': self.budgets[i] / 100.0,
+        'variance': variance[i] / 100.0
+      }
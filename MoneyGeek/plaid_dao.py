@@ -1,20 +1,91 @@
-import plaid
+import os
 import datetime
 
+# Largest page plaid will return from Transactions.get
+MAX_PAGE_SIZE = 500
+
+# PLAID_ENV values served locally by fake_plaid rather than plaid
+LOCAL_ENVIRONMENTS = ('fake', 'replay')
+
 def get_client(client_id, public_key, secret, environment):
+  # plaid is only needed for the real environments
+  import plaid
   client = plaid.Client(client_id=client_id, secret=secret,
     public_key=public_key, environment=environment)
   return client
 
+def get_client_from_env(environ=os.environ):
+  # Client for the PLAID_* environment variables, None when the real environments are missing
+  # credentials. PLAID_ENV=fake serves generated data (sized by PLAID_FAKE_*), PLAID_ENV=replay
+  # serves the PLAID_REPLAY file and PLAID_RECORD=FILE records whatever client is in use.
+  environment = environ.get('PLAID_ENV', 'sandbox')
+  if environment in LOCAL_ENVIRONMENTS or environ.get('PLAID_RECORD'):
+    # The scripts import plaid_dao as a sibling module, the tests and benchmarks from the package
+    if __package__:
+      from . import fake_plaid
+    else:
+      import fake_plaid
+  if environment == 'fake':
+    client = fake_plaid.FakeClient.from_env(environ)
+  elif environment == 'replay':
+    client = fake_plaid.ReplayClient(environ['PLAID_REPLAY'], float(environ.get('PLAID_FAKE_LATENCY') or 0))
+  else:
+    credentials = [environ.get(name) for name in ('PLAID_CLIENT_ID', 'PLAID_PUBLIC_KEY', 'PLAID_SECRET')]
+    if None in credentials:
+      return None
+    client = get_client(*credentials, environment)
+  if environ.get('PLAID_RECORD'):
+    client = fake_plaid.RecordingClient(client, environ['PLAID_RECORD'])
+  return client
+
 def get_accounts(client, access_token):
   response = client.Accounts.get(access_token)
   accounts = response['accounts']
   return accounts
 
-def get_transactions(client, access_token, daysAgoStart, daysAgoEnd):
+def get_date_range(daysAgoStart, daysAgoEnd):
   if daysAgoStart < daysAgoEnd:
     raise Exception("Days ago start: {} cannot be less than days ago end: {}".format(daysAgoStart, daysAgoEnd))
   start_date = "{:%Y-%m-%d}".format(datetime.datetime.now() + datetime.timedelta(-daysAgoStart))
   end_date = "{:%Y-%m-%d}".format(datetime.datetime.now() + datetime.timedelta(-daysAgoEnd))
+  return (start_date, end_date)
+
+def get_transactions(client, access_token, daysAgoStart, daysAgoEnd):
+  # Single request, only returns the first page. Use iter_transactions to get everything
+  (start_date, end_date) = get_date_range(daysAgoStart, daysAgoEnd)
   response = client.Transactions.get(access_token, start_date, end_date)
   return response
+
+def iter_transaction_pages(client, access_token, daysAgoStart, daysAgoEnd, page_size=MAX_PAGE_SIZE,
+    offset=0, limiter=None):
+  # Generator of transaction lists, one per request, paging with count/offset until
+  # total_transactions is exhausted. limiter (if given) is acquired before every request.
+  (start_date, end_date) = get_date_range(daysAgoStart, daysAgoEnd)
+  page_size = min(page_size, MAX_PAGE_SIZE)
+  total = None
+  while total is None or offset < total:
+    if limiter:
+      limiter.acquire()
+    response = client.Transactions.get(access_token, start_date, end_date, count=page_size, offset=offset)
+    total = response["total_transactions"]
+    page = response["transactions"]
+    if not page:
+      break
+    offset += len(page)
+    yield page
+
+def iter_transactions(client, access_token, daysAgoStart, daysAgoEnd, page_size=MAX_PAGE_SIZE, limiter=None):
+  for page in iter_transaction_pages(client, access_token, daysAgoStart, daysAgoEnd, page_size, limiter=limiter):
+    for txn in page:
+      yield txn
+
+def to_row(txn, categoryID=None):
+  # Converts a plaid transaction into a row for DataAccessor.add_transactions
+  # plaid leaves category null (or empty) for some transactions, txn.category can't be
+  category = txn.get("category") or ["Uncategorised"]
+  cat = category[0]
+  if len(category) > 1:
+    subcat = category[1]
+  else:
+    subcat = None
+  return (txn["transaction_id"], txn["account_id"], cat, subcat, txn["name"], txn["amount"], txn["date"], categoryID)
@@ -1,72 +1,170 @@
 import sys
-import os
-from dao import DataAccessor as DA
-import plaid_dao as PDA
-import sqlite3
+import argparse
+import datetime
+import queue
 import time
+from concurrent.futures import ThreadPoolExecutor
+from dao import QueryStats, TUNED_PRAGMAS, open_shards, shard_for
+import plaid_dao as PDA
+from rate_limit import TokenBucket
+from categorise import Categoriser
 
-def main():
+def parse_args(argv):
+  parser = argparse.ArgumentParser(description="Pull transactions from plaid for every user connection")
+  parser.add_argument("db_file")
+  parser.add_argument("days_ago_start", type=int)
+  parser.add_argument("--workers", type=int, default=4,
+    help="Number of connections fetched concurrently (default: 4)")
+  parser.add_argument("--rate", type=float, default=2.0,
+    help="Maximum plaid requests per second across all workers (default: 2)")
+  parser.add_argument("--burst", type=int, default=1,
+    help="Number of requests allowed back to back before the rate applies (default: 1)")
+  parser.add_argument("--overlap", type=int, default=7,
+    help="Days re-fetched before the last seen transaction of an incremental sync (default: 7)")
+  parser.add_argument("--full", action="store_true",
+    help="Ignore the sync state and fetch the whole days_ago_start window (backfill)")
+  parser.add_argument("--shards", type=int, default=0,
+    help="Number of shards db_file is split into (the app's SQLITE_SHARDS, default: 0)")
+  parser.add_argument("--sql-stats", action="store_true",
+    help="Print per statement SQL timings at the end of the run")
+  parser.add_argument("--slow-ms", type=float,
+    help="Log statements taking at least this many milliseconds, with their query plan (implies --sql-stats)")
+  return parser.parse_args(argv)
 
-  PLAID_CLIENT_ID = os.getenv('PLAID_CLIENT_ID')
-  PLAID_SECRET = os.getenv('PLAID_SECRET')
-  PLAID_PUBLIC_KEY = os.getenv('PLAID_PUBLIC_KEY')
-  PLAID_ENV = os.getenv('PLAID_ENV', 'sandbox')
-  if PLAID_CLIENT_ID is None or PLAID_SECRET is None or PLAID_PUBLIC_KEY is None:
+def get_days_ago_start(syncState, days_ago_start, overlap, today):
+  # Connections that have synced before only need the delta since the later of the last seen
+  # transaction and the last sync, plus an overlap for late posting transactions
+  if syncState is None:
+    return days_ago_start
+  marks = [d for d in (syncState["lastTxnDate"], syncState["lastSyncDate"]) if d]
+  if not marks:
+    return days_ago_start
+  since = max(marks)
+  since = datetime.datetime.strptime(since, "%Y-%m-%d").date()
+  return max((today - since).days + overlap, 0)
+
+def get_plaid_client():
+  # Client for the PLAID_* environment variables (see plaid_dao.get_client_from_env), exits
+  # when they aren't set
+  client = PDA.get_client_from_env()
+  if client is None:
     print("ERROR: PLAID env variables are not set!")
     sys.exit(1)
+  return client
 
-  # read in sqlite3 file
-  if len(sys.argv) != 3:
-    print("Usage: {} db_file days_ago_start".format(sys.argv[0]))
-    sys.exit(1)
-  db_file = sys.argv[1]
-  days_ago_start = int(sys.argv[2])
+def new_stat(lastTxnDate):
+  return {"total": 0, "inserted": 0, "dup": 0, "pending": 0, "lastTxnDate": lastTxnDate}
+
+def store_page(da, categoriser, stat, page):
+  # Writes the settled transactions of a page from plaid, pending ones are picked up once they post
+  rows = list(categoriser.categorise(PDA.to_row(txn) for txn in page if not txn["pending"]))
+  (inserted, skipped_dup) = da.add_transactions(rows)
+  stat["total"] += len(page)
+  stat["inserted"] += inserted
+  stat["dup"] += skipped_dup
+  stat["pending"] += len(page) - len(rows)
+  for row in rows:
+    if stat["lastTxnDate"] is None or row[6] > stat["lastTxnDate"]:
+      stat["lastTxnDate"] = row[6]
+
+def format_stat(stat):
+  return "Total: {}, Inserted: {}, Skipped Duplicate: {}, Skipped Pending: {}".format(
+    stat["total"], stat["inserted"], stat["dup"], stat["pending"])
+
+def fetch_transactions(client, limiter, userConn, days_ago_start, days_ago_end, results, offset=0,
+    page_size=PDA.MAX_PAGE_SIZE):
+  # Runs on a worker thread, so must not touch the database. Pages are handed to the
+  # writer through the (bounded) results queue as they arrive.
+  try:
+    for page in PDA.iter_transaction_pages(client, userConn["accessCode"], days_ago_start, days_ago_end,
+        page_size, offset, limiter):
+      results.put(("page", userConn, page))
+    results.put(("done", userConn, None))
+  except Exception as e:
+    results.put(("error", userConn, e))
+
+def write_results(da, categoriser, results, stats, expected, today):
+  # Stores the pages handed over by the fetches of one database's connections until all
+  # expected of them have finished, the only thread writing to that database. A connection
+  # whose page can't be stored is failed, its remaining pages are drained and dropped so its
+  # fetch never blocks on the queue.
+  remaining = expected
+  failed = set()
+  while remaining > 0:
+    (kind, userConn, payload) = results.get()
+    connectionID = userConn["connectionID"]
+    institution = userConn["name"]
+    stat = stats[connectionID]
+    if kind != "page":
+      remaining -= 1
+    if connectionID in failed:
+      continue
+    try:
+      if kind == "page":
+        store_page(da, categoriser, stat, payload)
+      elif kind == "done":
+        # Only a complete fetch moves the high-water mark
+        da.update_sync_state(connectionID, today.isoformat(), stat["lastTxnDate"])
+        print("-> INFO: {} Summary: {}".format(institution, format_stat(stat)))
+      else:
+        print("ERROR: Could not get transactions for {}: {}".format(institution, payload))
+    except Exception as e:
+      failed.add(connectionID)
+      print("ERROR: Could not store transactions for {}: {}".format(institution, e))
+
+def main():
+
+  client = get_plaid_client()
+  args = parse_args(sys.argv[1:])
+  days_ago_start = args.days_ago_start
   days_ago_end = 0
   if days_ago_start <= days_ago_end:
     print("ERROR: days_ago_start ({}) must be greater than days_ago_end({})".format(days_ago_start, days_ago_end))
-  da = DA(db_file)
-
-  client = PDA.get_client(PLAID_CLIENT_ID, PLAID_PUBLIC_KEY, PLAID_SECRET, PLAID_ENV)
-
-  # For each user
-  userIds = da.get_all_userID()
-  for userRow in userIds:
-    print("INFO: Processing user: {}".format(userRow["username"]))
-    userConns = da.get_user_connections(userRow["userID"])
-    # For each userConn
-    for userConn in userConns:
-      institutionInfo = da.get_institution_info(userConn["institutionID"])
-      print("-> INFO: Processing institution: {}".format(institutionInfo["name"]))
-      access_code = userConn["accessCode"]
-      try:
-        txns = PDA.get_transactions(client, access_code, days_ago_start, days_ago_end)
-        num_txns = txns["total_transactions"]
-        print("-> INFO: Got {} transactions".format(num_txns, ))
-        transactions = txns["transactions"]
-        inserted = 0
-        skipped_dup = 0
-        skipped_pending = 0
-        for txn in transactions:
-          if not txn["pending"]:
-            try:
-              category = txn["category"]
-              cat = category[0]
-              if len(category) > 1:
-                subcat = category[1]
-              else:
-                subcat = None
-              da.add_transaction(txn["transaction_id"], txn["account_id"], cat, subcat,
-                txn["name"], txn["amount"], txn["date"], None)
-              inserted += 1
-            except sqlite3.IntegrityError:
-              skipped_dup += 1
-          else:
-            skipped_pending += 1
-        print("Summary: Total: {}, Inserted: {}, Skipped Duplicate: {}, Skipped Pending: {}".format(num_txns, inserted, skipped_dup, skipped_pending))
-        print("Sleeping for 5 Seconds...")
-        time.sleep(5)
-      except:
-        print("ERROR: Could not get transactions for {}".format(institutionInfo["name"]))
+    sys.exit(1)
+  # WAL so the web app can keep reading while this writes. One DataAccessor per shard (just the
+  # one when the database isn't sharded), each written by its own thread
+  sqlStats = QueryStats(args.slow_ms) if args.sql_stats or args.slow_ms is not None else None
+  das = open_shards(args.db_file, args.shards, pragmas=TUNED_PRAGMAS, stats=sqlStats, check_same_thread=False)
+
+  limiter = TokenBucket(args.rate, args.burst)
+
+  # Collect every user connection up front, along with the window it needs
+  today = datetime.date.today()
+  userConns = [[] for _ in das]
+  for userRow in das[0].get_all_userID():
+    print("INFO: Queueing user: {}".format(userRow["username"]))
+    shard = shard_for(userRow["userID"], args.shards)
+    for userConn in das[shard].get_user_connections(userRow["userID"]):
+      syncState = None if args.full else das[shard].get_sync_state(userConn["connectionID"])
+      daysAgo = get_days_ago_start(syncState, days_ago_start, args.overlap, today)
+      lastTxnDate = syncState["lastTxnDate"] if syncState else None
+      userConns[shard].append((userConn, daysAgo, lastTxnDate))
+
+  # Fetch on the worker pool, the writers store what they hand over
+  workers = max(args.workers, 1)
+  results = [queue.Queue(maxsize=workers * 2) for _ in das]
+  stats = [{} for _ in das]
+  started = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=workers) as pool, ThreadPoolExecutor(max_workers=len(das)) as writers:
+    writes = [writers.submit(write_results, da, Categoriser(da), results[shard], stats[shard], len(userConns[shard]),
+      today) for (shard, da) in enumerate(das)]
+    for (shard, conns) in enumerate(userConns):
+      for (userConn, daysAgo, lastTxnDate) in conns:
+        stats[shard][userConn["connectionID"]] = new_stat(lastTxnDate)
+        print("-> INFO: Fetching {} from {} days ago".format(userConn["name"], daysAgo))
+        pool.submit(fetch_transactions, client, limiter, userConn, daysAgo, days_ago_end, results[shard])
+    for write in writes:
+      write.result()
+
+  elapsed = time.perf_counter() - started
+  total = sum(stat["total"] for shardStats in stats for stat in shardStats.values())
+  print("INFO: Fetched {} transactions from {} connections in {:.1f}s ({:.0f}/s)".format(total,
+    sum(len(conns) for conns in userConns), elapsed, total / elapsed if elapsed else 0))
+
+  if sqlStats is not None:
+    print("INFO: SQL statements by total time:")
+    for line in sqlStats.format_summary():
+      print("  " + line)
 
 if __name__ == "__main__":
   main()
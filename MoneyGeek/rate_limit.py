@@ -0,0 +1,40 @@
+import threading
+import time
+
+class TokenBucket:
+  # Thread safe token bucket. Tokens are refilled at `rate` per second up to `capacity`,
+  # acquire() blocks until enough tokens are available.
+
+  def __init__(self, rate, capacity=1, clock=time.monotonic, sleep=time.sleep):
+    if rate <= 0:
+      raise ValueError("Rate must be positive, got: {}".format(rate))
+    self.rate = float(rate)
+    self.capacity = float(max(capacity, 1))
+    self.tokens = self.capacity
+    self.clock = clock
+    self.sleep = sleep
+    self.last = clock()
+    self.lock = threading.Lock()
+
+  def _refill(self):
+    now = self.clock()
+    self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+    self.last = now
+
+  def try_acquire(self, tokens=1):
+    with self.lock:
+      self._refill()
+      if self.tokens >= tokens:
+        self.tokens -= tokens
+        return True
+      return False
+
+  def acquire(self, tokens=1):
+    while True:
+      with self.lock:
+        self._refill()
+        if self.tokens >= tokens:
+          self.tokens -= tokens
+          return
+        wait = (tokens - self.tokens) / self.rate
+      self.sleep(wait)
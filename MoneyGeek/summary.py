@@ -1,25 +1,44 @@
+import base64
 import functools
 import json
 import datetime
-import calendar
 
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, session, url_for
+    Blueprint, Response, abort, current_app, flash, g, jsonify, redirect, render_template, request, session,
+    stream_with_context, url_for
 )
 
-from .flask_util import get_da
+from .auth import login_required
+from .dao import month_range, to_cents
+from .export import FORMATS, to_record
+from .flask_util import get_da, get_summary_cache
+from .pivot import Pivot, month_span
 
 bp = Blueprint('summary', __name__, url_prefix='/summary')
 
+def get_account_summary(userID):
+  # Cached per user, entries are tagged with the user's account ref version so adding one of
+  # their accounts or connections (in this process) invalidates them, the cache TTL covers
+  # other processes
+  da = get_da(userID)
+  cache = get_summary_cache()
+  version = da.get_ref_version(('account', userID))
+  entry = cache.get(userID)
+  if entry is not None and entry[0] == version:
+    return entry[1]
+  summary = da.get_summary(userID)
+  cache.set(userID, (version, summary))
+  return summary
+
 @bp.route('/home', methods=('GET',))
 def home():
   userID = session.get('userID')
-  da = get_da()
   error = None
-  s = da.convertRowsToDictList(da.get_summary(userID))
-  session['summary'] = s
+  summary = get_account_summary(userID)
+  # Older sessions carried the whole summary in the cookie
+  session.pop('summary', None)
   if not error:
-    return render_template('summary/home.html')
+    return render_template('summary/home.html', summary=summary)
   flash(error)
   return redirect(url_for('auth.login'))
 
@@ -45,7 +64,7 @@ def view_account():
     accountName = account_conn['name']
     # Store accountName
     info['name'] = accountName
-    dates = da.convertRowsToDictList(da.get_available_dates(accountID))
+    dates = da.get_available_dates(accountID)
     # Store dates
     info['dates'] = dates
     year = None
@@ -55,15 +74,22 @@ def view_account():
     # choose and store date
     chosen_date = request.form.get('chosen_date')
     if chosen_date:
-      (year, month) = chosen_date.split('-')
+      (year, sep, month) = chosen_date.partition('-')
+      parse_month(year, month)
     elif len(dates) > 0:
       year = dates[0]['year']
       month = dates[0]['month']
     if year and month:
       info['year'] = year
       info['month'] = month
-      categories = da.convertRowsToDictList(da.get_categories())
-      transactions = da.convertRowsToDictList(da.get_transactions_for_month(accountID, year, month))
+      # Paged by (date, transactionID) key, the form posts back the current page's key
+      after = parse_page_key(request.form.get('after'))
+      info['after'] = format_page_key(after)
+      categories = da.get_categories()
+      (start, end) = month_range(year, month)
+      (transactions, nextKey) = da.get_transaction_page(accountID, start, end, after,
+        current_app.config['TRANSACTION_PAGE_SIZE'])
+      info['next'] = format_page_key(nextKey)
 
   if not error:
     return render_template('summary/view_account.html', transactions=transactions, categories=categories, info=info)
@@ -71,20 +97,34 @@ def view_account():
     flash(error)
     return redirect(url_for('summary.home'))
 
+@bp.route('/uncategorised', methods=('GET', ))
+@login_required
+def uncategorised():
+  # Work queue: account months with transactions still to categorise, each opening view_account
+  pending = get_da().find_uncategorised_accounts(session.get('userID'))
+  return render_template('summary/uncategorised.html', pending=pending,
+    total=sum(row['pending'] for row in pending))
+
 @bp.route('/update_transactions', methods=('POST', ))
 def update_transactions():
   accountID = request.form.get('accountID')
   txns = request.form.getlist('txn')
   da = get_da()
   errCount = 0
+  updates = []
   for txn in txns:
     elems = txn.split(':')
-    if len(elems) == 3:
-      da.update_category(accountID, elems[0], elems[2])
-    elif len(elems) == 2 and elems[1] == '':
-      da.update_category(accountID, elems[0], None)
-    else:
+    try:
+      if len(elems) == 3:
+        updates.append((elems[0], int(elems[2])))
+      elif len(elems) == 2 and elems[1] == '':
+        updates.append((elems[0], None))
+      else:
+        errCount += 1
+    except ValueError:
       errCount += 1
+  updated = da.update_categories(accountID, updates)
+  flash("Updated {} transactions".format(updated))
   if errCount > 0:
     flash("{} updates were invalid and skipped".format(errCount))
   return redirect(url_for('summary.view_account'), code=307)
@@ -99,55 +139,38 @@ def monthly_summary():
     now = datetime.datetime.now()
     year = str(now.year)
     month = str(now.month)
+  parse_month(year, month)
   da = get_da()
-  summary = da.convertRowsToDictList(da.get_monthly_summary(userID, year, month))
+  summary = da.get_monthly_summary(userID, year, month)
   return render_template('summary/monthly_summary.html', year=year, month=month, summary=summary)
 
 @bp.route('/annual_summary', methods=('GET', ))
 def annual_summary():
+  # Either a single year or a range of years (start_year/end_year)
   error = None
   userID = session.get('userID')
   year = request.args.get('year')
+  startYear = request.args.get('start_year') or year
+  endYear = request.args.get('end_year') or year
   cumulative = request.args.get('cumulative')
-  if not year:
+  if not startYear or not endYear:
     now = datetime.datetime.now()
-    year = str(now.year)
+    startYear = endYear = str(now.year)
+  startYear = parse_year(startYear)
+  endYear = parse_year(endYear)
+  if startYear > endYear:
+    (startYear, endYear) = (endYear, startYear)
+  endYear = min(endYear, startYear + current_app.config['SUMMARY_MAX_YEARS'] - 1)
   if cumulative == 'true':
     cumulative = True
   else:
     cumulative = False
   da = get_da()
-  res = da.get_annual_summary(userID, year)
-  budget = da.get_budget(userID)
-  budgetMap = {}     # Category ID -> budget amount
-  for row in budget:
-    budgetMap[row['categoryID']] = row['budgetAmount']
-  categoryIDMap = {} # Category name -> Category ID
-  cat_store = None   # Category name @ [0], amount at month index (1 = Jan), total annual for category @ [13], monthly budget @ [14]
-  summary = []       # An array of cat_stores
-  total = 0
-  for row in res:
-    if not cat_store or cat_store[0] != row['name']:
-      # New Category - so create a new row
-      cat_store = [0 for _ in range(15)]
-      cat_store[0] = row['name']
-      summary.append(cat_store)
-      categoryIDMap[row['name']] = row['categoryID']
-      total = 0
-    cat_store[int(row['month'])] = row['amount']
-    total += row['amount']
-    cat_store[13] = total
-    cat_store[14] = budgetMap.get(row['categoryID'], 0)
-
-  if cumulative:
-    for cat_store in summary:
-      cum = 0;
-      for i in range(1, 13):
-        cum += cat_store[i]
-        cat_store[i] = cum
-  
-  months = [calendar.month_abbr[i+1] for i in range(12)]
-  return render_template('summary/annual_summary.html', year=year, summary=summary, categoryIDMap=categoryIDMap, months=months, cumulative=cumulative)
+  res = da.get_period_summary(userID, startYear, endYear)
+  budgets = dict((row['categoryID'], row['budgetCents']) for row in da.get_budget(userID))
+  summary = Pivot.from_rows(res, month_span(startYear, endYear), budgets)
+  return render_template('summary/annual_summary.html', startYear=startYear, endYear=endYear, summary=summary,
+    rows=list(summary.display_rows(cumulative)), cumulative=cumulative)
 
 @bp.route('/update_budget', methods=('POST', ))
 def update_budget():
@@ -156,5 +179,120 @@ def update_budget():
   userID = session.get('userID')
   da = get_da()
   for categoryID in request.form.keys():
-    da.upsert_budget(userID, categoryID, request.form.get(categoryID))
+    try:
+      da.upsert_budget(userID, categoryID, request.form.get(categoryID))
+    except ValueError as e:
+      flash(str(e))
   return redirect(url_for('summary.annual_summary'))
+
+def parse_date(value):
+  # Optional ISO date query argument
+  if not value:
+    return None
+  try:
+    return datetime.datetime.strptime(value, "%Y-%m-%d").date().isoformat()
+  except ValueError:
+    abort(400, "Invalid date: {}".format(value))
+
+def parse_month(year, month):
+  # [start, end) date bounds of a year and month argument
+  try:
+    return month_range(year, month)
+  except (TypeError, ValueError):
+    abort(400, "Invalid month: {}-{}".format(year, month))
+
+def parse_year(value):
+  try:
+    year = int(value)
+  except (TypeError, ValueError):
+    year = None
+  if year is None or not datetime.MINYEAR <= year <= datetime.MAXYEAR:
+    abort(400, "Invalid year: {}".format(value))
+  return year
+
+def parse_page_key(value):
+  # Opaque page key, as handed out by format_page_key. It holds the last row's stored date as it
+  # is (older uploads hold full timestamps), so the next page carries on exactly after that row
+  if not value:
+    return None
+  try:
+    key = json.loads(base64.urlsafe_b64decode(value.encode()).decode())
+  except ValueError:
+    key = None
+  if not isinstance(key, list) or len(key) != 2 or not all(isinstance(part, str) for part in key):
+    abort(400, "Invalid page key: {}".format(value))
+  return tuple(key)
+
+def format_page_key(key):
+  if key is None:
+    return None
+  return base64.urlsafe_b64encode(json.dumps(list(key)).encode()).decode()
+
+@bp.route('/api/transactions', methods=('GET', ))
+@login_required
+def api_transactions():
+  # JSON page of an account's transactions for a month (year, month), continued with the
+  # previous response's 'next' key (after) until it comes back null
+  userID = session.get('userID')
+  accountID = request.args.get('accountID')
+  da = get_da()
+  account = da.get_account_connection(userID, accountID) if accountID else None
+  if account is None:
+    abort(404, "Unknown account: {}".format(accountID))
+  (start, end) = parse_month(request.args.get('year'), request.args.get('month'))
+  limit = request.args.get('limit', current_app.config['TRANSACTION_PAGE_SIZE'], type=int)
+  limit = max(1, min(limit, current_app.config['TRANSACTION_PAGE_MAX']))
+  after = parse_page_key(request.args.get('after'))
+  (rows, nextKey) = da.get_transaction_page(accountID, start, end, after, limit)
+  return jsonify({
+    'transactions': [to_record(dict(row, account=account['name'])) for row in rows],
+    'next': format_page_key(nextKey)
+  })
+
+def parse_amount(value):
+  # Optional decimal amount query argument, in cents
+  if not value:
+    return None
+  try:
+    return to_cents(value)
+  except ValueError:
+    abort(400, "Invalid amount: {}".format(value))
+
+def search_results():
+  # (query text, matches) for the search arguments: q, start/end dates, min/max amounts, limit
+  text = request.args.get('q', '')
+  limit = request.args.get('limit', current_app.config['TRANSACTION_PAGE_SIZE'], type=int)
+  limit = max(1, min(limit, current_app.config['TRANSACTION_PAGE_MAX']))
+  results = get_da().search_transactions(session.get('userID'), text, parse_date(request.args.get('start')),
+    parse_date(request.args.get('end')), parse_amount(request.args.get('min')), parse_amount(request.args.get('max')),
+    limit)
+  return (text, results)
+
+@bp.route('/search', methods=('GET', ))
+@login_required
+def search():
+  (text, results) = search_results()
+  return render_template('summary/search.html', q=text, args=request.args, results=results)
+
+@bp.route('/api/search', methods=('GET', ))
+@login_required
+def api_search():
+  (text, results) = search_results()
+  return jsonify({'transactions': [to_record(row) for row in results]})
+
+@bp.route('/export', methods=('GET', ))
+@login_required
+def export():
+  # Streams the user's transactions as CSV or NDJSON, optionally for one account (accountID)
+  # and a [start, end) date range, without ever holding the whole history in memory
+  userID = session.get('userID')
+  fmt = request.args.get('format', 'csv')
+  if fmt not in FORMATS:
+    abort(400, "Unknown format: {}".format(fmt))
+  accountID = request.args.get('accountID')
+  start = parse_date(request.args.get('start'))
+  end = parse_date(request.args.get('end'))
+  (lines, mimetype) = FORMATS[fmt]
+  rows = get_da().iter_transactions(userID, accountID, start, end)
+  return Response(stream_with_context(lines(rows)), mimetype=mimetype,
+    headers={'Content-Disposition': 'attachment; filename=transactions.{}'.format(fmt)})
@@ -0,0 +1,232 @@
+import sys
+import argparse
+import datetime
+import queue
+import random
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dao import TUNED_PRAGMAS, open_shards, to_timestamp
+from rate_limit import TokenBucket
+from categorise import Categoriser
+from plaid_dao import MAX_PAGE_SIZE
+from pull_data import get_plaid_client, get_days_ago_start, new_stat, store_page, format_stat, fetch_transactions
+
+# Long running alternative to pull_data.py: every connection has a job in the sync_job table,
+# due jobs are claimed stalest first and fetched on a bounded worker pool, each stored page is
+# checkpointed so an interrupted sync resumes where it stopped, and a failed connection is
+# retried with exponential backoff instead of waiting for the next full run. Several daemons
+# can share a database, jobs left running by one that died are taken over once they are stale.
+#   python sync_daemon.py DB_FILE [--workers 4] [--interval 3600] [--once] [--status]
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser(description="Keep every user connection synced with plaid")
+  parser.add_argument("db_file")
+  parser.add_argument("--days-ago-start", type=int, default=730,
+    help="Window fetched for a connection that has never synced (default: 730)")
+  parser.add_argument("--interval", type=int, default=3600,
+    help="Seconds between successful syncs of a connection (default: 3600)")
+  parser.add_argument("--workers", type=int, default=4,
+    help="Number of connections synced concurrently, per shard (default: 4)")
+  parser.add_argument("--rate", type=float, default=2.0,
+    help="Maximum plaid requests per second across all workers (default: 2)")
+  parser.add_argument("--burst", type=int, default=1,
+    help="Number of requests allowed back to back before the rate applies (default: 1)")
+  parser.add_argument("--overlap", type=int, default=7,
+    help="Days re-fetched before the last seen transaction of an incremental sync (default: 7)")
+  parser.add_argument("--backoff", type=int, default=60,
+    help="Seconds before retrying a failed connection, doubled on every consecutive failure (default: 60)")
+  parser.add_argument("--max-backoff", type=int, default=6 * 3600,
+    help="Longest wait before retrying a failed connection (default: 21600)")
+  parser.add_argument("--poll", type=float, default=5.0,
+    help="Seconds between checks for due jobs when idle (default: 5)")
+  parser.add_argument("--refresh", type=int, default=60,
+    help="Seconds between checks for new connections, stale jobs and mapping changes (default: 60)")
+  parser.add_argument("--stale-after", type=int, default=6 * 3600,
+    help="Seconds after which a job still running is taken to be abandoned by its daemon (default: 21600)")
+  parser.add_argument("--shards", type=int, default=0,
+    help="Number of shards db_file is split into (the app's SQLITE_SHARDS), each gets its own queue (default: 0)")
+  parser.add_argument("--once", action="store_true",
+    help="Exit once no jobs are due instead of waiting for more")
+  parser.add_argument("--status", action="store_true",
+    help="Print the sync jobs and exit")
+  return parser.parse_args(argv)
+
+def utcnow():
+  return datetime.datetime.now(datetime.timezone.utc)
+
+def backoff_delay(attempts, base, maximum):
+  # Seconds to wait after failure number attempts + 1. Jittered so connections that fail
+  # together (e.g. an institution outage) don't all retry in lockstep.
+  delay = min(base * 2 ** min(attempts, 30), maximum)
+  return delay * random.uniform(0.8, 1.2)
+
+class SyncDaemon:
+  # The thread in run() claims jobs and is the only one writing to its database, workers only talk to plaid
+
+  def __init__(self, da, client, limiter, categoriser, workers=4, days_ago_start=730, interval=3600,
+      overlap=7, backoff=60, max_backoff=6 * 3600, refresh=60, stale_after=6 * 3600, page_size=MAX_PAGE_SIZE,
+      report=print):
+    self.da = da
+    self.client = client
+    self.limiter = limiter
+    self.categoriser = categoriser
+    self.workers = max(workers, 1)
+    self.days_ago_start = days_ago_start
+    self.interval = interval
+    self.overlap = overlap
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.refresh = refresh
+    self.stale_after = stale_after
+    self.page_size = page_size
+    self.report = report
+    self.results = queue.Queue(maxsize=self.workers * 2)
+    self.running = {}   # connectionID -> {"job", "windowStart", "offset", "stat", "error"}
+    self.refreshed = None
+    self.stopping = threading.Event()
+
+  def stop(self, *args):
+    # Stops claiming jobs, the ones running are finished first
+    if not self.stopping.is_set():
+      self.report("INFO: Stopping once {} running job(s) finish".format(len(self.running)))
+    self.stopping.set()
+
+  def maintain(self, now):
+    # Every refresh seconds (and on the first call): jobs for new connections, and jobs whose
+    # daemon died back in the queue
+    if self.refreshed is not None and time.monotonic() - self.refreshed < self.refresh:
+      return
+    self.refreshed = time.monotonic()
+    self.da.ensure_sync_jobs(to_timestamp(now))
+    released = self.da.release_sync_jobs(to_timestamp(now - datetime.timedelta(seconds=self.stale_after)))
+    if released:
+      self.report("INFO: Resuming {} stale job(s)".format(released))
+
+  def schedule(self, pool):
+    # Claims due jobs for the idle workers, returns how many were started
+    free = self.workers - len(self.running)
+    if free <= 0 or self.stopping.is_set():
+      return 0
+    now = utcnow()
+    self.maintain(now)
+    jobs = self.da.claim_sync_jobs(to_timestamp(now), free)
+    for job in jobs:
+      self.start(pool, job, datetime.date.today())
+    return len(jobs)
+
+  def start(self, pool, job, today):
+    connectionID = job["connectionID"]
+    syncState = self.da.get_sync_state(connectionID)
+    if job["windowStart"]:
+      # Resume the interrupted window after its last stored page. Plaid lists newest first, so
+      # transactions that arrived since only push stored ones back into the rest of the window,
+      # where they are skipped as duplicates.
+      windowStart = job["windowStart"]
+      offset = job["checkpointOffset"]
+      daysAgo = (today - datetime.date.fromisoformat(windowStart)).days
+    else:
+      daysAgo = get_days_ago_start(syncState, self.days_ago_start, self.overlap, today)
+      windowStart = (today - datetime.timedelta(daysAgo)).isoformat()
+      offset = 0
+    lastTxnDate = syncState["lastTxnDate"] if syncState else None
+    self.running[connectionID] = {"job": job, "windowStart": windowStart, "offset": offset,
+      "stat": new_stat(lastTxnDate), "error": None}
+    self.report("-> INFO: Syncing {} for user {} from {} days ago{}".format(job["name"], job["userID"], daysAgo,
+      " (resuming at {})".format(offset) if offset else ""))
+    pool.submit(fetch_transactions, self.client, self.limiter, job, daysAgo, 0, self.results, offset,
+      self.page_size)
+
+  def handle(self, kind, job, payload):
+    connectionID = job["connectionID"]
+    state = self.running[connectionID]
+    if kind == "page":
+      # After a page that couldn't be stored the rest of the fetch is dropped. The job stays
+      # running until the fetch finishes, then fails and retries from the last checkpoint.
+      if state["error"] is not None:
+        return
+      try:
+        store_page(self.da, self.categoriser, state["stat"], payload)
+        state["offset"] += len(payload)
+        self.da.checkpoint_sync_job(connectionID, state["windowStart"], state["offset"])
+      except Exception as e:
+        state["error"] = e
+      return
+    del self.running[connectionID]
+    now = utcnow()
+    if state["error"] is not None:
+      (kind, payload) = ("error", state["error"])
+    if kind == "done":
+      # Only a complete fetch moves the high-water mark
+      self.da.update_sync_state(connectionID, datetime.date.today().isoformat(), state["stat"]["lastTxnDate"])
+      self.da.complete_sync_job(connectionID, to_timestamp(now),
+        to_timestamp(now + datetime.timedelta(seconds=self.interval)))
+      self.report("-> INFO: {} Summary: {}".format(job["name"], format_stat(state["stat"])))
+    else:
+      delay = backoff_delay(job["attempts"], self.backoff, self.max_backoff)
+      self.da.fail_sync_job(connectionID, "{}: {}".format(type(payload).__name__, payload),
+        to_timestamp(now + datetime.timedelta(seconds=delay)))
+      self.report("ERROR: Could not sync {} (attempt {}), retrying in {:.0f}s: {}".format(job["name"],
+        job["attempts"] + 1, delay, payload))
+
+  def run(self, poll=5.0, once=False):
+    with ThreadPoolExecutor(max_workers=self.workers) as pool:
+      while True:
+        started = self.schedule(pool)
+        if not self.running:
+          if self.stopping.is_set() or (once and not started):
+            break
+          self.stopping.wait(poll)
+          continue
+        try:
+          (kind, job, payload) = self.results.get(timeout=poll)
+        except queue.Empty:
+          continue
+        # Whatever goes wrong, keep draining: the workers block on a full queue otherwise
+        try:
+          self.handle(kind, job, payload)
+        except Exception as e:
+          self.report("ERROR: Could not record the sync of {}: {}".format(job["name"], e))
+
+def print_status(da):
+  print("{:>6}  {:<16} {:<24} {:<8} {:<19} {:>8}  {:<19} {}".format("conn", "user", "institution", "status",
+    "next run (UTC)", "attempts", "last success (UTC)", "last error"))
+  for job in da.get_sync_jobs():
+    print("{:>6}  {:<16} {:<24} {:<8} {:<19} {:>8}  {:<19} {}".format(job["connectionID"], job["username"],
+      job["name"], job["status"], job["nextRunAt"], job["attempts"], job["lastSuccessAt"] or "-",
+      job["lastError"] or ""))
+
+def main():
+  args = parse_args(sys.argv[1:])
+  # Each shard has its own jobs, worker pool and writer thread
+  das = open_shards(args.db_file, args.shards, pragmas=TUNED_PRAGMAS, check_same_thread=False)
+  if args.status:
+    for (shard, da) in enumerate(das):
+      if args.shards:
+        print("Shard {}:".format(shard))
+      print_status(da)
+    return
+
+  client = get_plaid_client()
+  # plaid's limits apply to the client, so the shards share the limiter
+  limiter = TokenBucket(args.rate, args.burst)
+  daemons = [SyncDaemon(da, client, limiter, Categoriser(da, args.refresh), args.workers, args.days_ago_start, args.interval,
+    args.overlap, args.backoff, args.max_backoff, args.refresh, args.stale_after) for da in das]
+  def stop(*args):
+    for daemon in daemons:
+      daemon.stop()
+  signal.signal(signal.SIGTERM, stop)
+  signal.signal(signal.SIGINT, stop)
+  threads = [threading.Thread(target=daemon.run, args=(args.poll, args.once)) for daemon in daemons]
+  for thread in threads:
+    thread.start()
+  # Joined with a timeout so the signal handlers get to run
+  for thread in threads:
+    while thread.is_alive():
+      thread.join(1)
+  for da in das:
+    da.close()
+
+if __name__ == "__main__":
+  main()
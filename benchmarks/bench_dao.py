@@ -0,0 +1,255 @@
+import argparse
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date
+
+from MoneyGeek import plaid_dao
+from MoneyGeek.categorise import Categoriser
+from MoneyGeek.dao import DataAccessor, TUNED_PRAGMAS, month_range
+from MoneyGeek.fake_plaid import FakeClient
+from MoneyGeek.importer import FileImporter
+
+from . import synthetic
+
+# Times every DataAccessor query and ingest path against a synthetic dataset and compares the
+# medians with stored baselines, failing (exit status 1) when one is slower than threshold x
+# its baseline. Baselines only mean something on the machine and dataset they were taken with.
+#   python -m benchmarks.bench_dao [--db FILE] [--update] [--only NAME] ...
+
+BASELINES = os.path.join(os.path.dirname(__file__), 'baselines.json')
+
+# name -> setup function taking the Context and returning the callable to time
+BENCHMARKS = {}
+
+def benchmark(name):
+  def register(setup):
+    BENCHMARKS[name] = setup
+    return setup
+  return register
+
+class Context:
+  # The DataAccessor plus a typical user, account and month of the dataset
+
+  def __init__(self, da, start, months):
+    self.da = da
+    users = da.get_all_userID()
+    self.userID = users[len(users) // 2]["userID"]
+    self.accountID = "acc{}-0".format(self.userID)
+    middle = list(synthetic.month_starts(start, months))[months // 2]
+    (self.year, self.month) = (str(middle.year), "{:02d}".format(middle.month))
+    self.startYear = str(start.year)
+    self.endYear = str(middle.year)
+    self.counter = 0
+
+  def unique(self, prefix):
+    # Fresh IDs for every repetition of a write benchmark
+    self.counter += 1
+    return "bench-{}-{}-{}".format(prefix, os.getpid(), self.counter)
+
+def consume(rows):
+  for _ in rows:
+    pass
+
+#### Queries ####
+
+@benchmark('get_summary')
+def bench_get_summary(ctx):
+  return lambda: ctx.da.get_summary(ctx.userID)
+
+@benchmark('get_user_info')
+def bench_get_user_info(ctx):
+  return lambda: ctx.da.get_user_info("user{}".format(ctx.userID))
+
+@benchmark('get_category_info')
+def bench_get_category_info(ctx):
+  return lambda: [ctx.da.get_category_info(name) for name in synthetic.SPENDING]
+
+@benchmark('get_available_dates')
+def bench_get_available_dates(ctx):
+  return lambda: ctx.da.get_available_dates(ctx.accountID)
+
+@benchmark('get_transactions_for_month')
+def bench_get_transactions_for_month(ctx):
+  return lambda: ctx.da.get_transactions_for_month(ctx.accountID, ctx.year, ctx.month)
+
+@benchmark('get_transaction_page')
+def bench_get_transaction_page(ctx):
+  (start, end) = month_range(ctx.year, ctx.month)
+  return lambda: ctx.da.get_transaction_page(ctx.accountID, start, end, None, 100)
+
+@benchmark('get_transaction_page_last')
+def bench_get_transaction_page_last(ctx):
+  # Last page of the month, the key seek should make it cost the same as the first
+  (start, end) = month_range(ctx.year, ctx.month)
+  rows = ctx.da.get_transactions_for_month(ctx.accountID, ctx.year, ctx.month)
+  last = sorted((r["date"], r["transactionID"]) for r in rows)[-2]
+  return lambda: ctx.da.get_transaction_page(ctx.accountID, start, end, last, 100)
+
+@benchmark('get_monthly_summary')
+def bench_get_monthly_summary(ctx):
+  return lambda: ctx.da.get_monthly_summary(ctx.userID, ctx.year, ctx.month)
+
+@benchmark('get_annual_summary')
+def bench_get_annual_summary(ctx):
+  return lambda: ctx.da.get_annual_summary(ctx.userID, ctx.year)
+
+@benchmark('get_period_summary')
+def bench_get_period_summary(ctx):
+  return lambda: ctx.da.get_period_summary(ctx.userID, ctx.startYear, ctx.endYear)
+
+@benchmark('get_budget')
+def bench_get_budget(ctx):
+  return lambda: ctx.da.get_budget(ctx.userID)
+
+@benchmark('iter_transactions')
+def bench_iter_transactions(ctx):
+  return lambda: consume(ctx.da.iter_transactions(ctx.userID))
+
+@benchmark('get_uncategorised_transactions')
+def bench_get_uncategorised_transactions(ctx):
+  return lambda: ctx.da.get_uncategorised_transactions(0, 1000)
+
+@benchmark('find_uncategorised_accounts')
+def bench_find_uncategorised_accounts(ctx):
+  return lambda: ctx.da.find_uncategorised_accounts(ctx.userID)
+
+@benchmark('search_transactions')
+def bench_search_transactions(ctx):
+  return lambda: ctx.da.search_transactions(ctx.userID, "uber trip")
+
+#### Ingest ####
+
+def new_rows(ctx, count, categoryID=None):
+  accountID = ctx.unique('acc')
+  return [("t{}".format(i), accountID, 'Bench', None, "STARBUCKS #{}".format(i), "-4.50",
+    "2017-{:02d}-{:02d}".format(i % 12 + 1, i % 28 + 1), categoryID) for i in range(count)]
+
+@benchmark('add_transactions_10k')
+def bench_add_transactions(ctx):
+  rows = new_rows(ctx, 10000, 1)
+  return lambda: ctx.da.add_transactions(rows)
+
+@benchmark('add_transactions_10k_categorised')
+def bench_add_transactions_categorised(ctx):
+  rows = new_rows(ctx, 10000)
+  categoriser = Categoriser(ctx.da)
+  return lambda: ctx.da.add_transactions(categoriser.categorise(rows))
+
+@benchmark('import_file_10k')
+def bench_import_file(ctx):
+  text = "".join("{:02d}/{:02d}/17\tx\tSHOP {}\t-{}.50\tGroceries\n".format(i % 12 + 1, i % 28 + 1, i, i % 90)
+    for i in range(10000))
+  importer = FileImporter(ctx.da, ctx.unique('acc'), report=lambda message: None)
+  return lambda: importer.run(io.StringIO(text), "bench.tsv")
+
+@benchmark('plaid_ingest_fake')
+def bench_plaid_ingest(ctx):
+  # A year of two accounts paged from the local plaid stand-in into txn, the way pull_data stores them
+  client = FakeClient(per_day=10)
+  categoriser = Categoriser(ctx.da)
+  token = ctx.unique('plaid')
+  def ingest():
+    for page in plaid_dao.iter_transaction_pages(client, token, 365, 0):
+      ctx.da.add_transactions(categoriser.categorise(plaid_dao.to_row(txn) for txn in page if not txn["pending"]))
+  return ingest
+
+@benchmark('update_categories_1k')
+def bench_update_categories(ctx):
+  rows = new_rows(ctx, 1000, 1)
+  ctx.da.add_transactions(rows)
+  updates = [(row[0], 2) for row in rows]
+  return lambda: ctx.da.update_categories(rows[0][1], updates)
+
+@benchmark('backfill_categories')
+def bench_backfill_categories(ctx):
+  # Leftover uncategorised synthetic rows are examined too, the first repetition picks up any
+  # the mappings can categorise
+  ctx.da.add_transactions(new_rows(ctx, 5000))
+  return lambda: Categoriser(ctx.da).backfill()
+
+#### Runner ####
+
+def run(ctx, names, repeat):
+  # name -> median seconds, each repetition gets its own setup
+  results = {}
+  for name in names:
+    timings = []
+    for _ in range(repeat):
+      fn = BENCHMARKS[name](ctx)
+      started = time.perf_counter()
+      fn()
+      timings.append(time.perf_counter() - started)
+    results[name] = statistics.median(timings)
+  return results
+
+def compare(results, baselines, threshold):
+  # Prints a report, returns the names slower than threshold x baseline
+  regressions = []
+  for (name, seconds) in results.items():
+    baseline = baselines.get(name)
+    if baseline:
+      ratio = seconds / baseline
+      flag = "REGRESSION" if ratio > threshold else ""
+      if flag:
+        regressions.append(name)
+      print("  {:<36} {:>10.3f} ms  baseline {:>10.3f} ms  x{:<5.2f} {}".format(name, seconds * 1000,
+        baseline * 1000, ratio, flag))
+    else:
+      print("  {:<36} {:>10.3f} ms  (no baseline)".format(name, seconds * 1000))
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the DataAccessor against a synthetic dataset')
+  parser.add_argument('--db', help='Existing synthetic database (created by benchmarks.synthetic, it gets written '
+    + 'to), a temporary one is generated otherwise')
+  parser.add_argument('--users', type=int, default=200)
+  parser.add_argument('--accounts', type=int, default=3)
+  parser.add_argument('--txns', type=int, default=60)
+  parser.add_argument('--start', default='2016-01-01')
+  parser.add_argument('--months', type=int, default=36)
+  parser.add_argument('--repeat', type=int, default=5)
+  parser.add_argument('--only', action='append', help='Only benchmarks whose name contains this, may be repeated')
+  parser.add_argument('--baselines', default=BASELINES)
+  parser.add_argument('--threshold', type=float, default=1.5, help='Fail when slower than this x the baseline')
+  parser.add_argument('--update', action='store_true', help='Store the results as the new baselines')
+  args = parser.parse_args()
+  start = date(*[int(p) for p in args.start.split('-')])
+  names = [n for n in BENCHMARKS if not args.only or any(o in n for o in args.only)]
+  dataset = {'users': args.users, 'accounts': args.accounts, 'txns': args.txns, 'start': args.start, 'months': args.months}
+
+  with tempfile.TemporaryDirectory() as tmp:
+    db_file = args.db
+    if not db_file:
+      db_file = os.path.join(tmp, 'bench.sqlite3')
+      print("Generating {}".format(dataset))
+      synthetic.create(db_file, args.users, args.accounts, args.txns, start, args.months, report=lambda message: None)
+    da = DataAccessor(db_file, pragmas=TUNED_PRAGMAS)
+    results = run(Context(da, start, args.months), names, args.repeat)
+    da.close()
+
+  stored = {}
+  if os.path.exists(args.baselines):
+    with open(args.baselines) as f:
+      stored = json.load(f)
+  if stored.get('dataset') not in (None, dataset):
+    print("WARN: Baselines were taken with {}".format(stored['dataset']))
+  print("Median of {} runs:".format(args.repeat))
+  regressions = compare(results, stored.get('results', {}), args.threshold)
+  if args.update:
+    baselines = dict(stored.get('results', {}))
+    baselines.update(results)
+    with open(args.baselines, 'w') as f:
+      json.dump({'dataset': dataset, 'results': baselines}, f, indent=2, sort_keys=True)
+      f.write("\n")
+    print("Updated {}".format(args.baselines))
+  elif regressions:
+    print("FAIL: {} slower than {}x baseline".format(", ".join(regressions), args.threshold))
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
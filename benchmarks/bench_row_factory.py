@@ -0,0 +1,57 @@
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from MoneyGeek.dao import DataAccessor
+
+# Compares fetching one large account as sqlite3.Row + convertRowsToDictList (the old route
+# code path) against the dict row factory, which builds the dicts once straight off the cursor.
+#   python -m benchmarks.bench_row_factory [rows]
+
+def populate(db_file, rows):
+  da = DataAccessor(db_file)
+  da.initialise_db('db/schema.sql')
+  da.initialise_db('db/categories.sql')
+  da.migrate('db/migrations')
+  da.add_transactions(
+    ("txn{}".format(i), "acc1", "Shops", "Groceries", "Purchase number {}".format(i), (i % 5000) / 100.0,
+      "20{:02d}-{:02d}-{:02d}".format(10 + i % 9, i % 12 + 1, i % 28 + 1), (i % 30) or None)
+    for i in range(rows)
+  )
+  da.close()
+
+def measure(fetch, repeat=3):
+  # Timed without tracemalloc (it slows allocation heavy code unevenly), peak memory in a
+  # separate traced pass
+  start = time.perf_counter()
+  for _ in range(repeat):
+    result = fetch()
+  elapsed = (time.perf_counter() - start) / repeat
+  tracemalloc.start()
+  fetch()
+  (_, peak) = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return (len(result), elapsed, peak)
+
+def main():
+  rows = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+  with tempfile.TemporaryDirectory() as tmp:
+    db_file = os.path.join(tmp, 'bench.sqlite3')
+    populate(db_file, rows)
+    row_da = DataAccessor(db_file)
+    dict_da = DataAccessor(db_file, row_factory='dict')
+    cases = [
+      ("sqlite3.Row + convertRowsToDictList", lambda: row_da.convertRowsToDictList(row_da.get_transactions("acc1"))),
+      ("dict row factory", lambda: dict_da.get_transactions("acc1"))
+    ]
+    print("Fetching {} transactions for one account".format(rows))
+    for (name, fetch) in cases:
+      # Warm the page cache first
+      fetch()
+      (count, elapsed, peak) = measure(fetch)
+      print("  {:<38} {:>8} rows {:>8.1f} ms  peak {:>8.1f} MiB".format(name, count, elapsed * 1000, peak / 1048576.0))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,166 @@
+import argparse
+import bisect
+import itertools
+import math
+import random
+from datetime import date, timedelta
+
+from werkzeug.security import generate_password_hash
+
+from MoneyGeek.dao import DataAccessor, TUNED_PRAGMAS
+
+# Deterministic synthetic dataset: users with a few connections and accounts each, and a
+# realistic-ish stream of transactions per account (monthly salary and rent, weekday heavy
+# spending spread over the usual categories, a share left uncategorised for the mappings).
+# The same seed and sizes always produce the same database.
+#   python -m benchmarks.synthetic DB_FILE [--users N] [--accounts N] [--txns N] ...
+
+# category -> (relative frequency, median amount in cents, merchant names)
+SPENDING = {
+  'Groceries': (20, 4500, ('WHOLE FOODS', 'TRADER JOES', 'SAFEWAY', 'KROGER')),
+  'Coffee': (14, 450, ('STARBUCKS', 'BLUE BOTTLE', 'PEETS COFFEE')),
+  'Lunch': (12, 1200, ('CHIPOTLE', 'SWEETGREEN', 'PRET A MANGER')),
+  'Restaurants': (8, 5500, ('OPENTABLE', 'UBER EATS', 'DOORDASH')),
+  'Transportation': (10, 1800, ('UBER TRIP', 'LYFT RIDE', 'MTA METROCARD', 'SHELL OIL')),
+  'Amazon': (6, 3000, ('AMAZON MKTPLACE', 'AMZN DIGITAL')),
+  'Household': (4, 2500, ('TARGET', 'HOME DEPOT', 'IKEA')),
+  'Clothing': (3, 6000, ('UNIQLO', 'GAP', 'NORDSTROM')),
+  'Entertainment': (3, 2500, ('AMC THEATRES', 'TICKETMASTER', 'STEAM GAMES')),
+  'Pharmacy': (2, 1500, ('CVS PHARMACY', 'WALGREENS')),
+  'Gym': (1, 6000, ('EQUINOX', 'PLANET FITNESS')),
+  'Flights': (1, 35000, ('DELTA AIR', 'UNITED AIRLINES', 'JETBLUE')),
+  'Utilities': (1, 9000, ('CON EDISON', 'PG&E')),
+  'Mobile Phone': (1, 7000, ('VERIZON WIRELESS', 'T-MOBILE'))
+}
+UNCATEGORISED = 0.15      # Share of spending left for the mappings / users to categorise
+INSTITUTIONS = (('ins_1', 'Chase'), ('ins_2', 'Bank of America'), ('ins_3', 'Wells Fargo'), ('ins_4', 'Citi'))
+ACCOUNT_TYPES = (('Checking', 'depository', 'checking'), ('Credit Card', 'credit', 'credit card'),
+  ('Savings', 'depository', 'savings'))
+MAPPINGS = (('uber trip|lyft', 'Transportation'), ('starbucks|peets', 'Coffee'), ('whole foods|trader joe', 'Groceries'))
+
+def month_starts(start, months):
+  (year, month) = (start.year, start.month)
+  for _ in range(months):
+    yield date(year, month, 1)
+    (year, month) = (year + month // 12, month % 12 + 1)
+
+def days_in_month(first):
+  return ((first.replace(day=28) + timedelta(days=4)).replace(day=1) - first).days
+
+class Generator:
+
+  def __init__(self, da, seed=1):
+    self.da = da
+    self.random = random.Random(seed)
+    categories = dict((c['name'], c['categoryID']) for c in da.get_categories())
+    self.salary = categories['Salary']
+    self.rent = categories['Rent']
+    names = sorted(SPENDING)
+    self.spending = [(categories[name], SPENDING[name][1], SPENDING[name][2]) for name in names]
+    self.weights = list(itertools.accumulate(SPENDING[name][0] for name in names))
+
+  def lognormal_cents(self, median):
+    # Right skewed amounts around the category median
+    return max(1, int(median * math.exp(self.random.gauss(0, 0.6))))
+
+  def account_transactions(self, accountID, start, months, perMonth):
+    # add_transactions rows for one account, in date order
+    rnd = self.random
+    counter = 0
+    for first in month_starts(start, months):
+      days = days_in_month(first)
+      rows = []
+      if accountID.endswith('-0'):
+        # The first account of a user gets paid and pays the rent
+        rows.append((first.replace(day=1), 'ACME CORP PAYROLL', 500000 + rnd.randrange(0, 50000), self.salary))
+        rows.append((first.replace(day=15), 'ACME CORP PAYROLL', 500000 + rnd.randrange(0, 50000), self.salary))
+        rows.append((first.replace(day=3), 'PROPERTY MGMT RENT', -250000, self.rent))
+      for _ in range(max(0, int(rnd.gauss(perMonth, perMonth * 0.2)))):
+        day = first + timedelta(days=rnd.randrange(days))
+        # Weekends are quieter, some of their spending moves to the Friday before
+        if day.weekday() >= 5 and day.day > 2 and rnd.random() < 0.4:
+          day = day - timedelta(days=day.weekday() - 4)
+        (categoryID, median, merchants) = self.spending[bisect.bisect_right(self.weights, rnd.random() * self.weights[-1])]
+        if rnd.random() < UNCATEGORISED:
+          categoryID = None
+        name = "{} #{}".format(rnd.choice(merchants), rnd.randrange(1000, 9999))
+        rows.append((day, name, -self.lognormal_cents(median), categoryID))
+      rows.sort(key=lambda r: r[0])
+      for (day, name, cents, categoryID) in rows:
+        counter += 1
+        yield ("{}-t{}".format(accountID, counter), accountID, 'Synthetic', None, name,
+          "{:.2f}".format(cents / 100.0), day.isoformat(), categoryID)
+
+  def generate(self, users, accounts, perMonth, start, months, batch_size=20000, report=print):
+    # users x accounts accounts (spread over the institutions), perMonth spending transactions
+    # per account for months months from start
+    da = self.da
+    # Hashing is deliberately slow, every synthetic user shares the one password
+    password = generate_password_hash('synthetic')
+    firstUser = (da.db.execute("SELECT IFNULL(MAX(userID), 0) FROM user").fetchone()[0]) + 1
+    da.db.executemany("INSERT INTO user (userID, username, password, email) VALUES (?, ?, ?, ?)",
+      ((u, "user{}".format(u), password, "user{}@example.com".format(u)) for u in range(firstUser, firstUser + users)))
+    for (institutionID, name) in INSTITUTIONS:
+      da.db.execute("INSERT OR IGNORE INTO institution (institutionID, name) VALUES (?, ?)", (institutionID, name))
+    accountIDs = []
+    for u in range(firstUser, firstUser + users):
+      for a in range(accounts):
+        institutionID = INSTITUTIONS[(u + a) % len(INSTITUTIONS)][0]
+        connection = da.db.execute("SELECT connectionID FROM connection WHERE userID = ? AND institutionID = ?",
+          (u, institutionID)).fetchone()
+        if connection is None:
+          connectionID = da.db.execute("INSERT INTO connection (userID, institutionID, accessCode) VALUES (?, ?, ?)",
+            (u, institutionID, "access-{}-{}".format(u, institutionID))).lastrowid
+        else:
+          connectionID = connection[0]
+        (name, accountType, subType) = ACCOUNT_TYPES[a % len(ACCOUNT_TYPES)]
+        accountID = "acc{}-{}".format(u, a)
+        da.db.execute("INSERT INTO account (connectionID, accountID, lastFourID, name, officialName, accountType, "
+          + "accountSubType) VALUES (?, ?, ?, ?, ?, ?, ?)",
+          (connectionID, accountID, 1000 + (u * 7 + a) % 9000, name, name, accountType, subType))
+        accountIDs.append(accountID)
+      for (categoryID, median, _) in self.spending[:5]:
+        da.db.execute("INSERT INTO budget (userID, categoryID, budgetCents) VALUES (?, ?, ?)",
+          (u, categoryID, median * perMonth // 2))
+    da.conn.commit()
+    da.invalidate_ref_data()
+    for (pattern, category) in MAPPINGS:
+      da.add_mapping(pattern, da.get_category_info(category)['categoryID'])
+    total = 0
+    batch = []
+    for accountID in accountIDs:
+      batch.extend(self.account_transactions(accountID, start, months, perMonth))
+      if len(batch) >= batch_size:
+        total += da.add_transactions(batch)[0]
+        batch = []
+        report("INFO: {} transactions".format(total))
+    if batch:
+      total += da.add_transactions(batch)[0]
+    return (users, len(accountIDs), total)
+
+def create(db_file, users, accounts, perMonth, start, months, seed=1, report=print):
+  # Fresh database with the full schema, filled with a synthetic dataset
+  da = DataAccessor(db_file, pragmas=TUNED_PRAGMAS)
+  da.initialise_db('db/schema.sql')
+  da.initialise_db('db/categories.sql')
+  da.migrate('db/migrations')
+  result = Generator(da, seed).generate(users, accounts, perMonth, start, months, report=report)
+  da.close()
+  return result
+
+def main():
+  parser = argparse.ArgumentParser(description='Create a synthetic MoneyGeek database')
+  parser.add_argument('db_file')
+  parser.add_argument('--users', type=int, default=200)
+  parser.add_argument('--accounts', type=int, default=3, help='Accounts per user')
+  parser.add_argument('--txns', type=int, default=60, help='Spending transactions per account per month')
+  parser.add_argument('--start', default='2016-01-01', help='First month (YYYY-MM-DD)')
+  parser.add_argument('--months', type=int, default=36)
+  parser.add_argument('--seed', type=int, default=1)
+  args = parser.parse_args()
+  start = date(*[int(p) for p in args.start.split('-')])
+  (users, accounts, txns) = create(args.db_file, args.users, args.accounts, args.txns, start, args.months, args.seed)
+  print("Created {} users, {} accounts, {} transactions in {}".format(users, accounts, txns, args.db_file))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,5 @@
+-- Date range lookups per account (summaries, monthly transaction lists)
+CREATE INDEX IF NOT EXISTS txn_account_date ON txn (accountID, date);
+
+-- Accounts for a connection (every per user join)
+CREATE INDEX IF NOT EXISTS account_connection ON account (connectionID, accountID);
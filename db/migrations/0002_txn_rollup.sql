@@ -0,0 +1,62 @@
+-- Per account, month and category totals so the summary pages don't re-aggregate txn.
+-- Kept up to date by the triggers below; uncategorised transactions roll up under categoryID 0.
+-- Keyed by account rather than user so a txn never needs its connection to be maintained,
+-- summaries join the (small) connection and account tables to pick a user's rows.
+DROP TABLE IF EXISTS txn_rollup;
+
+CREATE TABLE txn_rollup (
+  accountID TEXT NOT NULL,
+  year INTEGER NOT NULL,
+  month INTEGER NOT NULL,
+  categoryID INTEGER NOT NULL,
+  total FLOAT NOT NULL,
+  count INTEGER NOT NULL,
+  PRIMARY KEY (accountID, year, month, categoryID)
+);
+
+INSERT INTO txn_rollup (accountID, year, month, categoryID, total, count)
+  SELECT accountID, CAST(strftime('%Y', date) AS INTEGER), CAST(strftime('%m', date) AS INTEGER),
+    IFNULL(categoryID, 0), SUM(amount), COUNT(*)
+  FROM txn GROUP BY 1, 2, 3, 4;
+
+CREATE TRIGGER txn_rollup_insert AFTER INSERT ON txn
+BEGIN
+  INSERT INTO txn_rollup (accountID, year, month, categoryID, total, count)
+    SELECT NEW.accountID, CAST(strftime('%Y', NEW.date) AS INTEGER), CAST(strftime('%m', NEW.date) AS INTEGER),
+      IFNULL(NEW.categoryID, 0), 0, 0
+    WHERE NOT EXISTS (SELECT 1 FROM txn_rollup WHERE accountID = NEW.accountID
+      AND year = CAST(strftime('%Y', NEW.date) AS INTEGER) AND month = CAST(strftime('%m', NEW.date) AS INTEGER)
+      AND categoryID = IFNULL(NEW.categoryID, 0));
+  UPDATE txn_rollup SET total = total + NEW.amount, count = count + 1
+    WHERE accountID = NEW.accountID AND year = CAST(strftime('%Y', NEW.date) AS INTEGER)
+      AND month = CAST(strftime('%m', NEW.date) AS INTEGER) AND categoryID = IFNULL(NEW.categoryID, 0);
+END;
+
+CREATE TRIGGER txn_rollup_delete AFTER DELETE ON txn
+BEGIN
+  UPDATE txn_rollup SET total = total - OLD.amount, count = count - 1
+    WHERE accountID = OLD.accountID AND year = CAST(strftime('%Y', OLD.date) AS INTEGER)
+      AND month = CAST(strftime('%m', OLD.date) AS INTEGER) AND categoryID = IFNULL(OLD.categoryID, 0);
+  DELETE FROM txn_rollup WHERE count <= 0 AND accountID = OLD.accountID
+    AND year = CAST(strftime('%Y', OLD.date) AS INTEGER) AND month = CAST(strftime('%m', OLD.date) AS INTEGER)
+    AND categoryID = IFNULL(OLD.categoryID, 0);
+END;
+
+CREATE TRIGGER txn_rollup_update AFTER UPDATE OF accountID, amount, date, categoryID ON txn
+BEGIN
+  UPDATE txn_rollup SET total = total - OLD.amount, count = count - 1
+    WHERE accountID = OLD.accountID AND year = CAST(strftime('%Y', OLD.date) AS INTEGER)
+      AND month = CAST(strftime('%m', OLD.date) AS INTEGER) AND categoryID = IFNULL(OLD.categoryID, 0);
+  DELETE FROM txn_rollup WHERE count <= 0 AND accountID = OLD.accountID
+    AND year = CAST(strftime('%Y', OLD.date) AS INTEGER) AND month = CAST(strftime('%m', OLD.date) AS INTEGER)
+    AND categoryID = IFNULL(OLD.categoryID, 0);
+  INSERT INTO txn_rollup (accountID, year, month, categoryID, total, count)
+    SELECT NEW.accountID, CAST(strftime('%Y', NEW.date) AS INTEGER), CAST(strftime('%m', NEW.date) AS INTEGER),
+      IFNULL(NEW.categoryID, 0), 0, 0
+    WHERE NOT EXISTS (SELECT 1 FROM txn_rollup WHERE accountID = NEW.accountID
+      AND year = CAST(strftime('%Y', NEW.date) AS INTEGER) AND month = CAST(strftime('%m', NEW.date) AS INTEGER)
+      AND categoryID = IFNULL(NEW.categoryID, 0));
+  UPDATE txn_rollup SET total = total + NEW.amount, count = count + 1
+    WHERE accountID = NEW.accountID AND year = CAST(strftime('%Y', NEW.date) AS INTEGER)
+      AND month = CAST(strftime('%m', NEW.date) AS INTEGER) AND categoryID = IFNULL(NEW.categoryID, 0);
+END;
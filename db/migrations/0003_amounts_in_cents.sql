@@ -0,0 +1,95 @@
+-- Amounts are stored as integer cents so sums are exact. The DAO converts to and from
+-- decimal amounts at its boundary. SQLite can't change a column's type in place, so txn,
+-- budget and txn_rollup are rebuilt (which drops their indexes and triggers, recreated below).
+
+CREATE TABLE txn_new (
+  transactionID TEXT NOT NULL,
+  accountID TEXT NOT NULL,
+  category TEXT NOT NULL,
+  subCategory TEXT NULL,
+  name TEXT NOT NULL,
+  amountCents INTEGER NOT NULL,
+  date DATE NOT NULL,
+  categoryID INTEGER NULL,
+  UNIQUE(transactionID, accountID) ON CONFLICT FAIL
+);
+
+INSERT INTO txn_new (rowid, transactionID, accountID, category, subCategory, name, amountCents, date, categoryID)
+  SELECT rowid, transactionID, accountID, category, subCategory, name, CAST(ROUND(amount * 100) AS INTEGER), date, categoryID
+  FROM txn;
+
+DROP TABLE txn;
+ALTER TABLE txn_new RENAME TO txn;
+
+CREATE INDEX txn_account_date ON txn (accountID, date);
+
+CREATE TABLE budget_new (
+  userID INTEGER NOT NULL,
+  categoryID INTEGER NOT NULL,
+  budgetCents INTEGER NOT NULL
+);
+
+INSERT INTO budget_new (userID, categoryID, budgetCents)
+  SELECT userID, categoryID, CAST(ROUND(budgetAmount * 100) AS INTEGER) FROM budget;
+
+DROP TABLE budget;
+ALTER TABLE budget_new RENAME TO budget;
+
+DROP TABLE txn_rollup;
+
+CREATE TABLE txn_rollup (
+  accountID TEXT NOT NULL,
+  year INTEGER NOT NULL,
+  month INTEGER NOT NULL,
+  categoryID INTEGER NOT NULL,
+  totalCents INTEGER NOT NULL,
+  count INTEGER NOT NULL,
+  PRIMARY KEY (accountID, year, month, categoryID)
+);
+
+INSERT INTO txn_rollup (accountID, year, month, categoryID, totalCents, count)
+  SELECT accountID, CAST(strftime('%Y', date) AS INTEGER), CAST(strftime('%m', date) AS INTEGER),
+    IFNULL(categoryID, 0), SUM(amountCents), COUNT(*)
+  FROM txn GROUP BY 1, 2, 3, 4;
+
+CREATE TRIGGER txn_rollup_insert AFTER INSERT ON txn
+BEGIN
+  INSERT INTO txn_rollup (accountID, year, month, categoryID, totalCents, count)
+    SELECT NEW.accountID, CAST(strftime('%Y', NEW.date) AS INTEGER), CAST(strftime('%m', NEW.date) AS INTEGER),
+      IFNULL(NEW.categoryID, 0), 0, 0
+    WHERE NOT EXISTS (SELECT 1 FROM txn_rollup WHERE accountID = NEW.accountID
+      AND year = CAST(strftime('%Y', NEW.date) AS INTEGER) AND month = CAST(strftime('%m', NEW.date) AS INTEGER)
+      AND categoryID = IFNULL(NEW.categoryID, 0));
+  UPDATE txn_rollup SET totalCents = totalCents + NEW.amountCents, count = count + 1
+    WHERE accountID = NEW.accountID AND year = CAST(strftime('%Y', NEW.date) AS INTEGER)
+      AND month = CAST(strftime('%m', NEW.date) AS INTEGER) AND categoryID = IFNULL(NEW.categoryID, 0);
+END;
+
+CREATE TRIGGER txn_rollup_delete AFTER DELETE ON txn
+BEGIN
+  UPDATE txn_rollup SET totalCents = totalCents - OLD.amountCents, count = count - 1
+    WHERE accountID = OLD.accountID AND year = CAST(strftime('%Y', OLD.date) AS INTEGER)
+      AND month = CAST(strftime('%m', OLD.date) AS INTEGER) AND categoryID = IFNULL(OLD.categoryID, 0);
+  DELETE FROM txn_rollup WHERE count <= 0 AND accountID = OLD.accountID
+    AND year = CAST(strftime('%Y', OLD.date) AS INTEGER) AND month = CAST(strftime('%m', OLD.date) AS INTEGER)
+    AND categoryID = IFNULL(OLD.categoryID, 0);
+END;
+
+CREATE TRIGGER txn_rollup_update AFTER UPDATE OF accountID, amountCents, date, categoryID ON txn
+BEGIN
+  UPDATE txn_rollup SET totalCents = totalCents - OLD.amountCents, count = count - 1
+    WHERE accountID = OLD.accountID AND year = CAST(strftime('%Y', OLD.date) AS INTEGER)
+      AND month = CAST(strftime('%m', OLD.date) AS INTEGER) AND categoryID = IFNULL(OLD.categoryID, 0);
+  DELETE FROM txn_rollup WHERE count <= 0 AND accountID = OLD.accountID
+    AND year = CAST(strftime('%Y', OLD.date) AS INTEGER) AND month = CAST(strftime('%m', OLD.date) AS INTEGER)
+    AND categoryID = IFNULL(OLD.categoryID, 0);
+  INSERT INTO txn_rollup (accountID, year, month, categoryID, totalCents, count)
+    SELECT NEW.accountID, CAST(strftime('%Y', NEW.date) AS INTEGER), CAST(strftime('%m', NEW.date) AS INTEGER),
+      IFNULL(NEW.categoryID, 0), 0, 0
+    WHERE NOT EXISTS (SELECT 1 FROM txn_rollup WHERE accountID = NEW.accountID
+      AND year = CAST(strftime('%Y', NEW.date) AS INTEGER) AND month = CAST(strftime('%m', NEW.date) AS INTEGER)
+      AND categoryID = IFNULL(NEW.categoryID, 0));
+  UPDATE txn_rollup SET totalCents = totalCents + NEW.amountCents, count = count + 1
+    WHERE accountID = NEW.accountID AND year = CAST(strftime('%Y', NEW.date) AS INTEGER)
+      AND month = CAST(strftime('%m', NEW.date) AS INTEGER) AND categoryID = IFNULL(NEW.categoryID, 0);
+END;
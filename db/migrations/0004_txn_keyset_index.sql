@@ -0,0 +1,4 @@
+-- Keyset pagination of an account's transactions in (date, transactionID) order. Covers the
+-- (accountID, date) lookups too, so it replaces txn_account_date
+CREATE INDEX IF NOT EXISTS txn_account_date_id ON txn (accountID, date, transactionID);
+DROP INDEX IF EXISTS txn_account_date;
@@ -0,0 +1,32 @@
+-- Full text index of transaction descriptions, reading its content from txn (external content)
+-- so the text is not stored twice. accountID is indexed too so a search can be narrowed to a
+-- user's accounts inside the index. Prefix indexes make "uber*" style lookups cheap.
+-- A migration that rebuilds txn must rebuild txn_search too ('rebuild' below).
+DROP TABLE IF EXISTS txn_search;
+
+CREATE VIRTUAL TABLE txn_search USING fts5(
+  name, category, subCategory, accountID,
+  content='txn', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+
+INSERT INTO txn_search (txn_search) VALUES ('rebuild');
+
+CREATE TRIGGER txn_search_insert AFTER INSERT ON txn
+BEGIN
+  INSERT INTO txn_search (rowid, name, category, subCategory, accountID)
+    VALUES (NEW.rowid, NEW.name, NEW.category, NEW.subCategory, NEW.accountID);
+END;
+
+CREATE TRIGGER txn_search_delete AFTER DELETE ON txn
+BEGIN
+  INSERT INTO txn_search (txn_search, rowid, name, category, subCategory, accountID)
+    VALUES ('delete', OLD.rowid, OLD.name, OLD.category, OLD.subCategory, OLD.accountID);
+END;
+
+CREATE TRIGGER txn_search_update AFTER UPDATE OF name, category, subCategory, accountID ON txn
+BEGIN
+  INSERT INTO txn_search (txn_search, rowid, name, category, subCategory, accountID)
+    VALUES ('delete', OLD.rowid, OLD.name, OLD.category, OLD.subCategory, OLD.accountID);
+  INSERT INTO txn_search (rowid, name, category, subCategory, accountID)
+    VALUES (NEW.rowid, NEW.name, NEW.category, NEW.subCategory, NEW.accountID);
+END;
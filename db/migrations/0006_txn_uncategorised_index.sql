@@ -0,0 +1,3 @@
+-- Only the transactions still waiting for a category, per account and date. Stays small as
+-- users categorise, and lets the "needs categorising" queue skip everything already done
+CREATE INDEX IF NOT EXISTS txn_uncategorised ON txn (accountID, date) WHERE categoryID IS NULL;
@@ -0,0 +1,24 @@
+-- One sync job per connection for the sync daemon (MoneyGeek/sync_daemon.py). A job is due once
+-- nextRunAt has passed; failures push nextRunAt out with exponential backoff and count up attempts.
+-- checkpointOffset/windowStart record how far a running sync got through its plaid window, so a
+-- job interrupted by an error or a restart picks up from its last stored page.
+-- Timestamps are UTC 'YYYY-MM-DD HH:MM:SS' text so they compare as strings.
+DROP TABLE IF EXISTS sync_job;
+
+CREATE TABLE sync_job (
+  connectionID INTEGER PRIMARY KEY NOT NULL,
+  status TEXT NOT NULL DEFAULT 'idle',
+  nextRunAt TEXT NOT NULL,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  lastError TEXT NULL,
+  startedAt TEXT NULL,
+  lastSuccessAt TEXT NULL,
+  windowStart DATE NULL,
+  checkpointOffset INTEGER NOT NULL DEFAULT 0
+);
+
+-- Due jobs that aren't already running
+CREATE INDEX sync_job_due ON sync_job (nextRunAt) WHERE status = 'idle';
+
+INSERT INTO sync_job (connectionID, nextRunAt)
+  SELECT connectionID, datetime('now') FROM connection;
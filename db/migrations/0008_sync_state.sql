@@ -0,0 +1,9 @@
+-- High-water marks for incremental syncs (pull_data.py, sync_daemon.py): the last sync date and
+-- the latest transaction date seen per connection. Created here rather than in schema.sql so
+-- databases initialised from the original baseline get it too; IF NOT EXISTS keeps the state of
+-- databases that already have the table.
+CREATE TABLE IF NOT EXISTS sync_state (
+  connectionID INTEGER PRIMARY KEY NOT NULL,
+  lastSyncDate DATE NULL,
+  lastTxnDate DATE NULL
+);
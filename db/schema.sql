@@ -1,3 +1,7 @@
+-- Baseline schema (version 0). Later changes live in db/migrations and are applied on top
+-- by DataAccessor.migrate (or `flask migrate-db`), which tracks progress in PRAGMA user_version.
+PRAGMA user_version = 0;
+
 DROP TABLE IF EXISTS user;
 DROP TABLE IF EXISTS connection;
 DROP TABLE IF EXISTS institution;
@@ -6,6 +10,11 @@ DROP TABLE IF EXISTS txn;
 DROP TABLE IF EXISTS category;
 DROP TABLE IF EXISTS mapping;
 DROP TABLE IF EXISTS budget;
+DROP TABLE IF EXISTS sync_state;
+-- Created by migrations, dropped here so re-initialising starts from a clean database
+DROP TABLE IF EXISTS txn_rollup;
+DROP TABLE IF EXISTS txn_search;
+DROP TABLE IF EXISTS sync_job;
 
 CREATE TABLE user (
   userID INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -65,4 +74,3 @@ CREATE TABLE budget (
   categoryID INTEGER NOT NULL,
   budgetAmount FLOAT NOT NULL
 );
-
@@ -0,0 +1,65 @@
+import os
+import unittest
+from MoneyGeek.moneygeek import create_app
+from MoneyGeek.flask_util import get_da, get_pool, get_sql_stats
+
+USER_QUERY = "SELECT userID, username, email FROM user WHERE userID = ?"
+
+class TestLoadLoggedInUser(unittest.TestCase):
+
+  def setUp(self):
+    self.app = create_app({'TESTING': True, 'DATABASE': 'instance/test_auth.sqlite3', 'SQL_STATS': True})
+    with self.app.app_context():
+      da = get_da()
+      da.initialise_db('db/schema.sql')
+      da.initialise_db('db/categories.sql')
+      da.migrate('db/migrations')
+      da.add_user("user", "pass", "email")
+    self.client = self.app.test_client()
+    with self.client.session_transaction() as session:
+      session['userID'] = 1
+
+  def user_queries(self):
+    with self.app.app_context():
+      return sum(s['executions'] for s in get_sql_stats().summary() if s['sql'] == USER_QUERY)
+
+  def test_user_read_once_per_session(self):
+    for _ in range(3):
+      response = self.client.get('/summary/monthly_summary')
+      self.assertIn(b'Monthly summary for user', response.data)
+    self.assertEqual(1, self.user_queries())
+    # Static files never look at the user
+    self.client.get('/static/style.css')
+    self.assertEqual(1, self.user_queries())
+    # A change to the user in this process forces a re-read
+    with self.app.app_context():
+      get_da().invalidate_ref_data(('user', 1))
+    self.client.get('/summary/monthly_summary')
+    self.client.get('/summary/monthly_summary')
+    self.assertEqual(2, self.user_queries())
+
+  def test_snapshot_expires(self):
+    self.client.get('/summary/monthly_summary')
+    with self.client.session_transaction() as session:
+      user = session['user']
+      user['checked'] -= self.app.config['USER_SNAPSHOT_TTL'] + 1
+      session['user'] = user
+    self.client.get('/summary/monthly_summary')
+    self.assertEqual(2, self.user_queries())
+
+  def test_unknown_user_logged_out(self):
+    with self.client.session_transaction() as session:
+      session['userID'] = 42
+    self.assertEqual(302, self.client.get('/summary/search').status_code)
+    with self.client.session_transaction() as session:
+      self.assertNotIn('userID', session)
+
+  def tearDown(self):
+    with self.app.app_context():
+      get_pool().close()
+    for suffix in ('', '-wal', '-shm'):
+      if os.path.exists('instance/test_auth.sqlite3' + suffix):
+        os.remove('instance/test_auth.sqlite3' + suffix)
+
+if __name__ == '__main__':
+  unittest.main()
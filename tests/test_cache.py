@@ -0,0 +1,45 @@
+import unittest
+from MoneyGeek.cache import LRUCache
+
+class FakeClock:
+
+  def __init__(self):
+    self.now = 0.0
+
+  def __call__(self):
+    return self.now
+
+class TestLRUCache(unittest.TestCase):
+
+  def setUp(self):
+    self.clock = FakeClock()
+    self.cache = LRUCache(maxsize=2, ttl=10, clock=self.clock)
+
+  def test_evicts_least_recently_used(self):
+    self.cache.set("a", 1)
+    self.cache.set("b", 2)
+    # Touch "a" so "b" is the oldest
+    self.assertEqual(1, self.cache.get("a"))
+    self.cache.set("c", 3)
+    self.assertEqual(None, self.cache.get("b"))
+    self.assertEqual(1, self.cache.get("a"))
+    self.assertEqual(3, self.cache.get("c"))
+
+  def test_expires(self):
+    self.cache.set("a", 1)
+    self.clock.now = 9.9
+    self.assertEqual(1, self.cache.get("a"))
+    self.clock.now = 10
+    self.assertEqual("gone", self.cache.get("a", "gone"))
+    self.assertEqual(0, len(self.cache))
+
+  def test_delete_and_clear(self):
+    self.cache.set("a", 1)
+    self.cache.set("b", 2)
+    self.cache.delete("a")
+    self.assertEqual(None, self.cache.get("a"))
+    self.cache.clear()
+    self.assertEqual(None, self.cache.get("b"))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,99 @@
+import os
+import unittest
+from MoneyGeek.dao import DataAccessor
+from MoneyGeek.categorise import Categoriser, check_pattern
+
+class TestCategoriser(unittest.TestCase):
+
+  def setUp(self):
+    self.da = DataAccessor('instance/test.sqlite3')
+    self.da.initialise_db('db/schema.sql')
+    self.da.initialise_db('db/categories.sql')
+    self.da.migrate('db/migrations')
+    self.groceries = self.da.get_category_info("Groceries")["categoryID"]
+    self.restaurants = self.da.get_category_info("Restaurants")["categoryID"]
+    self.transport = self.da.get_category_info("Transportation")["categoryID"]
+    self.da.add_mapping("uber", self.transport)
+    self.da.add_mapping("uber eats", self.restaurants)
+    self.da.add_mapping(r"whole\s*foods|trader (joe)'?s", self.groceries)
+    self.categoriser = Categoriser(self.da)
+
+  def test_match(self):
+    self.categoriser.refresh()
+    self.assertEqual(self.transport, self.categoriser.match("UBER *TRIP 1234"))
+    # The longer, more specific pattern wins
+    self.assertEqual(self.restaurants, self.categoriser.match("Uber Eats order"))
+    # Groups inside a pattern don't confuse the lookup
+    self.assertEqual(self.groceries, self.categoriser.match("TRADER JOES #552"))
+    self.assertEqual(self.groceries, self.categoriser.match("WholeFoods Market"))
+    self.assertEqual(None, self.categoriser.match("Netflix"))
+
+  def test_recompiles_only_on_change(self):
+    self.categoriser.refresh()
+    regex = self.categoriser.regex
+    self.categoriser.refresh()
+    self.assertIs(regex, self.categoriser.regex)
+    self.da.add_mapping("netflix", 1)
+    self.categoriser.refresh()
+    self.assertEqual(1, self.categoriser.match("NETFLIX.COM"))
+    with self.assertRaises(ValueError):
+      self.da.add_mapping("unbalanced(", 1)
+
+  def test_mappings_from_other_connections(self):
+    # Mappings written elsewhere are picked up once the ttl runs out
+    self.categoriser.refresh()
+    other = DataAccessor('instance/test.sqlite3')
+    other.db.execute("INSERT INTO mapping (pattern, categoryID) VALUES ('netflix', 1)")
+    other.conn.commit()
+    other.close()
+    self.categoriser.refresh()
+    self.assertEqual(None, self.categoriser.match("NETFLIX.COM"))
+    self.categoriser.ttl = 0
+    self.categoriser.refresh()
+    self.assertEqual(1, self.categoriser.match("NETFLIX.COM"))
+    regex = self.categoriser.regex
+    self.categoriser.refresh()
+    self.assertIs(regex, self.categoriser.regex)
+
+  def test_uncombinable_patterns(self):
+    # Inline flags, named groups and group references would break the combined regex
+    for pattern in ("(?i)netflix", "(?P<shop>amazon)", r"(ab)\1", "(?P<a>x)(?P=a)", "(a)?(?(1)b|c)", "unbalanced("):
+      with self.assertRaises(ValueError):
+        check_pattern(pattern)
+    # Scoped flags, lookarounds and escaped backslashes are fine
+    for pattern in ("(?i:spotify)", "(?:apple|itunes)(?!\\s*store)", r"c:\\1"):
+      check_pattern(pattern)
+    # Ones in the table (the DAO only checks they compile) are skipped rather than breaking the rest
+    for pattern in ("(?i)netflix", "(?P<x>a)", "(?P<x>b)"):
+      self.da.add_mapping(pattern, 1)
+    self.categoriser.refresh()
+    self.assertEqual(self.transport, self.categoriser.match("UBER TRIP"))
+    self.assertEqual(None, self.categoriser.match("netflix"))
+
+  def test_categorise_on_ingest(self):
+    rows = [
+      ("id1", "acc", "Travel", None, "UBER TRIP", 10, "2018-01-01", None),
+      ("id2", "acc", "Food", None, "Whole Foods", 20, "2018-01-02", None),
+      ("id3", "acc", "Food", None, "Whole Foods", 30, "2018-01-03", self.restaurants),
+      ("id4", "acc", "Misc", None, "Unknown shop", 40, "2018-01-04", None)
+    ]
+    self.da.add_transactions(self.categoriser.categorise(rows))
+    categories = [row["categoryID"] for row in self.da.get_transactions("acc")]
+    self.assertEqual([self.transport, self.groceries, self.restaurants, None], categories)
+
+  def test_backfill(self):
+    rows = [("id{}".format(i), "acc", "Misc", None, name, 1, "2018-01-01", None)
+      for (i, name) in enumerate(["UBER", "uber eats", "Corner shop", "whole foods", "Cinema"])]
+    self.da.add_transactions(rows)
+    (examined, categorised) = self.categoriser.backfill(batch_size=2)
+    self.assertEqual(5, examined)
+    self.assertEqual(3, categorised)
+    # Everything left over is genuinely unmatched
+    self.assertEqual((2, 0), self.categoriser.backfill(batch_size=2))
+
+  def tearDown(self):
+    self.da.close()
+    os.remove('instance/test.sqlite3')
+
+if __name__ == '__main__':
+  unittest.main()
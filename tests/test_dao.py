@@ -1,7 +1,8 @@
 import os
 import sqlite3
 import unittest
-from MoneyGeek.dao import DataAccessor
+from MoneyGeek import dao
+from MoneyGeek.dao import DataAccessor, QueryStats, to_cents
 
 class TestDataAccessor(unittest.TestCase):
 
@@ -9,6 +10,16 @@ class TestDataAccessor(unittest.TestCase):
     self.da = DataAccessor('instance/test.sqlite3')
     self.da.initialise_db('db/schema.sql')
     self.da.initialise_db('db/categories.sql')
+    self.da.migrate('db/migrations')
+
+  def query_plan(self, query, *args):
+    # EXPLAIN QUERY PLAN of the last statement a DataAccessor query method executed
+    statements = []
+    self.da.conn.set_trace_callback(statements.append)
+    query(*args)
+    self.da.conn.set_trace_callback(None)
+    plan = self.da.db.execute("EXPLAIN QUERY PLAN " + statements[-1]).fetchall()
+    return [row["detail"] for row in plan]
 
   def test_add_user(self):
     user = "testUser"
@@ -94,12 +105,110 @@ class TestDataAccessor(unittest.TestCase):
     except sqlite3.IntegrityError:
       self.assertTrue(True)
 
+  def test_add_transactions(self):
+    accountID = "account1"
+    rows = [
+      ("txn1", accountID, "test", "subtest", "purchase 1", 100, "2018-01-13", None),
+      ("txn2", accountID, "test", None, "purchase 2", 25.5, "2018-01-14", 1),
+      ("txn3", accountID, "test", None, "purchase 3", -10, "2018-02-01", None)
+    ]
+    (inserted, duplicates) = self.da.add_transactions(rows)
+    self.assertEqual(3, inserted)
+    self.assertEqual(0, duplicates)
+    # Re-adding overlapping rows (from a generator) skips the existing ones
+    more = rows[1:] + [("txn4", accountID, "test", None, "purchase 4", 7, "2018-02-02", None)]
+    (inserted, duplicates) = self.da.add_transactions(r for r in more)
+    self.assertEqual(1, inserted)
+    self.assertEqual(2, duplicates)
+    self.assertEqual(4, len(self.da.get_transactions(accountID)))
+
+  def test_sync_state(self):
+    connectionID = 1
+    self.assertEqual(None, self.da.get_sync_state(connectionID))
+    self.da.update_sync_state(connectionID, "2018-01-20", "2018-01-18")
+    state = self.da.get_sync_state(connectionID)
+    self.assertEqual("2018-01-20", state["lastSyncDate"])
+    self.assertEqual("2018-01-18", state["lastTxnDate"])
+    self.da.update_sync_state(connectionID, "2018-01-21", "2018-01-21")
+    self.assertEqual("2018-01-21", self.da.get_sync_state(connectionID)["lastTxnDate"])
+
+  def test_sync_jobs(self):
+    self.da.add_user("user", "pass", "email")
+    for institutionID in ("inst1", "inst2", "inst3"):
+      self.da.add_institution(institutionID, institutionID)
+      self.da.add_connection(1, institutionID, "token-" + institutionID)
+    self.assertEqual(3, self.da.ensure_sync_jobs("2018-01-01 00:00:00"))
+    self.assertEqual(0, self.da.ensure_sync_jobs("2018-01-01 00:00:00"))
+    self.da.complete_sync_job(1, "2018-01-01 10:00:00", "2018-01-01 11:00:00")
+    self.da.complete_sync_job(2, "2018-01-01 09:00:00", "2018-01-01 11:00:00")
+    # Nothing due yet but the never synced connection
+    self.assertEqual([3], [j["connectionID"] for j in self.da.claim_sync_jobs("2018-01-01 10:30:00", 5)])
+    self.assertEqual([], self.da.claim_sync_jobs("2018-01-01 10:30:00", 5))
+    # Stalest first, and never more than asked for
+    self.assertEqual([2], [j["connectionID"] for j in self.da.claim_sync_jobs("2018-01-01 11:00:00", 1)])
+    # A failure keeps the checkpoint and counts the attempt
+    self.da.checkpoint_sync_job(2, "2017-01-01", 500)
+    self.da.fail_sync_job(2, "timeout", "2018-01-01 11:05:00")
+    self.da.fail_sync_job(3, "timeout", "2018-01-01 12:00:00")
+    job = self.da.claim_sync_jobs("2018-01-01 11:05:00", 5)[0]
+    self.assertEqual((2, 1, "2017-01-01", 500), (job["connectionID"], job["attempts"], job["windowStart"],
+      job["checkpointOffset"]))
+    # Jobs a stopped daemon left running are due again, once they have been running for long enough
+    self.assertEqual(0, self.da.release_sync_jobs("2018-01-01 11:05:00"))
+    self.assertEqual(2, self.da.release_sync_jobs("2018-01-01 11:05:01"))
+    self.assertEqual({"idle"}, {j["status"] for j in self.da.get_sync_jobs()})
+    self.da.complete_sync_job(2, "2018-01-01 11:10:00", "2018-01-01 12:10:00")
+    job = [j for j in self.da.get_sync_jobs() if j["connectionID"] == 2][0]
+    self.assertEqual((0, None, None, 0), (job["attempts"], job["lastError"], job["windowStart"], job["checkpointOffset"]))
+
   def test_get_category_info(self):
     row = self.da.get_category_info("Groceries")
     self.assertEqual(1, row["categoryID"])
     row = self.da.get_category_info("invalid_category")
     self.assertEqual(None, row)
 
+  def test_reference_data_cache(self):
+    statements = []
+    self.da.conn.set_trace_callback(statements.append)
+    # Loaded once, then served without queries
+    self.assertEqual(1, self.da.get_category_info("groceries")["categoryID"])
+    self.assertEqual("Groceries", self.da.get_category_by_id(1)["name"])
+    categories = len(self.da.get_categories())
+    self.assertEqual(1, len(statements))
+    # Writes invalidate the relevant snapshot
+    self.da.add_category("New-Category")
+    self.assertEqual(categories + 1, len(self.da.get_categories()))
+    self.assertEqual("New-Category", self.da.get_category_info("NEW-category")["name"])
+    self.da.add_institution("inst1", "First Bank")
+    self.assertEqual("inst1", self.da.get_institution_by_name("first bank")["institutionID"])
+    self.assertEqual(None, self.da.get_budget_info(1, 1))
+    self.da.upsert_budget(1, 1, 25)
+    self.assertEqual(25, self.da.get_budget_info(1, 1)["budgetAmount"])
+    self.da.upsert_budget(1, 1, 30)
+    self.assertEqual(30, self.da.get_budget(1)[0]["budgetAmount"])
+    self.assertEqual([], self.da.get_budget(2))
+    self.da.conn.set_trace_callback(None)
+
+  def test_reference_data_not_shared_mutably(self):
+    # Callers get copies, changing one doesn't reach the snapshot everyone else reads
+    self.da.get_category_info("groceries")["name"] = "Changed"
+    self.da.get_categories()[0]["name"] = "Changed"
+    self.assertEqual("Groceries", self.da.get_category_by_id(1)["name"])
+    with self.assertRaises(TypeError):
+      self.da.get_category_index().byID[1]["name"] = "Changed"
+
+  def test_reference_data_bounded(self):
+    entries = dao.REF_DATA_ENTRIES
+    dao.REF_DATA_ENTRIES = 5
+    try:
+      for userID in range(20):
+        self.da.get_budget(userID)
+      self.assertEqual(5, len(dao._ref_data))
+      # The most recently used ones are kept
+      self.assertIn((self.da.db_file, ('budget', 19)), dao._ref_data)
+    finally:
+      dao.REF_DATA_ENTRIES = entries
+
   def test_get_summary(self):
     # Setup!
     user = "testUser"
@@ -121,6 +230,25 @@ class TestDataAccessor(unittest.TestCase):
     summary = self.da.get_summary(userID)
     self.assertEqual(3, len(summary))
 
+  def test_iter_transactions(self):
+    self.da.add_user("testUser", "testPass", "testEmail")
+    self.da.add_institution("inst1", "institution 1")
+    self.da.add_connection(1, "inst1", "abcd")
+    self.da.add_account(1, "acc1", 1234, "account 1", "official 1", "Test1", "TestSub1")
+    self.da.add_account(1, "acc2", 5678, "account 2", "official 2", "Test2", "TestSub2")
+    self.da.add_transactions(
+      [("a{}".format(i), "acc1", "cat", None, "txn", i, "2018-01-{:02d}".format(i + 1), None) for i in range(7)]
+      + [("b1", "acc2", "cat", None, "txn", 1, "2018-02-01", 1), ("c1", "unowned", "cat", None, "txn", 1, "2018-02-01", 1)]
+    )
+    rows = list(self.da.iter_transactions(1, batch_size=3))
+    self.assertEqual(8, len(rows))
+    self.assertEqual(["a{}".format(i) for i in range(7)], [r["transactionID"] for r in rows[:7]])
+    self.assertEqual("Groceries", rows[7]["userCategory"])
+    rows = list(self.da.iter_transactions(1, "acc1", "2018-01-03", "2018-01-05"))
+    self.assertEqual(["a2", "a3"], [r["transactionID"] for r in rows])
+    self.assertEqual("account 1", rows[0]["account"])
+    self.assertEqual([], list(self.da.iter_transactions(2)))
+
   def test_get_monthly_summary(self):
     # Setup!
     user = "testUser"
@@ -150,8 +278,215 @@ class TestDataAccessor(unittest.TestCase):
     self.assertEqual(3, len(summary))
     summary = self.da.get_monthly_summary(userID, '2018', '02')
     self.assertEqual(1, len(summary))
+    # Unpadded months work too
+    summary = self.da.get_monthly_summary(userID, '2018', '2')
+    self.assertEqual(-10, summary[0]["total"])
+
+  def test_update_categories(self):
+    accountID = "account1"
+    self.da.add_transactions([
+      ("id1", accountID, "cat", None, "txn-1", 1, "2018-01-01", None),
+      ("id2", accountID, "cat", None, "txn-2", 2, "2018-01-02", 1),
+      ("id3", accountID, "cat", None, "txn-3", 3, "2018-01-03", 2),
+      ("id1", "other", "cat", None, "txn-1", 4, "2018-01-03", None)
+    ])
+    # id2 is unchanged and "missing" doesn't exist, so only two rows change
+    updated = self.da.update_categories(accountID, [("id1", 3), ("id2", 1), ("id3", None), ("missing", 1)])
+    self.assertEqual(2, updated)
+    categories = dict((row["transactionID"], row["categoryID"]) for row in self.da.get_transactions(accountID))
+    self.assertEqual({"id1": 3, "id2": 1, "id3": None}, categories)
+    # Other accounts are untouched
+    self.assertEqual(None, self.da.get_transactions("other")[0]["categoryID"])
+
+  def get_rollup(self):
+    res = self.da.db.execute(
+      "SELECT accountID, year, month, categoryID, totalCents, count FROM txn_rollup ORDER BY 1, 2, 3, 4"
+    )
+    return [tuple(row) for row in res.fetchall()]
+
+  def test_rollup_maintained(self):
+    accountID = "account1"
+    self.da.add_transaction("id1", accountID, "no cat", None, "txn-1", 100, "2018-01-15", None)
+    self.da.add_transactions([
+      ("id2", accountID, "no cat", None, "txn-2", 150, "2018-01-16", 1),
+      ("id3", accountID, "no cat", None, "txn-3", -100, "2018-01-17", 1),
+      ("id4", accountID, "no cat", None, "txn-4", 3, "2018-02-18", 2),
+      ("id1", accountID, "no cat", None, "duplicate", 999, "2018-01-15", None)
+    ])
+    self.assertEqual([
+      (accountID, 2018, 1, 0, 10000, 1),
+      (accountID, 2018, 1, 1, 5000, 2),
+      (accountID, 2018, 2, 2, 300, 1)
+    ], self.get_rollup())
+    # Moving transactions between categories moves their totals, emptied groups disappear
+    self.da.update_category(accountID, "id1", 2)
+    self.da.update_category(accountID, "id4", None)
+    self.assertEqual([
+      (accountID, 2018, 1, 1, 5000, 2),
+      (accountID, 2018, 1, 2, 10000, 1),
+      (accountID, 2018, 2, 0, 300, 1)
+    ], self.get_rollup())
+    # Rebuilding from scratch agrees with the incremental version
+    incremental = self.get_rollup()
+    self.da.rebuild_rollup()
+    self.assertEqual(incremental, self.get_rollup())
+
+  def test_amounts_stored_in_cents(self):
+    accountID = "account1"
+    self.da.add_transaction("id1", accountID, "cat", None, "txn-1", 0.1, "2018-01-15", 1)
+    self.da.add_transactions([
+      ("id2", accountID, "cat", None, "txn-2", "0.2", "2018-01-16", 1),
+      ("id3", accountID, "cat", None, "txn-3", -19.99, "2018-01-17", 1)
+    ])
+    cents = [row[0] for row in self.da.db.execute("SELECT amountCents FROM txn ORDER BY transactionID").fetchall()]
+    self.assertEqual([10, 20, -1999], cents)
+    amounts = [row["amount"] for row in self.da.get_transactions(accountID)]
+    self.assertEqual(sorted([0.1, 0.2, -19.99]), sorted(amounts))
+    self.da.upsert_budget(1, 1, "12.345")
+    self.assertEqual(1235, self.da.get_budget(1)[0]["budgetCents"])
+    with self.assertRaises(ValueError):
+      self.da.upsert_budget(1, 1, "")
+    for amount in ("Infinity", "-inf", "NaN", "sNaN", "1e400", float("inf")):
+      with self.assertRaises(ValueError):
+        to_cents(amount)
+    with self.assertRaises(ValueError):
+      self.da.upsert_budget(1, 1, "1e400")
+
+  def test_get_transaction_page(self):
+    accountID = "account1"
+    # Same day transactions are ordered by ID, other months are left out
+    self.da.add_transactions([
+      ("id{}".format(i), accountID, "cat", None, "txn-{}".format(i), i, "2018-01-{:02d}".format(10 + i // 2), None)
+      for i in range(7)
+    ] + [("id9", accountID, "cat", None, "txn-9", 9, "2018-02-01", None)])
+    (start, end) = ("2018-01-01", "2018-02-01")
+    seen = []
+    after = None
+    while True:
+      (rows, after) = self.da.get_transaction_page(accountID, start, end, after, 3)
+      seen.append([row["transactionID"] for row in rows])
+      if after is None:
+        break
+    self.assertEqual([["id0", "id1", "id2"], ["id3", "id4", "id5"], ["id6"]], seen)
+    # Later pages seek on the key rather than skipping earlier rows
+    plan = self.query_plan(self.da.get_transaction_page, accountID, start, end, ("2018-01-11", "id3"), 3)
+    self.assertIn("SEARCH t USING INDEX txn_account_date_id (accountID=? AND (date,transactionID)>(?,?) AND date<?)", plan)
+
+  def test_search_transactions(self):
+    self.da.add_user("testUser", "testPass", "testEmail")
+    self.da.add_institution("inst1", "institution 1")
+    self.da.add_connection(1, "inst1", "abcd")
+    self.da.add_account(1, "acc1", 1234, "account 1", "official 1", "Test", "Sub")
+    self.da.add_account(1, "acc2", 5678, "account 2", "official 2", "Test", "Sub")
+    self.da.add_transactions([
+      ("id1", "acc1", "Travel", "Taxi", "UBER *TRIP", -12.5, "2018-01-15", None),
+      ("id2", "acc2", "Food", None, "Uber Eats", -30, "2018-02-15", None),
+      ("id3", "acc1", "Food", None, "Corner shop", -3, "2018-02-16", None),
+      # Someone else's account
+      ("id4", "acc3", "Travel", None, "UBER TRIP", -9, "2018-01-15", None)
+    ])
+    found = lambda *args: sorted(r["transactionID"] for r in self.da.search_transactions(1, *args))
+    self.assertEqual(["id1", "id2"], found("uber"))
+    self.assertEqual(["id1"], found("ube trip"))
+    self.assertEqual(["id2"], found("uber", "2018-02-01"))
+    self.assertEqual(["id2"], found("uber", None, None, -5000, -2000))
+    self.assertEqual(["id1"], found("taxi"))
+    # FTS5 syntax is taken literally, nothing at all matches nothing
+    self.assertEqual([], found('"eats OR (shop'))
+    self.assertEqual([], found(" "))
+    # The index follows updates and deletes
+    self.da.db.execute("UPDATE txn SET name = 'Lyft' WHERE transactionID = 'id1'")
+    self.da.db.execute("DELETE FROM txn WHERE transactionID = 'id2'")
+    self.assertEqual([], found("uber"))
+    self.assertEqual("account 1", self.da.search_transactions(1, "lyft")[0]["account"])
+
+  def test_search_scoped_to_user(self):
+    # "chk" as an FTS phrase also matches the other user's "chk-savings"
+    self.da.add_institution("inst1", "institution 1")
+    for (userID, accountID) in ((1, "chk"), (2, "chk-savings")):
+      self.da.add_user("user{}".format(userID), "pass", "email{}".format(userID))
+      self.da.add_connection(userID, "inst1", "token{}".format(userID))
+      self.da.add_account(userID, accountID, 1234, "account", "official", "Test", "Sub")
+      self.da.add_transactions([(accountID + "-1", accountID, "Food", None, "STARBUCKS", -4.5, "2018-01-05", None)])
+    self.assertEqual(["chk-1"], [r["transactionID"] for r in self.da.search_transactions(1, "starbucks")])
+    self.assertEqual(["chk-savings-1"], [r["transactionID"] for r in self.da.search_transactions(2, "starbucks")])
+
+  def test_find_uncategorised_accounts(self):
+    self.da.add_user("testUser", "testPass", "testEmail")
+    self.da.add_institution("inst1", "institution 1")
+    self.da.add_connection(1, "inst1", "abcd")
+    self.da.add_account(1, "acc1", 1234, "account 1", "official 1", "Test", "Sub")
+    self.da.add_transactions([
+      ("id1", "acc1", "cat", None, "txn-1", 1, "2018-01-15", None),
+      ("id2", "acc1", "cat", None, "txn-2", 1, "2018-01-16", None),
+      ("id3", "acc1", "cat", None, "txn-3", 1, "2018-02-16", None),
+      ("id4", "acc1", "cat", None, "txn-4", 1, "2018-03-16", 1),
+      ("id5", "acc2", "cat", None, "txn-5", 1, "2018-03-16", None)
+    ])
+    pending = [(r["accountID"], r["year"], r["month"], r["pending"]) for r in self.da.find_uncategorised_accounts(1)]
+    self.assertEqual([("acc1", "2018", "02", 1), ("acc1", "2018", "01", 2)], pending)
+    self.da.update_categories("acc1", [("id3", 1)])
+    self.assertEqual(1, len(self.da.find_uncategorised_accounts(1)))
+    plan = self.query_plan(self.da.find_uncategorised_accounts, 1)
+    self.assertIn("SEARCH t USING INDEX txn_uncategorised (accountID=?)", plan)
+
+  def test_dict_row_factory(self):
+    self.da.add_transaction("id1", "account1", "cat", None, "txn-1", 1.5, "2018-01-15", 1)
+    da = DataAccessor('instance/test.sqlite3', row_factory='dict')
+    rows = da.get_transactions("account1")
+    self.assertEqual("txn-1", rows[0]["name"])
+    self.assertEqual(rows, da.convertRowsToDictList(rows))
+    # A different result set on the same connection gets its own column names
+    self.assertEqual({"one": 1, "two": 2}, da.db.execute("SELECT 1 AS one, 2 AS two").fetchone())
+    self.assertEqual(1.5, da.get_transactions("account1")[0]["amount"])
+    da.close()
+    with self.assertRaises(ValueError):
+      DataAccessor('instance/test.sqlite3', row_factory='namedtuple')
+
+  def test_query_stats(self):
+    slow = []
+    stats = QueryStats(slow_ms=0, log=slow.append)
+    da = DataAccessor('instance/test.sqlite3', stats=stats)
+    da.add_transactions([("id{}".format(i), "account1", "cat", None, "txn", i, "2018-01-15", None) for i in range(5)])
+    self.assertEqual(5, len(da.get_transactions("account1")))
+    self.assertEqual(5, len(da.get_transactions("account1")))
+    statements = dict((s['sql'].split(' ')[0], s) for s in stats.summary())
+    # Executions and fetched rows add up per statement
+    self.assertEqual((2, 10), (statements['SELECT']['executions'], statements['SELECT']['rows']))
+    self.assertEqual(1, statements['INSERT']['executions'])
+    # With a 0ms threshold everything is logged, queries along with their plan
+    self.assertTrue(any("SEARCH t USING INDEX txn_account_date_id" in line for line in slow))
+    stats.reset()
+    self.assertEqual([], stats.summary())
+    da.close()
+
+  def test_migrate(self):
+    migrations = self.da.get_migrations('db/migrations')
+    self.assertEqual(migrations[-1][0], self.da.get_schema_version())
+    # Re-running is a no-op
+    self.assertEqual([], self.da.migrate('db/migrations'))
+    # Re-initialising a migrated database starts over
+    self.da.initialise_db('db/schema.sql')
+    self.assertEqual([m[0] for m in migrations], self.da.migrate('db/migrations'))
+    # Databases that got sync_state from an earlier schema.sql keep their state
+    self.da.update_sync_state(1, "2018-01-20", "2018-01-18")
+    self.da.db.execute("PRAGMA user_version = 7")
+    self.assertEqual([8], self.da.migrate('db/migrations'))
+    self.assertEqual("2018-01-18", self.da.get_sync_state(1)["lastTxnDate"])
+
+  def test_date_queries_use_indexes(self):
+    plan = self.query_plan(self.da.get_transactions_for_month, "account1", "2018", "1")
+    self.assertIn("SEARCH t USING INDEX txn_account_date_id (accountID=? AND date>? AND date<?)", plan)
+    plan = self.query_plan(self.da.get_monthly_summary, 1, "2018", "01")
+    self.assertIn("SEARCH a USING COVERING INDEX account_connection (connectionID=?)", plan)
+    self.assertIn("SEARCH r USING INDEX sqlite_autoindex_txn_rollup_1 (accountID=? AND year=? AND month=?)", plan)
+    plan = self.query_plan(self.da.get_annual_summary, 1, "2018")
+    self.assertIn("SEARCH r USING INDEX sqlite_autoindex_txn_rollup_1 (accountID=? AND year>? AND year<?)", plan)
+    plan = self.query_plan(self.da.get_available_dates, "account1")
+    self.assertIn("SEARCH t USING COVERING INDEX txn_account_date_id (accountID=?)", plan)
 
   def tearDown(self):
+    self.da.close()
     os.remove('instance/test.sqlite3')
     #pass
 
@@ -0,0 +1,38 @@
+import csv
+import io
+import json
+import unittest
+from MoneyGeek.export import COLUMNS, csv_lines, format_cents, ndjson_lines
+
+def make_row(transactionID, amountCents):
+  row = dict((column, None) for column in COLUMNS)
+  row.update({'transactionID': transactionID, 'accountID': 'acc1', 'name': 'shop, "the" one', 'amountCents': amountCents})
+  return row
+
+class TestExport(unittest.TestCase):
+
+  def test_format_cents(self):
+    self.assertEqual("0.05", format_cents(5))
+    self.assertEqual("-19.99", format_cents(-1999))
+    self.assertEqual("1234.00", format_cents(123400))
+
+  def test_csv(self):
+    rows = [make_row("t1", 1050), make_row("t2", -3)]
+    lines = list(csv_lines(iter(rows)))
+    # One line per row, the header rides along with the first one
+    self.assertEqual(2, len(lines))
+    parsed = list(csv.DictReader(io.StringIO("".join(lines))))
+    self.assertEqual(["10.50", "-0.03"], [r['amount'] for r in parsed])
+    self.assertEqual('shop, "the" one', parsed[0]['name'])
+    self.assertEqual(list(COLUMNS), list(parsed[0].keys()))
+
+  def test_csv_empty(self):
+    self.assertEqual([",".join(COLUMNS) + "\r\n"], list(csv_lines(iter([]))))
+
+  def test_ndjson(self):
+    lines = list(ndjson_lines(iter([make_row("t1", 1050)])))
+    self.assertEqual("10.50", json.loads(lines[0])['amount'])
+    self.assertTrue(lines[0].endswith("\n"))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,81 @@
+import os
+import unittest
+from datetime import date
+from MoneyGeek import plaid_dao as PDA
+from MoneyGeek.fake_plaid import FakeClient, RecordingClient, ReplayClient, PlaidError, RateLimitExceededError
+
+RECORDING = 'instance/test_plaid.jsonl'
+
+class TestFakePlaid(unittest.TestCase):
+
+  def setUp(self):
+    self.sleeps = []
+    self.today = date.today()
+
+  def client(self, **options):
+    return FakeClient(sleep=self.sleeps.append, today=self.today, **options)
+
+  def test_deterministic_pages(self):
+    client = self.client(accounts=3, per_day=4)
+    txns = list(PDA.iter_transactions(client, "token", 60, 0, page_size=50))
+    total = client.Transactions.get("token", "2000-01-01", "2100-01-01", count=1)["total_transactions"]
+    self.assertGreater(len(txns), 100)
+    self.assertEqual(len(txns), len(set(t["transaction_id"] for t in txns)))
+    self.assertEqual(sorted((t["date"] for t in txns), reverse=True), [t["date"] for t in txns])
+    self.assertEqual({"token-acc0", "token-acc1", "token-acc2"}, set(t["account_id"] for t in txns))
+    self.assertTrue(any(t["pending"] for t in txns))
+    # Same seed, same data. Overlapping windows give the same transactions
+    again = list(PDA.iter_transactions(self.client(accounts=3, per_day=4), "token", 30, 0, page_size=500))
+    self.assertEqual(txns[:len(again)], again)
+    self.assertNotEqual(txns, list(PDA.iter_transactions(self.client(accounts=3, per_day=4, seed=2), "token", 60, 0)))
+    self.assertGreaterEqual(total, len(txns))
+    # Rows plaid_dao can store
+    self.assertEqual(8, len(PDA.to_row(txns[0])))
+
+  def test_accounts_and_institutions(self):
+    client = self.client(accounts=2, institutions=30)
+    accounts = PDA.get_accounts(client, "token")
+    self.assertEqual(["token-acc0", "token-acc1"], [a["account_id"] for a in accounts])
+    self.assertEqual(accounts, PDA.get_accounts(self.client(accounts=2), "token"))
+    found = client.Institutions.search("chase")["institutions"]
+    self.assertEqual(["Chase", "Chase 2", "Chase 3"], [i["name"] for i in found])
+
+  def test_latency_and_faults(self):
+    client = self.client(latency=0.25, rate_limit_every=3)
+    client.Accounts.get("token")
+    client.Accounts.get("token")
+    with self.assertRaises(RateLimitExceededError) as raised:
+      client.Accounts.get("token")
+    self.assertEqual("RATE_LIMIT_EXCEEDED", raised.exception.type)
+    self.assertEqual([0.25] * 3, self.sleeps)
+    with self.assertRaises(PlaidError):
+      self.client(error_rate=1.0).Accounts.get("token")
+    with self.assertRaises(PlaidError):
+      self.client(max_page_size=100).Transactions.get("token", "2018-01-01", "2018-02-01", count=500)
+
+  def test_record_and_replay(self):
+    recorder = RecordingClient(self.client(), RECORDING)
+    pages = list(PDA.iter_transaction_pages(recorder, "token", 30, 0, page_size=20))
+    with self.assertRaises(RateLimitExceededError):
+      PDA.get_accounts(RecordingClient(self.client(rate_limit_every=1), RECORDING), "token")
+    accounts = PDA.get_accounts(recorder, "token")
+    # Replays in the recorded order, the rate limited request then the retry
+    replay = ReplayClient(RECORDING)
+    self.assertEqual(pages, list(PDA.iter_transaction_pages(replay, "token", 30, 0, page_size=20)))
+    with self.assertRaises(RateLimitExceededError):
+      PDA.get_accounts(replay, "token")
+    self.assertEqual(accounts, PDA.get_accounts(replay, "token"))
+    with self.assertRaises(PlaidError):
+      PDA.get_accounts(replay, "other")
+
+  def test_client_from_env(self):
+    self.assertIsNone(PDA.get_client_from_env({}))
+    client = PDA.get_client_from_env({'PLAID_ENV': 'fake', 'PLAID_FAKE_ACCOUNTS': '4', 'PLAID_FAKE_LATENCY': '0.5'})
+    self.assertEqual((4, 0.5), (client.accounts, client.latency))
+
+  def tearDown(self):
+    if os.path.exists(RECORDING):
+      os.remove(RECORDING)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,99 @@
+import os
+import unittest
+from MoneyGeek.moneygeek import create_app
+from MoneyGeek.flask_util import get_da, get_pool
+from MoneyGeek.summary import get_account_summary
+
+class TestConnectionPool(unittest.TestCase):
+
+  def setUp(self):
+    self.app = create_app({'TESTING': True, 'DATABASE': 'instance/test_pool.sqlite3', 'SQLITE_POOL_SIZE': 1})
+    with self.app.app_context():
+      da = get_da()
+      da.initialise_db('db/schema.sql')
+      da.initialise_db('db/categories.sql')
+      da.migrate('db/migrations')
+
+  def test_connection_reused_across_app_contexts(self):
+    with self.app.app_context():
+      da = get_da()
+      self.assertIs(da, get_da())
+      self.assertEqual("wal", da.db.execute("PRAGMA journal_mode").fetchone()["journal_mode"])
+      self.assertEqual(5000, da.db.execute("PRAGMA busy_timeout").fetchone()["timeout"])
+      # The app hands out plain dict rows
+      self.assertEqual({"one": 1}, da.db.execute("SELECT 1 AS one").fetchone())
+    with self.app.app_context():
+      self.assertIs(da, get_da())
+
+  def test_release_rolls_back_and_bounds_idle(self):
+    with self.app.app_context():
+      pool = get_pool()
+      first = pool.acquire()
+      second = pool.acquire()
+      first.db.execute("INSERT INTO category (name) VALUES ('uncommitted')")
+      pool.release(first)
+      pool.release(second)
+      self.assertEqual(1, pool.idle.qsize())
+      self.assertEqual(None, first.get_category_info('uncommitted'))
+
+  def test_account_summary_cached_until_accounts_change(self):
+    with self.app.app_context():
+      da = get_da()
+      da.add_user("user", "pass", "email")
+      da.add_institution("inst1", "institution 1")
+      da.add_connection(1, "inst1", "abcd")
+      connectionID = da.get_connection_info(1, "inst1")["connectionID"]
+      da.add_account(connectionID, "acc1", 1234, "account 1", "official 1", "Test", "Sub")
+      summary = get_account_summary(1)
+      self.assertEqual(1, len(summary))
+      self.assertIs(summary, get_account_summary(1))
+      # Other users' entries are left alone
+      da.add_user("user2", "pass", "email2")
+      da.add_connection(2, "inst1", "efgh")
+      other = get_account_summary(2)
+      da.add_account(connectionID, "acc2", 5678, "account 2", "official 2", "Test", "Sub")
+      self.assertEqual(2, len(get_account_summary(1)))
+      self.assertIs(other, get_account_summary(2))
+
+  def test_sql_stats_endpoint(self):
+    client = self.app.test_client()
+    with self.app.app_context():
+      get_da().add_user("user", "pass", "email")
+    with client.session_transaction() as session:
+      session['userID'] = 1
+    # Off by default
+    self.assertEqual(404, client.get('/debug/sql').status_code)
+    self.app.config['SQL_STATS'] = True
+    with self.app.app_context():
+      get_pool().close()
+      del self.app.extensions['moneygeek_pool']
+    client.get('/summary/monthly_summary')
+    client.get('/summary/monthly_summary')
+    statements = client.get('/debug/sql').get_json()['statements']
+    self.assertTrue(any(s['sql'].startswith("SELECT r.year") and s['executions'] == 2 for s in statements))
+    # Resetting is for debug mode or when explicitly allowed, not any logged in user
+    self.assertEqual(403, client.delete('/debug/sql').status_code)
+    self.assertNotEqual([], client.get('/debug/sql').get_json()['statements'])
+    self.app.config['SQL_STATS_RESET'] = True
+    self.assertEqual([], client.delete('/debug/sql').get_json()['statements'])
+
+  def test_add_mapping_command(self):
+    runner = self.app.test_cli_runner()
+    result = runner.invoke(args=['add-mapping', 'netflix', 'Groceries'])
+    self.assertIn('Mapped netflix -> Groceries', result.output)
+    # Patterns the categoriser can't combine are refused before they reach the table
+    result = runner.invoke(args=['add-mapping', '(?i)spotify', 'Groceries'])
+    self.assertNotEqual(0, result.exit_code)
+    self.assertIn('(?i) is not supported', result.output)
+    with self.app.app_context():
+      self.assertEqual(['netflix'], [m['pattern'] for m in get_da().get_mappings()])
+
+  def tearDown(self):
+    with self.app.app_context():
+      get_pool().close()
+    for suffix in ('', '-wal', '-shm'):
+      if os.path.exists('instance/test_pool.sqlite3' + suffix):
+        os.remove('instance/test_pool.sqlite3' + suffix)
+
+if __name__ == '__main__':
+  unittest.main()
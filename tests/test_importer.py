@@ -0,0 +1,73 @@
+import io
+import os
+import unittest
+from MoneyGeek.dao import DataAccessor
+from MoneyGeek.categorise import Categoriser
+from MoneyGeek.importer import FileImporter, parse_amount, parse_columns
+
+class TestFileImporter(unittest.TestCase):
+
+  def setUp(self):
+    self.da = DataAccessor('instance/test.sqlite3')
+    self.da.initialise_db('db/schema.sql')
+    self.da.initialise_db('db/categories.sql')
+    self.da.migrate('db/migrations')
+    self.messages = []
+
+  def test_parse_columns(self):
+    self.assertEqual({'date': 1, 'name': 'Description', 'amount': 3}, parse_columns("date=1, name=Description, amount=3"))
+    with self.assertRaises(ValueError):
+      parse_columns("date=0,name=1")
+    with self.assertRaises(ValueError):
+      parse_columns("date=0,name=1,amount=2,colour=3")
+
+  def test_parse_amount(self):
+    self.assertEqual("-1234.50", str(parse_amount("(1,234.50)")))
+    self.assertEqual("12.00", str(parse_amount(" $12.00 ")))
+    with self.assertRaises(ValueError):
+      parse_amount("NaN")
+
+  def test_legacy_tsv(self):
+    lines = io.StringIO(
+      "01/05/18\tx\tWhole Foods\t-25.10\tGroceries\n"
+      + "01/06/18\tx\tCorner shop\t-3.00\n"
+      + "not a date\tx\tBad\t1.00\n"
+      + "01/07/18\tx\tSalary\t1,000.00\tNo-Such-Category\n"
+    )
+    importer = FileImporter(self.da, "acc1", batch_size=2, report=self.messages.append)
+    self.assertEqual((3, 3, 0), importer.run(lines, "bank.tsv"))
+    self.assertEqual(1, importer.errors)
+    rows = dict((r["transactionID"], r) for r in self.da.get_transactions("acc1"))
+    self.assertEqual(["bank.tsv@1", "bank.tsv@2", "bank.tsv@4"], sorted(rows))
+    self.assertEqual("2018-01-05", rows["bank.tsv@1"]["date"])
+    self.assertEqual(self.da.get_category_info("Groceries")["categoryID"], rows["bank.tsv@1"]["categoryID"])
+    self.assertEqual(None, rows["bank.tsv@4"]["categoryID"])
+    self.assertEqual(1000.0, rows["bank.tsv@4"]["amount"])
+    # Two batches of two rows, then the run summary
+    self.assertEqual(2, len([m for m in self.messages if m.startswith("INFO: Batch")]))
+    # Importing the same file again only finds duplicates
+    lines.seek(0)
+    self.assertEqual((3, 0, 3), FileImporter(self.da, "acc1", report=self.messages.append).run(lines, "bank.tsv"))
+
+  def test_csv_with_header(self):
+    transport = self.da.get_category_info("Transportation")["categoryID"]
+    self.da.add_mapping("uber", transport)
+    lines = io.StringIO(
+      "Posted Date,Reference,Description,Amount\n"
+      + "2018-02-01,r1,\"UBER, TRIP\",-12.5\n"
+      + "02/03/2018,r2,Rent,-900\n"
+    )
+    importer = FileImporter(self.da, "acc1", parse_columns("date=Posted Date,id=reference,name=DESCRIPTION,amount=Amount"),
+      ("%Y-%m-%d", "%m/%d/%Y"), ",", True, categoriser=Categoriser(self.da), report=self.messages.append)
+    self.assertEqual((2, 2, 0), importer.run(lines, "ignored"))
+    rows = dict((r["transactionID"], r) for r in self.da.get_transactions("acc1"))
+    self.assertEqual(transport, rows["r1"]["categoryID"])
+    self.assertEqual("UBER, TRIP", rows["r1"]["name"])
+    self.assertEqual("2018-02-03", rows["r2"]["date"])
+
+  def tearDown(self):
+    self.da.close()
+    os.remove('instance/test.sqlite3')
+
+if __name__ == '__main__':
+  unittest.main()
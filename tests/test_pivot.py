@@ -0,0 +1,43 @@
+import unittest
+from MoneyGeek.pivot import Pivot, month_span
+
+class TestPivot(unittest.TestCase):
+
+  def setUp(self):
+    rows = [
+      {'categoryID': 1, 'name': 'Groceries', 'year': 2017, 'month': 12, 'amountCents': 1000},
+      {'categoryID': 1, 'name': 'Groceries', 'year': 2018, 'month': 1, 'amountCents': 250},
+      {'categoryID': 1, 'name': 'Groceries', 'year': 2018, 'month': 3, 'amountCents': 750},
+      {'categoryID': 2, 'name': 'Rent', 'year': 2018, 'month': 1, 'amountCents': 50000},
+      # Outside the period, ignored
+      {'categoryID': 2, 'name': 'Rent', 'year': 2016, 'month': 1, 'amountCents': 1}
+    ]
+    self.pivot = Pivot.from_rows(rows, month_span(2017, 2018), {1: 100, 3: 5})
+
+  def test_shape(self):
+    self.assertEqual([(1, 'Groceries'), (2, 'Rent')], self.pivot.categories)
+    self.assertEqual(24, self.pivot.width)
+    self.assertEqual(1000, self.pivot.row(0)[11])
+    self.assertEqual(250, self.pivot.row(0)[12])
+    self.assertEqual(['Jan 2017', 'Feb 2017'], self.pivot.labels()[:2])
+
+  def test_totals(self):
+    self.assertEqual([2000, 50000], list(self.pivot.totals()))
+    self.assertEqual(50250, self.pivot.month_totals()[12])
+    self.assertEqual(sum(self.pivot.totals()), sum(self.pivot.month_totals()))
+
+  def test_cumulative_and_variance(self):
+    cumulative = self.pivot.cumulative()
+    self.assertEqual(2000, cumulative[23])
+    self.assertEqual(1250, cumulative[12])
+    self.assertEqual(50000, cumulative[2 * 24 - 1])
+    self.assertEqual([2400 - 2000, -50000], list(self.pivot.variance()))
+
+  def test_display_rows(self):
+    rows = list(self.pivot.display_rows(cumulative=True))
+    self.assertEqual(20.0, rows[0]['total'])
+    self.assertEqual(20.0, rows[0]['values'][-1])
+    self.assertEqual(1.0, rows[0]['budget'])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,117 @@
+import os
+import queue
+import sys
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from MoneyGeek import plaid_dao as PDA
+from MoneyGeek.categorise import Categoriser
+from MoneyGeek.dao import DataAccessor
+
+# The sync scripts import their siblings as top level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'MoneyGeek'))
+import pull_data
+
+def make_txn(token, n, amount=1.5, category=("Food", "Coffee")):
+  return {"transaction_id": "{}-{}".format(token, n), "account_id": "acc-" + token, "category": category,
+    "name": "STARBUCKS #{}".format(n), "amount": amount, "date": "2018-01-{:02d}".format(n % 28 + 1),
+    "pending": n % 5 == 4}
+
+class StubTransactions:
+
+  def __init__(self, txns):
+    self.txns = txns   # access token -> list of transactions
+    self.requests = []
+
+  def get(self, access_token, start_date, end_date, count=100, offset=0):
+    self.requests.append((access_token, count, offset))
+    txns = self.txns[access_token]
+    return {"total_transactions": len(txns), "transactions": txns[offset:offset + count]}
+
+class StubClient:
+
+  def __init__(self, txns):
+    self.Transactions = StubTransactions(txns)
+
+class TestDaysAgoStart(unittest.TestCase):
+
+  def test_without_state(self):
+    # Never synced, or --full (which passes no state), fetches the whole window
+    today = date(2018, 3, 1)
+    self.assertEqual(730, pull_data.get_days_ago_start(None, 730, 7, today))
+    self.assertEqual(730, pull_data.get_days_ago_start({"lastTxnDate": None, "lastSyncDate": None}, 730, 7, today))
+    self.assertEqual(730, pull_data.get_days_ago_start({"lastTxnDate": "", "lastSyncDate": ""}, 730, 7, today))
+
+  def test_partial_state(self):
+    today = date(2018, 3, 1)
+    self.assertEqual(19, pull_data.get_days_ago_start({"lastTxnDate": "2018-02-17", "lastSyncDate": None}, 730, 7,
+      today))
+    self.assertEqual(14, pull_data.get_days_ago_start({"lastTxnDate": None, "lastSyncDate": "2018-02-22"}, 730, 7,
+      today))
+
+  def test_overlap(self):
+    # The later of the two marks, plus the overlap, never negative
+    today = date(2018, 3, 1)
+    state = {"lastTxnDate": "2018-02-17", "lastSyncDate": "2018-02-22"}
+    self.assertEqual(7, pull_data.get_days_ago_start(state, 730, 0, today))
+    self.assertEqual(10, pull_data.get_days_ago_start(state, 730, 3, today))
+    self.assertEqual(0, pull_data.get_days_ago_start({"lastTxnDate": "2018-03-05", "lastSyncDate": None}, 730, 0,
+      today))
+
+class TestPaging(unittest.TestCase):
+
+  def test_iter_transaction_pages(self):
+    client = StubClient({"tok": [make_txn("tok", n) for n in range(12)]})
+    pages = list(PDA.iter_transaction_pages(client, "tok", 30, 0, page_size=5))
+    self.assertEqual([5, 5, 2], [len(p) for p in pages])
+    self.assertEqual([("tok", 5, 0), ("tok", 5, 5), ("tok", 5, 10)], client.Transactions.requests)
+    # Resuming from an offset, and plaid's page size limit
+    client.Transactions.requests = []
+    self.assertEqual([4], [len(p) for p in PDA.iter_transaction_pages(client, "tok", 30, 0, 1000, offset=8)])
+    self.assertEqual([("tok", PDA.MAX_PAGE_SIZE, 8)], client.Transactions.requests)
+
+  def test_to_row_without_category(self):
+    self.assertEqual(("Food", "Coffee"), PDA.to_row(make_txn("tok", 1))[2:4])
+    self.assertEqual(("Uncategorised", None), PDA.to_row(make_txn("tok", 1, category=None))[2:4])
+    self.assertEqual(("Uncategorised", None), PDA.to_row(make_txn("tok", 1, category=[]))[2:4])
+
+class TestFetchAndWrite(unittest.TestCase):
+
+  def setUp(self):
+    self.da = DataAccessor('instance/test_pull.sqlite3', check_same_thread=False)
+    self.da.initialise_db('db/schema.sql')
+    self.da.initialise_db('db/categories.sql')
+    self.da.migrate('db/migrations')
+
+  def test_store_error_fails_only_that_connection(self):
+    # The second page of "bad" can't be stored, its later pages are dropped without blocking the fetch
+    bad = [make_txn("bad", n) for n in range(20)]
+    bad[7]["amount"] = "not a number"
+    client = StubClient({"good": [make_txn("good", n) for n in range(12)], "bad": bad})
+    conns = [{"connectionID": 1, "name": "Good", "accessCode": "good"},
+      {"connectionID": 2, "name": "Bad", "accessCode": "bad"}]
+    stats = dict((c["connectionID"], pull_data.new_stat(None)) for c in conns)
+    results = queue.Queue(maxsize=1)
+    writer = threading.Thread(target=pull_data.write_results,
+      args=(self.da, Categoriser(self.da), results, stats, len(conns), date(2018, 2, 1)))
+    writer.start()
+    pool = ThreadPoolExecutor(max_workers=2)
+    for conn in conns:
+      pool.submit(pull_data.fetch_transactions, client, None, conn, 30, 0, results, page_size=5)
+    # Joined first, a writer that stopped draining would leave the fetches blocked forever
+    writer.join(10)
+    self.assertFalse(writer.is_alive())
+    pool.shutdown()
+    # Everything settled from the good connection, just the first page of the bad one
+    self.assertEqual((12, 10), (stats[1]["total"], stats[1]["inserted"]))
+    self.assertEqual(4, stats[2]["inserted"])
+    self.assertEqual("2018-01-12", self.da.get_sync_state(1)["lastTxnDate"])
+    self.assertIsNone(self.da.get_sync_state(2))
+
+  def tearDown(self):
+    self.da.close()
+    os.remove('instance/test_pull.sqlite3')
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+from MoneyGeek.rate_limit import TokenBucket
+
+class FakeClock:
+
+  def __init__(self):
+    self.now = 0.0
+
+  def __call__(self):
+    return self.now
+
+  def sleep(self, seconds):
+    self.now += seconds
+
+class TestTokenBucket(unittest.TestCase):
+
+  def setUp(self):
+    self.clock = FakeClock()
+
+  def test_burst_then_throttle(self):
+    bucket = TokenBucket(2, 3, clock=self.clock, sleep=self.clock.sleep)
+    # The first three go through immediately
+    for _ in range(3):
+      self.assertTrue(bucket.try_acquire())
+    self.assertFalse(bucket.try_acquire())
+    # Half a second refills one token at 2/s
+    self.clock.now += 0.5
+    self.assertTrue(bucket.try_acquire())
+    self.assertFalse(bucket.try_acquire())
+
+  def test_acquire_waits(self):
+    bucket = TokenBucket(4, 1, clock=self.clock, sleep=self.clock.sleep)
+    for _ in range(5):
+      bucket.acquire()
+    # One free token then four more at 4/s
+    self.assertAlmostEqual(1.0, self.clock.now)
+
+  def test_invalid_rate(self):
+    with self.assertRaises(ValueError):
+      TokenBucket(0)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,97 @@
+import os
+import sqlite3
+import sys
+import unittest
+from MoneyGeek.moneygeek import create_app
+from MoneyGeek.flask_util import close_pools, get_da, get_shard_das
+from MoneyGeek.dao import DataAccessor, shard_file
+
+# The scripts import their siblings as top level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'MoneyGeek'))
+import manual_update
+
+DATABASE = 'instance/test_shards.sqlite3'
+FILES = [DATABASE, shard_file(DATABASE, 0), shard_file(DATABASE, 1)]
+
+class TestShards(unittest.TestCase):
+
+  def setUp(self):
+    self.app = create_app({'TESTING': True, 'DATABASE': DATABASE, 'SQLITE_SHARDS': 2})
+    result = self.app.test_cli_runner().invoke(args=['migrate-db', '--init'])
+    self.assertIn('Shard 1: applied migrations', result.output)
+    with self.app.app_context():
+      da = get_da()
+      da.add_institution("inst1", "institution 1")
+      for userID in (1, 2, 3):
+        da.add_user("user{}".format(userID), "pass", "email{}".format(userID))
+        shardDA = get_da(userID)
+        shardDA.add_connection(userID, "inst1", "token{}".format(userID))
+        connectionID = shardDA.get_connection_info(userID, "inst1")["connectionID"]
+        shardDA.add_account(connectionID, "acc{}".format(userID), 1234, "account", "official", "Test", "Sub")
+        shardDA.add_transactions([("t{}".format(userID), "acc{}".format(userID), "Food", None, "STARBUCKS", -4.5,
+          "2018-01-05", shardDA.get_category_info("Coffee")["categoryID"])])
+
+  def rows(self, path, query):
+    conn = sqlite3.connect(path)
+    try:
+      return conn.execute(query).fetchall()
+    finally:
+      conn.close()
+
+  def test_users_routed_to_shards(self):
+    # Users and reference data only in the directory, everything else in the user's shard
+    self.assertEqual(3, len(self.rows(DATABASE, "SELECT * FROM user")))
+    self.assertEqual([], self.rows(DATABASE, "SELECT * FROM txn"))
+    self.assertEqual([("t2", )], self.rows(shard_file(DATABASE, 0), "SELECT transactionID FROM txn"))
+    self.assertEqual([("t1", ), ("t3", )], self.rows(shard_file(DATABASE, 1),
+      "SELECT transactionID FROM txn ORDER BY 1"))
+    tables = set(r[0] for r in self.rows(shard_file(DATABASE, 1), "SELECT name FROM sqlite_master WHERE type = 'table'"))
+    self.assertFalse(tables & {'user', 'institution', 'category', 'mapping'})
+    with self.app.app_context():
+      # Queries joining both see the directory through the shard
+      self.assertEqual(["institution 1"], [a["institution"] for a in get_da(3).get_summary(3)])
+      self.assertEqual(["Coffee"], [r["catName"] for r in get_da(3).get_monthly_summary(3, "2018", "01")])
+      self.assertEqual([], get_da(3).get_summary(2))
+      self.assertEqual(2, len(get_shard_das()))
+
+  def test_logged_in_user_served_from_shard(self):
+    client = self.app.test_client()
+    with client.session_transaction() as session:
+      session['userID'] = 2
+    response = client.get('/summary/monthly_summary?year=2018&month=1')
+    self.assertIn(b'Coffee', response.data)
+    response = client.get('/summary/api/search?q=starbucks')
+    self.assertEqual(["t2"], [t["transactionID"] for t in response.get_json()["transactions"]])
+
+  def test_directory_changes_seen_by_every_shard(self):
+    with self.app.app_context():
+      categories = len(get_da(1).get_categories())
+      get_da(2).add_category("Sharded")
+      self.assertEqual(categories + 1, len(get_da(1).get_categories()))
+      self.assertEqual(get_da(1).get_ref_version('category'), get_da().get_ref_version('category'))
+    with self.assertRaises(IOError):
+      DataAccessor(shard_file(DATABASE, 5), directory=DATABASE)
+
+  def test_manual_update_uses_user_shard(self):
+    # Logged in through the directory, the user's connections and accounts come from their shard
+    manual_update.raw_input = lambda prompt: "0"
+    mu = manual_update.ManualUpdater(DATABASE, client=object(), shards=2)
+    try:
+      mu.set_user("user2")
+      self.assertEqual(shard_file(DATABASE, 0), mu.da.db_file)
+      self.assertEqual("token2", mu.userConn["conn_info"]["accessCode"])
+      self.assertEqual("acc2", mu.choose_account())
+    finally:
+      mu.da.close()
+      del manual_update.raw_input
+
+  def tearDown(self):
+    with self.app.app_context():
+      close_pools()
+    for path in FILES:
+      for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+          os.remove(path + suffix)
+
+if __name__ == '__main__':
+  unittest.main()
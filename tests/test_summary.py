@@ -0,0 +1,75 @@
+import os
+import unittest
+from MoneyGeek.moneygeek import create_app
+from MoneyGeek.flask_util import get_da, get_pool
+
+DATABASE = 'instance/test_summary.sqlite3'
+
+class TestSummaryArguments(unittest.TestCase):
+
+  def setUp(self):
+    self.app = create_app({'TESTING': True, 'DATABASE': DATABASE})
+    with self.app.app_context():
+      da = get_da()
+      da.initialise_db('db/schema.sql')
+      da.initialise_db('db/categories.sql')
+      da.migrate('db/migrations')
+      da.add_user("user", "pass", "email")
+      da.add_institution("inst1", "institution 1")
+      da.add_connection(1, "inst1", "token1")
+      da.add_account(1, "acc1", 1234, "account", "official", "Test", "Sub")
+    self.client = self.app.test_client()
+    with self.client.session_transaction() as session:
+      session['userID'] = 1
+
+  def test_invalid_month(self):
+    for query in ('year=abc&month=1', 'year=2018&month=x', 'year=2018&month=13', 'year=0&month=1'):
+      self.assertEqual(400, self.client.get('/summary/monthly_summary?' + query).status_code)
+      self.assertEqual(400, self.client.get('/summary/api/transactions?accountID=acc1&' + query).status_code)
+    self.assertEqual(200, self.client.get('/summary/monthly_summary?year=2018&month=1').status_code)
+    for chosen_date in ('garbage', '2018', '2018-x'):
+      response = self.client.post('/summary/view_account', data={'accountID': 'acc1', 'chosen_date': chosen_date})
+      self.assertEqual(400, response.status_code)
+    response = self.client.post('/summary/view_account', data={'accountID': 'acc1', 'chosen_date': '2018-01'})
+    self.assertEqual(200, response.status_code)
+
+  def test_annual_summary_years(self):
+    for query in ('year=abc', 'start_year=2018&end_year=x', 'start_year=1&end_year=10000'):
+      self.assertEqual(400, self.client.get('/summary/annual_summary?' + query).status_code)
+    # Swapped and overlong ranges are fixed up rather than rejected
+    response = self.client.get('/summary/annual_summary?start_year=2018&end_year=2016')
+    self.assertIn(b'2016 - 2018', response.data)
+    response = self.client.get('/summary/annual_summary?start_year=1&end_year=9999')
+    self.assertEqual(200, response.status_code)
+    self.assertIn('1 - {}'.format(self.app.config['SUMMARY_MAX_YEARS']).encode(), response.data)
+
+  def test_transaction_pages_with_timestamps(self):
+    # Older uploads stored full timestamps, paging carries on after the exact stored value
+    rows = [("id{}".format(i), "acc1", "Misc", None, "shop", 1, "2018-01-{:02d}T00:00:00".format(i // 2 + 1), None)
+      for i in range(5)]
+    with self.app.app_context():
+      get_da().add_transactions(rows)
+    seen = []
+    after = ''
+    for page in range(3):
+      response = self.client.get('/summary/api/transactions?accountID=acc1&year=2018&month=1&limit=2&after='
+        + after)
+      self.assertEqual(200, response.status_code)
+      data = response.get_json()
+      seen += [t['transactionID'] for t in data['transactions']]
+      after = data['next']
+    self.assertEqual(["id{}".format(i) for i in range(5)], seen)
+    self.assertIsNone(after)
+    for after in ('garbage', '2018-01-01:id1', 'WyJhIl0='):
+      response = self.client.get('/summary/api/transactions?accountID=acc1&year=2018&month=1&after=' + after)
+      self.assertEqual(400, response.status_code)
+
+  def tearDown(self):
+    with self.app.app_context():
+      get_pool().close()
+    for suffix in ('', '-wal', '-shm'):
+      if os.path.exists(DATABASE + suffix):
+        os.remove(DATABASE + suffix)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,137 @@
+import datetime
+import os
+import sqlite3
+import sys
+import unittest
+from MoneyGeek import plaid_dao as PDA
+from MoneyGeek.categorise import Categoriser
+from MoneyGeek.dao import DataAccessor
+from MoneyGeek.fake_plaid import FakeClient
+
+# The sync scripts import their siblings as top level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'MoneyGeek'))
+import sync_daemon
+
+class BrokenCategoriser:
+  # Storing a page fails the way a locked database would
+
+  def categorise(self, rows):
+    raise sqlite3.OperationalError("database is locked")
+
+class TestSyncDaemon(unittest.TestCase):
+
+  def setUp(self):
+    self.da = DataAccessor('instance/test_sync.sqlite3', check_same_thread=False)
+    self.da.initialise_db('db/schema.sql')
+    self.da.initialise_db('db/categories.sql')
+    self.da.migrate('db/migrations')
+    self.da.add_user("user", "pass", "email")
+    for institutionID in ("inst1", "inst2"):
+      self.da.add_institution(institutionID, institutionID)
+      self.da.add_connection(1, institutionID, "token-" + institutionID)
+    self.messages = []
+
+  def daemon(self, client, **options):
+    options.setdefault("workers", 2)
+    return sync_daemon.SyncDaemon(self.da, client, None, Categoriser(self.da), days_ago_start=30,
+      page_size=20, report=self.messages.append, **options)
+
+  def jobs(self):
+    return dict((j["connectionID"], j) for j in self.da.get_sync_jobs())
+
+  def transactions(self):
+    return self.da.db.execute("SELECT COUNT(*) AS n FROM txn").fetchone()["n"]
+
+  def test_sync(self):
+    self.daemon(FakeClient(per_day=2)).run(poll=0.01, once=True)
+    jobs = self.jobs()
+    self.assertEqual({"idle"}, {j["status"] for j in jobs.values()})
+    self.assertTrue(all(j["lastSuccessAt"] for j in jobs.values()))
+    self.assertIsNotNone(self.da.get_sync_state(1))
+    self.assertGreater(self.transactions(), 0)
+
+  def test_backoff_and_resume_from_checkpoint(self):
+    # Every third request fails, after two stored pages of 20
+    daemon = self.daemon(FakeClient(per_day=2, rate_limit_every=3), workers=1)
+    daemon.run(poll=0.01, once=True)
+    job = self.jobs()[1]
+    self.assertEqual((1, 40), (job["attempts"], job["checkpointOffset"]))
+    self.assertIn("RateLimitExceededError", job["lastError"])
+    self.assertGreater(job["nextRunAt"], sync_daemon.to_timestamp(sync_daemon.utcnow()))
+    self.assertIsNone(self.da.get_sync_state(1))
+    # Once due, the retry carries on from the checkpoint and finishes the window
+    self.da.db.execute("UPDATE sync_job SET nextRunAt = '2000-01-01 00:00:00'")
+    daemon.client = FakeClient(per_day=2)
+    daemon.run(poll=0.01, once=True)
+    self.assertIn("(resuming at 40)", "".join(self.messages))
+    jobs = self.jobs()
+    self.assertEqual([(0, None, 0)] * 2, [(j["attempts"], j["lastError"], j["checkpointOffset"]) for j in jobs.values()])
+    settled = [t for token in ("token-inst1", "token-inst2")
+      for t in PDA.iter_transactions(FakeClient(per_day=2), token, 30, 0) if not t["pending"]]
+    self.assertEqual(len(settled), self.transactions())
+
+  def test_backoff_delay(self):
+    self.assertTrue(48 <= sync_daemon.backoff_delay(0, 60, 3600) <= 72)
+    self.assertTrue(192 <= sync_daemon.backoff_delay(2, 60, 3600) <= 288)
+    self.assertTrue(sync_daemon.backoff_delay(40, 60, 3600) <= 3600 * 1.2)
+
+  def test_storage_error_fails_job(self):
+    # A page that can't be stored fails the job with backoff, the run carries on with the others
+    daemon = self.daemon(FakeClient(per_day=2))
+    daemon.categoriser = BrokenCategoriser()
+    daemon.run(poll=0.01, once=True)
+    jobs = self.jobs()
+    self.assertEqual((1, 1), (jobs[1]["attempts"], jobs[2]["attempts"]))
+    self.assertEqual({"idle"}, {j["status"] for j in jobs.values()})
+    self.assertIn("database is locked", jobs[1]["lastError"])
+    self.assertGreater(jobs[1]["nextRunAt"], sync_daemon.to_timestamp(sync_daemon.utcnow()))
+
+  def test_stop(self):
+    # Stopped while the first job runs: it is finished, nothing else is claimed
+    daemon = self.daemon(FakeClient(per_day=2), workers=1)
+    def report(message):
+      self.messages.append(message)
+      if message.startswith("-> INFO: Syncing"):
+        daemon.stop()
+    daemon.report = report
+    daemon.run(poll=0.01)
+    jobs = self.jobs()
+    self.assertEqual([None], [j["lastSuccessAt"] for j in jobs.values() if j["connectionID"] == 2])
+    self.assertIsNotNone(jobs[1]["lastSuccessAt"])
+    self.assertEqual({"idle"}, {j["status"] for j in jobs.values()})
+
+  def test_mapping_added_by_another_process(self):
+    # Added the way flask add-mapping would from its own process, so without a ref version bump
+    # here: the running daemon still picks it up
+    daemon = self.daemon(FakeClient(per_day=2), workers=1)
+    daemon.categoriser.ttl = 0
+    daemon.run(poll=0.01, once=True)
+    other = DataAccessor('instance/test_sync.sqlite3')
+    other.db.execute("INSERT INTO mapping (pattern, categoryID) VALUES ('.', 1)")
+    other.conn.commit()
+    other.close()
+    self.da.db.execute("DELETE FROM txn")
+    self.da.db.execute("UPDATE sync_job SET nextRunAt = '2000-01-01 00:00:00'")
+    self.da.conn.commit()
+    daemon.run(poll=0.01, once=True)
+    categories = {row["categoryID"] for row in self.da.db.execute("SELECT categoryID FROM txn")}
+    self.assertEqual({1}, categories)
+
+  def test_stale_jobs_released(self):
+    # Another daemon's job is left alone until it has been running for stale_after
+    self.da.ensure_sync_jobs("2018-01-01 00:00:00")
+    self.da.claim_sync_jobs(sync_daemon.to_timestamp(sync_daemon.utcnow() - datetime.timedelta(seconds=60)), 2)
+    self.daemon(FakeClient(per_day=2)).run(poll=0.01, once=True)
+    self.assertEqual({"running"}, {j["status"] for j in self.jobs().values()})
+    self.daemon(FakeClient(per_day=2), stale_after=30).run(poll=0.01, once=True)
+    self.assertEqual({"idle"}, {j["status"] for j in self.jobs().values()})
+    self.assertIn("INFO: Resuming 2 stale job(s)", self.messages)
+
+  def tearDown(self):
+    self.da.close()
+    for suffix in ('', '-wal', '-shm'):
+      if os.path.exists('instance/test_sync.sqlite3' + suffix):
+        os.remove('instance/test_sync.sqlite3' + suffix)
+
+if __name__ == '__main__':
+  unittest.main()